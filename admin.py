@@ -0,0 +1,264 @@
+"""
+Administrator pages.  Only App Engine admins can reach /admin/* (see app.yaml).
+"""
+
+from datetime import date, datetime, time as dt_time, timedelta
+from dateutil import parser as date_parser
+import pytz
+
+from flask import (Blueprint, Response, current_app, flash, redirect, render_template, 
+    request, stream_with_context, url_for)
+from google.appengine.api import app_identity, taskqueue, users
+from google.appengine.ext import ndb
+
+import availability
+import cancellations
+import counters
+import exports
+from forms import ActionForm, BulkScheduleForm, CancelBookingsForm, ImportBookingsForm
+import imports
+import metrics
+import modelcache
+from models import Booking, ImportJob, User, UserPrefs
+
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+def validAction():
+    """
+    True if a POSTed admin button came with a valid CSRF token.
+    """
+    if ActionForm().validate_on_submit():
+        return True
+    flash('That page has expired. Please reload it and try again.', 'error')
+    return False
+
+@admin.route('/')
+def index():
+    return render_template('admin-index.html', 
+        cache_rates=modelcache.hitRates(['User', 'Booking', 'RemindersToken', 'FeedToken', 'WatchChannel']),
+        prefetch=availability.prefetchStats(),
+        user_saves=metrics.getMulti(['user.writes', 'user.writes_avoided']),
+        action_form=ActionForm())
+
+@admin.route('/matrix')
+@admin.route('/matrix/<date_str>')
+def matrix(date_str=None):
+    d = date.today() if date_str is None else date_parser.parse(date_str).date()
+    d -= timedelta(days=d.weekday())
+    week_end = d + timedelta(days=6)
+    report = User.getAvailabilityMatrix(d, week_end)
+
+    # Show times in the first teacher's time zone
+    tz = report.users[0].getTimezoneObject() if report.users else None
+    times = report.columnDatetimes(tz) if tz else [ ]
+    days = [ ]
+    for t in times:
+        if not days or days[-1][0] != t.date():
+            days.append([t.date(), 0])
+        days[-1][1] += 1
+    return render_template('admin-matrix.html', matrix=report, times=times, days=days,
+        counts=report.availableCounts(),
+        week_start=d, date_prev=(d - timedelta(days=7)).strftime('%Y-%m-%d'),
+        date_next=(d + timedelta(days=7)).strftime('%Y-%m-%d'))
+
+@admin.route('/utilization')
+def utilization():
+    """
+    Bookings against scheduled slots per day and per teacher over a date
+    range.  Reads only the booking counters and the teachers' schedules,
+    never the bookings.
+    """
+    teachers = User.getTeachers()
+    if request.args.get('from') and request.args.get('to'):
+        d_from = date_parser.parse(request.args['from']).date()
+        d_to = date_parser.parse(request.args['to']).date()
+    else:
+        firsts = [u.prefs.first_day_scheduled for u in teachers if u.prefs.first_day_scheduled]
+        lasts = [u.prefs.last_day_scheduled for u in teachers if u.prefs.last_day_scheduled]
+        d_from = min(firsts) if firsts else date.today() - timedelta(days=date.today().weekday())
+        d_to = max(lasts) if lasts else d_from + timedelta(days=34)
+    d_to = min(d_to, d_from + timedelta(days=61))
+
+    dates = [ ]
+    d = d_from
+    while d <= d_to:
+        dates.append(d)
+        d += timedelta(days=1)
+
+    # Scheduled slots per teacher and day; only those days can have bookings
+    schedules = [ ]
+    day_slots = dict((d, 0) for d in dates)
+    for user in teachers:
+        slots = { }
+        for day in user.getSlotGrid(d_from, d_to).days:
+            slots[day.date] = bin(day.schedule).count('1')
+            day_slots[day.date] += slots[day.date]
+        schedules.append((user, slots))
+
+    names = [Booking.dayCounter(d) for d in dates]
+    for user, slots in schedules:
+        names.append(Booking.teacherCounter(user.key.id()))
+        names.extend(Booking.teacherDayCounter(user.key.id(), d) for d in slots)
+    counts = counters.getCounts(names)
+
+    rows = [ ]
+    for user, slots in schedules:
+        booked = sum(counts[Booking.teacherDayCounter(user.key.id(), d)] for d in slots)
+        rows.append((user, booked, sum(slots.values()), counts[Booking.teacherCounter(user.key.id())]))
+    days = [(d, counts[Booking.dayCounter(d)], day_slots[d]) for d in dates if day_slots[d]]
+    return render_template('admin-utilization.html', rows=rows, days=days,
+        total_booked=sum(r[1] for r in days), total_slots=sum(r[2] for r in days),
+        d_from=d_from, d_to=d_to, action_form=ActionForm())
+
+@admin.route('/utilization/recount', methods=['POST'])
+def recount():
+    if validAction():
+        taskqueue.add(url=url_for('recount_bookings_task'))
+        flash('The booking counters are being rebuilt.', 'info')
+    return redirect(url_for('admin.utilization'))
+
+@admin.route('/schedule', methods=['GET', 'POST'])
+def schedule():
+    teachers = User.getTeachers()
+    form = BulkScheduleForm()
+    form.uids.choices = [(u.key.urlsafe(), u.prefs.display_name or u.email) for u in teachers]
+    if request.method == 'POST':
+        if form.validate_on_submit():
+            keys = [ndb.Key(urlsafe=uid) for uid in form.uids.data]
+            updated = User.updateMulti(keys, form.populate_obj)
+            flash('Updated the schedule for %d teachers.' % len(updated), 'info')
+            return redirect(url_for('admin.schedule'))
+        flash('The schedule could not be updated. Please correct these fields and re-submit.', 'error')
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash('> %s: %s' % (getattr(form, field).label.text, error), 'error')
+    return render_template('admin-schedule.html', form=form)
+
+def exportFilters(args):
+    """
+    (query, canceled, name) for the export filters in `args`.
+    Dates are local to the teacher, or to the default time zone when
+    exporting everybody.
+    """
+    resource = User.getByUrlsafeId(args['uid']) if args.get('uid') else None
+    tz = resource.getTimezoneObject() if resource else pytz.timezone(UserPrefs.timezone._default)
+    dt_from = dt_to = None
+    if args.get('from'):
+        dt_from = tz.localize(datetime.combine(date_parser.parse(args['from']).date(), dt_time()))
+        dt_from = dt_from.astimezone(pytz.utc).replace(tzinfo=None)
+    if args.get('to'):
+        dt_to = tz.localize(datetime.combine(
+            date_parser.parse(args['to']).date() + timedelta(days=1), dt_time()))
+        dt_to = dt_to.astimezone(pytz.utc).replace(tzinfo=None)
+    canceled = args.get('canceled', 'exclude')
+    if canceled not in exports.CANCELED_CHOICES:
+        canceled = 'exclude'
+    name = resource.prefs.display_name if resource else current_app.config['FRIENDLY_NAME']
+    qry = exports.queryBookings(resource.key if resource else None, dt_from, dt_to)
+    return (qry, canceled, name)
+
+def exportChunks(fmt, args):
+    qry, canceled, name = exportFilters(args)
+    if fmt == 'csv':
+        return exports.csvChunks(qry, canceled)
+    return exports.icsChunks(qry, name, current_app.config['SERVER_NAME'], canceled)
+
+def exportBucket():
+    return current_app.config['EXPORT_BUCKET'] or app_identity.get_default_gcs_bucket_name()
+
+def exportResponse(fmt, args):
+    response = Response(stream_with_context(exportChunks(fmt, args)), mimetype=exports.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=bookings.%s' % fmt
+    return response
+
+@admin.route('/export')
+def export():
+    return render_template('admin-export.html', teachers=User.getTeachers(),
+        canceled_choices=exports.CANCELED_CHOICES)
+
+@admin.route('/export/bookings.<fmt>')
+def export_bookings(fmt):
+    if fmt not in ('csv', 'ics'):
+        return 'Unknown export format', 404
+    qry, canceled, name = exportFilters(request.args)
+    if qry.count(limit=exports.INLINE_LIMIT + 1) > exports.INLINE_LIMIT:
+        params = dict(request.args.items())
+        params.update({ 'fmt': fmt, 'email': users.get_current_user().email() })
+        taskqueue.add(url=url_for('export_bookings_task'), params=params)
+        flash('That export is large, so a link to it will be emailed to you when it is ready.', 'info')
+        return redirect(url_for('admin.export'))
+    return exportResponse(fmt, request.args)
+
+@admin.route('/export/files/<filename>')
+def export_file(filename):
+    fmt = filename.rsplit('.', 1)[-1]
+    f = exports.openExport(exportBucket(), filename) if fmt in exports.MIMETYPES else None
+    if f is None:
+        return 'Unknown export', 404
+    response = Response(exports.fileChunks(f), mimetype=exports.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=bookings.%s' % fmt
+    return response
+
+@admin.route('/cancel', methods=['GET', 'POST'])
+def cancel():
+    form = CancelBookingsForm()
+    form.uid.choices = [('', 'All teachers')] + [(u.key.urlsafe(), u.prefs.display_name) 
+        for u in User.getTeachers()]
+    if request.method == 'POST':
+        if form.validate_on_submit():
+            qry = exportFilters({ 'uid': form.uid.data, 'from': form.date_from.data.isoformat(),
+                'to': form.date_to.data.isoformat() })[0]
+            bookings = [b for b in qry if b.canceled is None]
+            done = cancellations.cancelBookings(bookings, form.reason.data)
+            flash('%d bookings were canceled. The families will get an email.' % len(done), 'info')
+            return redirect(url_for('admin.cancel'))
+        flash('The bookings were not canceled. Please correct these fields and re-submit.', 'error')
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash('> %s: %s' % (getattr(form, field).label.text, error), 'error')
+    return render_template('admin-cancel.html', form=form)
+
+@admin.route('/import', methods=['GET', 'POST'])
+def import_bookings():
+    form = ImportBookingsForm()
+    if request.method == 'POST':
+        if form.validate_on_submit():
+            upload = form.file.data
+            job = imports.startImport(upload.read(), upload.filename)
+            return redirect(url_for('admin.import_status', job_id=job.key.id()))
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash('%s.' % error, 'error')
+    return render_template('admin-import.html', form=form, columns=imports.CSV_COLUMNS)
+
+@admin.route('/import/<int:job_id>')
+def import_status(job_id):
+    job = ImportJob.get_by_id(job_id)
+    if job is None:
+        return 'Unknown import', 404
+    return render_template('admin-import-status.html', job=job)
+
+@admin.route('/index-users', methods=['POST'])
+def index_users():
+    if validAction():
+        taskqueue.add(url=url_for('index_users_task'))
+        flash('Teacher search tokens are being rebuilt.', 'info')
+    return redirect(url_for('admin.index'))
+
+@admin.route('/index-attendee-emails', methods=['POST'])
+def index_attendee_emails():
+    if validAction():
+        taskqueue.add(url=url_for('index_attendee_emails_task'))
+        flash('Family email lookups are being rebuilt.', 'info')
+    return redirect(url_for('admin.index'))
+
+@admin.route('/migrate-bookings', methods=['POST'])
+def migrate_bookings():
+    if not current_app.config['ANCESTOR_BOOKINGS']:
+        flash('Set ancestor_bookings = True in the config file first.', 'error')
+    elif validAction():
+        taskqueue.add(url=url_for('migrate_booking_keys_task'))
+        flash('Bookings are being moved under their teachers.', 'info')
+    return redirect(url_for('admin.index'))
@@ -6,6 +6,12 @@ WSGI applications specified in app.yaml are loaded.
 
 # linkenv script to work with py27 virtualenv on dev appserver
 import os, sys
+
+# Time every import made while the instance starts up
+if os.environ.get('PROFILE_IMPORTS'):
+    import importtimer
+    importtimer.install()
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'gaenv')) 
 
 from google.appengine.ext import vendor
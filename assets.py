@@ -0,0 +1,61 @@
+"""
+Script and style bundles, built before deploying with Flask-Assets.
+
+Each bundle is minified into static/gen with a hash of its contents in
+the file name.  app.yaml serves static/gen with a far-future expiration;
+a changed bundle gets a new name, so browsers never use a stale copy.
+The hashes are recorded in assets-manifest, which is kept outside
+static/ because App Engine doesn't let the app read files under a
+static_dir.
+
+App Engine can't write files, so bundles are never built on the fly.
+Build them before deploying, and after changing anything they include:
+
+    python assets.py
+
+With ASSETS_DEBUG on (the default on the development server) templates
+link the source files one by one, and no build is needed.
+"""
+
+import logging
+import os
+
+from flask_assets import Bundle, Environment
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+bundles = {
+    # jQuery and the webshim loader for <input type="date"> and friends.
+    # forms.js tells webshim where its shims are, since it can't tell
+    # from the bundle's URL.
+    'forms_js': Bundle(
+        'js/jquery-2.1.4.min.js',
+        'js/js-webshim-1.15.10/polyfiller.js',
+        'js/forms.js',
+        filters='jsmin', output='gen/forms.%(version)s.js'),
+    'site_css': Bundle(
+        'css/site.css',
+        filters='cssmin', output='gen/site.%(version)s.css'),
+}
+
+
+def init_app(app):
+    env = Environment(app)
+    env.auto_build = False
+    env.versions = 'hash'
+    env.url_expire = False
+    env.manifest = 'file:%s' % os.path.join(ROOT, 'assets-manifest')
+    env.register(bundles)
+    return env
+
+
+if __name__ == '__main__':
+    from flask import Flask
+    from webassets.script import CommandLineEnvironment
+
+    logging.basicConfig(level=logging.INFO)
+    app = Flask(__name__, static_folder=os.path.join(ROOT, 'static'))
+    env = init_app(app)
+    with app.app_context():
+        CommandLineEnvironment(env, logging.getLogger('assets')).build()
@@ -0,0 +1,166 @@
+"""
+Cached availability for the public calendar views.
+
+Computed slot grids are kept in memcache and served stale-while-revalidate:
+
+* younger than AVAILABILITY_SOFT_TTL seconds: served as is;
+* between the soft and hard TTL: served as is, and a task queue refresh
+  is started (at most one per soft TTL period);
+* older than AVAILABILITY_HARD_TTL, or missing: computed before serving.
+
+Parents browsing the calendar may see availability a few seconds old.
+Booking never relies on this cache; see `reserveSlot` and
+`User.isSlotFree`.
+
+Every cache key includes a per-teacher generation number, so
+`invalidate()` drops all of a teacher's cached weeks at once.
+
+While a week is served, `prefetchAdjacent` queues computing the weeks
+before and after it, so the calendar's "< Prev" and "Next >" links find
+them cached.  Its memcache calls and the enqueue are asynchronous, so
+they overlap rendering the page.  Prefetched grids are marked, and the `prefetch.*` metrics
+count how many were queued, how many were then shown, and how often a
+parent got there before the prefetch had finished.
+"""
+
+from datetime import datetime, time as dt_time, timedelta
+import time
+
+from flask import current_app, url_for
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+import metrics
+
+
+# How long a parent holds a slot while their booking is being saved
+RESERVATION_SECONDS = 60
+
+
+def generation(user_id):
+    return memcache.get('avail-gen:%s' % user_id) or 0
+
+def invalidate(user_id):
+    memcache.incr('avail-gen:%s' % user_id, initial_value=0)
+
+def invalidateMulti(user_ids):
+    memcache.offset_multi(dict((user_id, 1) for user_id in user_ids), 
+        key_prefix='avail-gen:', initial_value=0)
+
+def _cacheKey(user_id, d_from, d_to, gen=None):
+    if gen is None:
+        gen = generation(user_id)
+    return 'avail:%s:%d:%s:%s' % (user_id, gen, d_from.isoformat(), d_to.isoformat())
+
+def computeSlotGrid(resource, d_from, d_to, prefetched=False):
+    """
+    Compute the grid for the local dates `d_from` through `d_to`
+    and store it in the cache.
+    """
+    tz = resource.getTimezoneObject()
+    key = _cacheKey(resource.key.id(), d_from, d_to)
+    grid = resource.getAvailableSlotGrid(
+        tz.localize(datetime.combine(d_from, dt_time())),
+        tz.localize(datetime.combine(d_to, dt_time.max)))
+    hard_ttl = current_app.config['AVAILABILITY_HARD_TTL']
+    if hard_ttl > 0:
+        values = { key: (time.time(), grid) }
+        if prefetched:
+            values[key + ':prefetched'] = 1
+        memcache.set_multi(values, time=hard_ttl)
+    return grid
+
+def getSlotGrid(resource, d_from, d_to):
+    """
+    The grid for the local dates `d_from` through `d_to`, possibly stale.
+    """
+    config = current_app.config
+    key = _cacheKey(resource.key.id(), d_from, d_to)
+    cached = memcache.get_multi([key, key + ':prefetched', key + ':prefetch'])
+    if key in cached:
+        computed, grid = cached[key]
+        age = time.time() - computed
+        if age <= config['AVAILABILITY_HARD_TTL']:
+            if age > config['AVAILABILITY_SOFT_TTL']:
+                _scheduleRefresh(resource, d_from, d_to, key)
+            if key + ':prefetched' in cached:
+                # Count each prefetched week once
+                memcache.delete(key + ':prefetched')
+                metrics.incr('prefetch.used')
+            return grid
+    if key + ':prefetch' in cached:
+        metrics.incr('prefetch.late')
+    return computeSlotGrid(resource, d_from, d_to)
+
+@ndb.tasklet
+def prefetchAdjacent(resource, d_from, d_to):
+    """
+    Queue computing the periods just before and after the local dates
+    `d_from` through `d_to`.  Periods that are cached, already queued,
+    over, or off the teacher's schedule are skipped.  Returns a Future
+    for the number of tasks queued; the request must wait for it before
+    it ends.
+    """
+    config = current_app.config
+    hard_ttl = config['AVAILABILITY_HARD_TTL']
+    if not config['AVAILABILITY_PREFETCH'] or hard_ttl <= 0:
+        raise ndb.Return(0)
+    user_id = resource.key.id()
+    gen = generation(user_id)
+    today = datetime.now(resource.getTimezoneObject()).date()
+    length = d_to - d_from + timedelta(days=1)
+    periods = { }
+    for start in (d_from - length, d_from + length):
+        end = start + length - timedelta(days=1)
+        if end >= today and resource.getSlotGrid(start, end).days:
+            periods[_cacheKey(user_id, start, end, gen)] = (start, end)
+    if not periods:
+        raise ndb.Return(0)
+
+    # ndb batches these into one get_multi and one add_multi
+    ctx = ndb.get_context()
+    keys = list(periods.keys())
+    cached = yield [ctx.memcache_get(key) for key in keys]
+    keys = [key for key, value in zip(keys, cached) if value is None]
+    added = yield [ctx.memcache_add(key + ':prefetch', 1, time=hard_ttl) for key in keys]
+    tasks = [ ]
+    for key, ok in zip(keys, added):
+        if ok:
+            start, end = periods[key]
+            tasks.append(taskqueue.Task(url=url_for('refresh_availability'), params={
+                'uid': resource.key.urlsafe(),
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'prefetch': '1' }))
+    if tasks:
+        counted = metrics.incrAsync('prefetch.queued', len(tasks))
+        yield taskqueue.Queue().add_async(tasks)
+        yield counted
+    raise ndb.Return(len(tasks))
+
+def prefetchStats():
+    """
+    (queued, used, late, hit rate) for the admin page.
+    """
+    counts = metrics.getMulti(['prefetch.queued', 'prefetch.used', 'prefetch.late'])
+    queued, used, late = counts['prefetch.queued'], counts['prefetch.used'], counts['prefetch.late']
+    return (queued, used, late, float(used) / queued if queued else None)
+
+def _scheduleRefresh(resource, d_from, d_to, key):
+    soft_ttl = max(current_app.config['AVAILABILITY_SOFT_TTL'], 1)
+    if memcache.add(key + ':refresh', 1, time=soft_ttl):
+        taskqueue.add(url=url_for('refresh_availability'), params={
+            'uid': resource.key.urlsafe(),
+            'from': d_from.isoformat(),
+            'to': d_to.isoformat() })
+
+def reserveSlot(resource, dt_start):
+    """
+    Hold the slot starting at `dt_start` while a booking is saved.  Returns
+    False if somebody else is booking the same slot right now.
+    """
+    key = 'reserve:%s:%s' % (resource.key.id(), dt_start.isoformat())
+    return memcache.add(key, 1, time=RESERVATION_SECONDS)
+
+def releaseSlot(resource, dt_start):
+    memcache.delete('reserve:%s:%s' % (resource.key.id(), dt_start.isoformat()))
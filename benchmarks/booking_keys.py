@@ -0,0 +1,152 @@
+"""
+Compare the two Booking layouts on the local datastore stub: root entities
+found with `Booking.resource == key` queries (the default) against
+entities keyed under their teacher by slot (`ancestor_bookings = True`).
+
+For each layout it measures, for N_TEACHERS teachers with N_BOOKINGS
+bookings each:
+
+* the slot-taken check made before a booking is saved
+  (`User.isSlotFree` without the Calendar part, or a key get),
+* listing a teacher's bookings (`Booking.getBookingsForResource`), and
+* how many bookings written a moment ago are missing from that listing.
+  The stub is set up like production's eventual consistency at its
+  worst: a global query never sees a write until its entity group has
+  been read again.
+
+Times from the stub only show relative cost; datastore RPC counts are
+printed as well.  Run from the top level folder, with the packages in
+requirements.txt installed and the App Engine SDK on PYTHONPATH:
+
+    PYTHONPATH=$GAE_SDK:$GAE_SDK/lib/fancy_urllib python benchmarks/booking_keys.py
+
+With SDK 1.9.88 (20 teachers, 50 bookings each; per check and per listing):
+
+    layout     slot check          listing            new bookings missing
+    root       51-60 ms, 1 RPC     85-121 ms, 1 RPC   20 of 20
+    ancestor   1.1-1.9 ms, 1 RPC   36-61 ms, 1 RPC     0 of 20
+"""
+
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+# Load lib/ now: once the testbed is active, appengine_config would also
+# apply the dev_appserver socket patch, which needs the real dev server
+import appengine_config
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from models import Attendee, Booking, User
+
+
+N_TEACHERS = 20
+N_BOOKINGS = 50
+N_CHECKS = 200
+
+_rpcs = [0]
+
+
+def count_rpc(service, call, request, response):
+    _rpcs[0] += 1
+
+def setup():
+    tb = testbed.Testbed()
+    tb.activate()
+    # probability=0: writes are only applied when their entity group is read
+    tb.init_datastore_v3_stub(consistency_policy=
+        datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+    tb.init_memcache_stub()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', count_rpc, 'datastore_v3')
+    ctx = ndb.get_context()
+    ctx.set_cache_policy(False)
+    ctx.set_memcache_policy(False)
+    return tb
+
+def make_booking(user, start_utc):
+    booking = Booking(key=Booking.newKey(user.key, start_utc), resource=user.key,
+        attendee=Attendee(email='parent@example.org', first_name='Pat', last_name='Parent'))
+    booking.start_time = start_utc
+    booking.end_time = start_utc + timedelta(minutes=20)
+    booking.timezone = 'UTC'
+    return booking
+
+def measure(fn, count):
+    _rpcs[0] = 0
+    t0 = time.time()
+    result = fn()
+    return (result, (time.time() - t0) * 1000 / count, float(_rpcs[0]) / count)
+
+def run(ancestor_keys):
+    Booking.ancestor_keys = ancestor_keys
+    # Every booking here is created under its teacher; nothing to migrate
+    Booking._roots_migrated = ancestor_keys
+    tb = setup()
+    try:
+        day = datetime(2016, 3, 21, 15, 0)
+        users = [ ]
+        for i in range(N_TEACHERS):
+            user = User(id='teacher%d' % i, email='teacher%d@example.org' % i,
+                first_name='Teacher', last_name=str(i))
+            user.prefs = user.defaultUserPrefs()
+            user.days = user.defaultDayPrefs()
+            users.append(user)
+        ndb.put_multi(users)
+        bookings = [make_booking(u, day + timedelta(minutes=30 * j))
+            for u in users for j in range(N_BOOKINGS)]
+        keys = ndb.put_multi(bookings)
+        # Apply every write, so only the last phase sees unapplied ones
+        ndb.get_multi(keys)
+
+        def check_slots():
+            taken = 0
+            for n in range(N_CHECKS):
+                user = users[n % N_TEACHERS]
+                start = day + timedelta(minutes=30 * (n % (2 * N_BOOKINGS)))
+                if ancestor_keys:
+                    found = Booking.newKey(user.key, start).get()
+                    taken += found is not None and found.canceled is None
+                else:
+                    qry = Booking.query(Booking.resource == user.key,
+                        Booking.start_time >= start - timedelta(minutes=30),
+                        Booking.start_time < start + timedelta(minutes=20))
+                    taken += any(b.end_time > start for b in qry if b.canceled is None)
+            return taken
+
+        def list_all():
+            return sum(len(Booking.getBookingsForResource(u)) for u in users)
+
+        def list_after_write():
+            fresh = [make_booking(u, day - timedelta(days=1)) for u in users]
+            ndb.put_multi(fresh)
+            missing = 0
+            for u, b in zip(users, fresh):
+                if b.key not in [x.key for x in Booking.getBookingsForResource(u)]:
+                    missing += 1
+            return missing
+
+        taken, check_ms, check_rpcs = measure(check_slots, N_CHECKS)
+        listed, list_ms, list_rpcs = measure(list_all, N_TEACHERS)
+        missing = list_after_write()
+        print('%-8s slot check %6.2f ms %4.1f RPCs (%d of %d taken) | listing %6.2f ms %4.1f RPCs '
+            '(%d bookings) | %d of %d new bookings missing' % (
+            'ancestor' if ancestor_keys else 'root', check_ms, check_rpcs, taken, N_CHECKS,
+            list_ms, list_rpcs, listed, missing, N_TEACHERS))
+    finally:
+        tb.deactivate()
+
+def main():
+    run(False)
+    run(True)
+
+
+if __name__ == '__main__':
+    main()
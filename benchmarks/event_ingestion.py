@@ -0,0 +1,110 @@
+"""
+Compare the CPU time and retained memory of busy-event ingestion per 1000
+Calendar events: the old path (full event resources, `dateutil` parsing,
+event dicts kept with datetimes added) against the current one (partial
+response, `rfc3339` parsing, (start_epoch, end_epoch) tuples).
+
+Run from the top level folder, with the packages in requirements.txt
+installed:
+
+    python benchmarks/event_ingestion.py
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import sys
+import timeit
+
+from dateutil import parser as date_parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import rfc3339
+
+
+N_EVENTS = 1000
+REPEAT = 5
+
+
+def make_event(i, dt_start):
+    dt_end = dt_start + timedelta(minutes=45)
+    return {
+        'kind': 'calendar#event',
+        'etag': '"28%014d"' % i,
+        'id': 'evt%024d' % i,
+        'status': 'confirmed',
+        'htmlLink': 'https://www.google.com/calendar/event?eid=ZXZ0%024d' % i,
+        'created': '2015-09-01T17:03:12.000Z',
+        'updated': '2015-09-02T08:41:55.301Z',
+        'summary': 'Staff meeting %d' % i,
+        'description': 'Agenda: curriculum night, conferences, field trip forms.',
+        'location': 'Room %d' % (100 + i % 40),
+        'creator': { 'email': 'teacher@example.org', 'self': True },
+        'organizer': { 'email': 'teacher@example.org', 'self': True },
+        'start': { 'dateTime': dt_start.strftime('%Y-%m-%dT%H:%M:%S-07:00') },
+        'end': { 'dateTime': dt_end.strftime('%Y-%m-%dT%H:%M:%S-07:00') },
+        'iCalUID': 'evt%024d@google.com' % i,
+        'sequence': 0,
+        'attendees': [
+            { 'email': 'teacher@example.org', 'responseStatus': 'accepted', 'self': True },
+            { 'email': 'principal@example.org', 'responseStatus': 'needsAction' },
+        ],
+        'reminders': { 'useDefault': True },
+    }
+
+def make_pages():
+    dt = datetime(2015, 10, 19, 7, 0)
+    events = [make_event(i, dt + timedelta(hours=i)) for i in range(N_EVENTS)]
+    full = json.dumps({ 'items': events })
+    partial = json.dumps({ 'items': [ dict((k, e[k]) for k in ('start', 'end')) for e in events ] })
+    return (full, partial)
+
+def ingest_old(page):
+    busy_events = [ ]
+    for e in json.loads(page)['items']:
+        if e.get('transparency') != 'transparent':
+            dt_start = date_parser.parse(e['start']['dateTime'])
+            dt_end = date_parser.parse(e['end']['dateTime'])
+            e.update({ 'dt_start': dt_start, 'dt_end': dt_end })
+            busy_events.append(e)
+    return busy_events
+
+def ingest_new(page):
+    busy_events = [ ]
+    for e in json.loads(page)['items']:
+        if e.get('transparency') != 'transparent':
+            busy_events.append((rfc3339.parse_datetime(e['start']['dateTime']),
+                rfc3339.parse_datetime(e['end']['dateTime'])))
+    return busy_events
+
+def deep_size(obj, seen=None):
+    """
+    Bytes retained by `obj` and everything it references (shared objects
+    are counted once).
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, 'tzinfo') and obj.tzinfo is not None:
+        size += deep_size(obj.tzinfo, seen)
+    return size
+
+def main():
+    full, partial = make_pages()
+    print('%d events; response body %d bytes full, %d bytes with fields=' % 
+        (N_EVENTS, len(full), len(partial)))
+    for name, fn, page in [('old', ingest_old, full), ('new', ingest_new, partial)]:
+        seconds = min(timeit.repeat(lambda: fn(page), number=1, repeat=REPEAT))
+        retained = deep_size(fn(page))
+        print('%-4s %8.1f ms CPU  %9d bytes retained' % (name, seconds * 1000, retained))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Memory held by the slots and busy times of the admin matrix use case:
+N_TEACHERS teachers over a N_DAYS-day window, comparing the old forms
+(`{'start', 'end', 'available'}` dicts, and Calendar event resources
+kept with `dt_start`/`dt_end` added) against `slots.Slot` and
+`slots.BusyInterval`.
+
+Run from the top level folder, with the packages in requirements.txt
+installed:
+
+    python benchmarks/slot_memory.py
+"""
+
+from datetime import date, datetime, time as dt_time, timedelta
+import os
+import sys
+
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from event_ingestion import deep_size, make_event
+from slots import BusyInterval, SlotGrid, to_epoch
+
+
+N_TEACHERS = 80
+N_DAYS = 35
+INTERVAL = 20
+# Calendar events per teacher per school day
+EVENTS_PER_DAY = 3
+
+TZ = pytz.timezone('America/Los_Angeles')
+
+
+def make_grid(d_from):
+    grid = SlotGrid(TZ, INTERVAL)
+    for n in range(N_DAYS):
+        d = d_from + timedelta(days=n)
+        if d.weekday() < 5:
+            grid.addDay(d, dt_time(13, 0), dt_time(19, 0), dt_time(15, 0), dt_time(15, 20))
+    return grid
+
+def make_events(d_from):
+    events = [ ]
+    for n in range(N_DAYS):
+        d = d_from + timedelta(days=n)
+        if d.weekday() < 5:
+            for k in range(EVENTS_PER_DAY):
+                events.append(make_event(len(events), datetime.combine(d, dt_time(8 + 3 * k))))
+    return events
+
+def slot_size(slots):
+    """
+    `deep_size` for a list of Slots, which it doesn't know about.
+    """
+    seen = set()
+    size = sys.getsizeof(slots)
+    for s in slots:
+        size += sys.getsizeof(s) + sum(deep_size(getattr(s, name), seen) for name in s.__slots__)
+    return size
+
+def main():
+    d_from = date(2015, 10, 19)
+    old_slots = new_slots = old_busy = new_busy = 0
+    count_slots = count_busy = 0
+    for i in range(N_TEACHERS):
+        slots = make_grid(d_from).toSlots()
+        count_slots += len(slots)
+        new_slots += slot_size(slots)
+        old_slots += deep_size([{ 'start': s.start, 'end': s.end, 'available': s.available } 
+            for s in slots])
+
+        events = make_events(d_from)
+        count_busy += len(events)
+        for e in events:
+            e['dt_start'] = TZ.localize(datetime.strptime(e['start']['dateTime'][:19], '%Y-%m-%dT%H:%M:%S'))
+            e['dt_end'] = TZ.localize(datetime.strptime(e['end']['dateTime'][:19], '%Y-%m-%dT%H:%M:%S'))
+        old_busy += deep_size(events)
+        new_busy += deep_size([BusyInterval(to_epoch(e['dt_start']), to_epoch(e['dt_end'])) 
+            for e in events])
+
+    print('%d teachers, %d days: %d slots, %d busy times' % (N_TEACHERS, N_DAYS, count_slots, count_busy))
+    print('slots  %10d bytes as dicts  %10d bytes as Slot          (%.1f MB less)' % (
+        old_slots, new_slots, (old_slots - new_slots) / 1e6))
+    print('busy   %10d bytes as events %10d bytes as BusyInterval  (%.1f MB less)' % (
+        old_busy, new_busy, (old_busy - new_busy) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
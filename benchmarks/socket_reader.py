@@ -0,0 +1,105 @@
+"""
+Read throughput of the socket file object used on the development server
+(stdlib/patched_socket.py: recv_into a bytearray) against the standard
+library's `socket._fileobject` (recv strings copied through StringIO),
+over a local socket pair.
+
+Each case sends PAYLOAD_MB of data and reads it back the way httplib does:
+
+* `read(size)` of 1 MB bodies on an unbuffered file (httplib's default),
+* `readline()` of header-sized lines: unbuffered, one byte per recv()
+  as httplib reads response headers (HEADERS_KB of them), and buffered,
+* a chunked body (`readline()` for each chunk size, then `read(size)`),
+* `read()` to EOF.
+
+The stock `readline()` copies everything left in its buffer after each
+line, so the gap grows with the buffer size.  Run from the top level
+folder with Python 2.7:
+
+    python benchmarks/socket_reader.py
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'stdlib'))
+import patched_socket
+
+
+PAYLOAD_MB = 16
+BODY_SIZE = 1024 * 1024
+CHUNK_SIZE = 4096
+LINE = 'X-Header: %s\r\n' % ('v' * 60)
+HEADERS_KB = 512
+REPEAT = 3
+
+
+def send_all(sock, data):
+    sock.sendall(data)
+    sock.close()
+
+def timed(fileobject_class, data, bufsize, consume):
+    a, b = socket.socketpair()
+    writer = threading.Thread(target=send_all, args=(a, data))
+    writer.start()
+    f = fileobject_class(b, 'rb', bufsize)
+    t0 = time.time()
+    received = consume(f)
+    seconds = time.time() - t0
+    writer.join()
+    b.close()
+    assert received == len(data), (received, len(data))
+    return seconds
+
+def read_bodies(f):
+    total = 0
+    while True:
+        n = len(f.read(BODY_SIZE))
+        if not n:
+            return total
+        total += n
+
+def read_lines(f):
+    return sum(len(line) for line in iter(f.readline, ''))
+
+def read_chunked(f):
+    total = 0
+    while True:
+        line = f.readline()
+        total += len(line)
+        size = int(line, 16)
+        if not size:
+            return total + len(f.readline())
+        total += len(f.read(size)) + len(f.read(2))
+
+def read_all(f):
+    return len(f.read())
+
+def main():
+    size = PAYLOAD_MB * 1024 * 1024
+    body = ('{"start": {"dateTime": "2015-10-19T08:00:00-07:00"}}, ' * (size // 54 + 1))[:size]
+    lines = LINE * (size // len(LINE))
+    headers = LINE * (HEADERS_KB * 1024 // len(LINE))
+    chunked = ''.join('%x\r\n%s\r\n' % (CHUNK_SIZE, body[i:i + CHUNK_SIZE])
+        for i in range(0, size, CHUNK_SIZE)) + '0\r\n\r\n'
+    print('%d MB per case, best of %d' % (PAYLOAD_MB, REPEAT))
+    for name, data, bufsize, consume in [
+            ('read(1 MB), unbuffered', body, 0, read_bodies),
+            ('readline(), unbuffered', headers, 0, read_lines),
+            ('readline(), 8 KB buffer', lines, 8192, read_lines),
+            ('readline(), 64 KB buffer', lines, 65536, read_lines),
+            ('chunked, 8 KB buffer', chunked, 8192, read_chunked),
+            ('chunked, 64 KB buffer', chunked, 65536, read_chunked),
+            ('read() to EOF', body, -1, read_all) ]:
+        results = [ ]
+        for label, cls in [('stdlib', socket._fileobject), ('patched', patched_socket._fileobject)]:
+            seconds = min(timed(cls, data, bufsize, consume) for i in range(REPEAT))
+            results.append('%s %7.1f MB/s' % (label, len(data) / seconds / 1e6))
+        print('%-26s %s' % (name, '   '.join(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Cancelling many bookings at once: a teacher's sick day, or a whole
+conference session.
+
+1. `cancelBookings` marks the bookings canceled right away, in a few
+   datastore transactions (see `Booking.cancelMulti`).
+2. Task queue tasks then delete the linked Google Calendar events, one
+   batch HTTP request of up to 50 deletes per teacher, and
+3. email each family once about all of its canceled conferences in
+   that task's batch.
+"""
+
+from collections import OrderedDict
+import logging
+
+from flask import current_app, render_template, url_for
+from google.appengine.api import mail, taskqueue
+from google.appengine.ext import ndb
+
+import availability
+import gapi
+from models import Booking
+
+
+# Bookings per follow-up task, so each task stays small and quick
+TASK_SIZE = 100
+
+
+def cancelBookings(bookings, reason=None):
+    """
+    Cancel `bookings` and queue the Calendar deletes and the emails.
+    Returns the bookings that weren't already canceled.
+    """
+    canceled = Booking.cancelMulti(bookings)
+    # The freed slots can be booked again right away
+    availability.invalidateMulti(set(b.resource.id() for b in canceled))
+    keys = [b.key.urlsafe() for b in canceled]
+    for start in range(0, len(keys), TASK_SIZE):
+        chunk = ','.join(keys[start:start + TASK_SIZE])
+        taskqueue.add(url=url_for('delete_calendar_events_task'), params={ 'keys': chunk })
+        taskqueue.add(url=url_for('notify_cancellations_task'), 
+            params={ 'keys': chunk, 'reason': reason or '' })
+    return canceled
+
+def _getBookings(urlsafe_keys):
+    keys = [ndb.Key(urlsafe=k) for k in urlsafe_keys.split(',') if k]
+    return [b for b in ndb.get_multi(keys) if b is not None]
+
+def deleteCalendarEvents(urlsafe_keys):
+    """
+    Delete the Calendar events of canceled bookings, batched per teacher.
+    Events that are already gone count as deleted.  Raises if any delete
+    failed, so the task is retried (the retry skips bookings already done).
+    """
+    by_resource = OrderedDict()
+    for b in _getBookings(urlsafe_keys):
+        if b.canceled is not None and b.event is not None and b.event.event_id:
+            by_resource.setdefault(b.resource, [ ]).append(b)
+
+    failed = 0
+    for resource_key, bookings in by_resource.items():
+        resource = resource_key.get()
+        if resource is None:
+            continue
+        cal_service = gapi.buildService('calendar', 'v3', resource.authorizedHttp())
+        requests = [cal_service.events().delete(calendarId=b.event.calendar_id or 'primary',
+            eventId=b.event.event_id, sendNotifications=False) for b in bookings]
+        done = [ ]
+        results = gapi.executeBatch(cal_service, requests, resource_key.id())
+        for b, (response, exception) in zip(bookings, results):
+            status = getattr(getattr(exception, 'resp', None), 'status', None)
+            if exception is None or status in (404, 410):
+                b.event.event_id = None
+                done.append(b)
+            else:
+                failed += 1
+                logging.warning('CANCEL: could not delete event for booking %s: %s' % 
+                    (b.key.urlsafe(), exception))
+        ndb.put_multi(done)
+    if failed:
+        raise Exception('%d Calendar events could not be deleted' % failed)
+
+def notifyAttendees(urlsafe_keys, reason=None):
+    """
+    Send each family one message listing all of its canceled conferences.
+    """
+    config = current_app.config
+    by_email = OrderedDict()
+    for b in _getBookings(urlsafe_keys):
+        if b.canceled is not None and b.attendee and b.attendee.email:
+            by_email.setdefault(b.attendee.email.lower(), [ ]).append(b)
+
+    for email, bookings in by_email.items():
+        body = render_template('cancel-message.txt', config=config, 
+            email=email, bookings=bookings, reason=reason)
+        mail.EmailMessage(
+            sender=config['SUPPORT_EMAIL'],
+            subject='Conference canceled',
+            to=email,
+            body=body).send()
+    logging.info('CANCEL: notified %d families' % len(by_email))
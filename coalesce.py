@@ -0,0 +1,103 @@
+"""
+Request coalescing for expensive, idempotent fetches.
+
+When several requests ask for the same thing at the same moment, only one
+of them does the work:
+
+* Within an instance, the first caller for a key runs the fetch and the
+  other threads wait on it and share its result (or its exception).
+* Across instances, that caller first takes a memcache lease.  The lease
+  holder publishes its result in memcache for `result_ttl` seconds, and
+  callers on other instances poll for it for up to `wait` seconds before
+  giving up and fetching for themselves.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer(object):
+
+    def __init__(self, namespace, enabled=True, result_ttl=5, lease_ttl=30, wait=10, poll=0.05):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.result_ttl = result_ttl
+        self.lease_ttl = lease_ttl
+        self.wait = wait
+        self.poll = poll
+        self._flights = { }
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError('Unknown coalescer setting %s' % name)
+            setattr(self, name, value)
+
+    def _cacheKey(self, key):
+        return '%s:%s' % (self.namespace, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def call(self, key, fn):
+        """
+        Return `fn()`, sharing the call with any concurrent caller for `key`.
+        """
+        if not self.enabled:
+            return fn()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._callShared(key, fn)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _callShared(self, key, fn):
+        cache_key = self._cacheKey(key)
+        lease_key = cache_key + ':lease'
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return cached[0]
+
+        if not memcache.add(lease_key, 1, time=self.lease_ttl):
+            deadline = time.time() + self.wait
+            while time.time() < deadline:
+                time.sleep(self.poll)
+                cached = memcache.get(cache_key)
+                if cached is not None:
+                    return cached[0]
+            logging.info('COALESCE: gave up waiting for %s' % key)
+            return fn()
+
+        try:
+            result = fn()
+            memcache.set(cache_key, (result,), time=self.result_ttl)
+        finally:
+            memcache.delete(lease_key)
+        return result
@@ -19,3 +19,54 @@ secret_key = 'a-very-long-random-key-used-to-hash-csrf-tokens'
 friendly_name = 'KSD Conference System'
 support_email = 'webmaster@kentfieldschools.org'
 reminders_expire = 60
+
+# Concurrent requests for the same teacher's busy times share one Calendar
+# API call. Results are shared across instances for busy_coalesce_result_ttl
+# seconds; other instances wait up to busy_coalesce_wait seconds for them.
+busy_coalesce_enabled = True
+busy_coalesce_result_ttl = 5
+busy_coalesce_wait = 10
+
+# Public calendar pages show cached availability. After availability_soft_ttl
+# seconds it is refreshed in the background; after availability_hard_ttl
+# seconds it is recomputed before the page is shown. Bookings always check
+# against live data.
+availability_soft_ttl = 15
+availability_hard_ttl = 120
+
+# After a calendar week is shown, compute the weeks before and after it in
+# the background, so "< Prev" and "Next >" are served from the cache. The
+# /admin page shows how many prefetched weeks were actually viewed.
+availability_prefetch = True
+
+# Ask Google Calendar to notify us when a teacher's calendar changes, so
+# cached availability is dropped right away. Needs a verified https domain.
+calendar_watch_enabled = False
+
+# Google API calls per second allowed for one teacher and for the whole app,
+# the most seconds one call may spend waiting for or retrying the API, and
+# the most seconds all the calls made for one page may spend (App Engine
+# stops a request after 60 seconds; task queue requests get 10 minutes)
+api_rate_per_user = 5
+api_rate_global = 50
+api_deadline = 20
+api_request_deadline = 45
+
+# Seconds calendar clients may reuse a subscription feed before asking again
+# (they revalidate with If-None-Match, which is cheap for us either way)
+feed_max_age = 300
+
+# Cloud Storage bucket for large booking exports, which are written there
+# and emailed as a link. Defaults to the app's default bucket. Set a
+# lifecycle rule on the bucket to delete old files under exports/.
+# export_bucket = 'gafe-conferences.appspot.com'
+
+# Store each booking under its teacher, keyed by its start time, so slot and
+# per-teacher lookups are strongly consistent. After turning this on, press
+# "Move older bookings under their teachers" on the /admin page once.
+ancestor_bookings = False
+
+# Link scripts and styles one file at a time instead of the minified
+# bundles. Defaults to True on the development server; with it False, run
+# "python assets.py" first (see assets.py).
+# assets_debug = False
@@ -0,0 +1,99 @@
+"""
+Exact, sharded counters kept in the datastore.
+
+Each counter is split over SHARDS entities so that concurrent bookings
+rarely write the same entity group.  `increment` is meant to be called
+inside the transaction that creates or cancels the thing being counted,
+so the count can't drift from the data; memcache holds the summed totals
+and is adjusted only after the transaction commits.
+
+Reading a counter sums its shards with one `get_multi`, unless the total
+is already in memcache.
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+SHARDS = 10
+
+PREFIX = 'counter:'
+
+# Cached totals are re-read from the shards this often, in case a
+# memcache update was lost
+CACHE_SECONDS = 300
+
+
+# One shard of a counter, keyed by '<name>#<shard number>'
+class CounterShard(ndb.Model):
+    # The summed totals are cached instead (see getCounts)
+    _use_memcache = False
+
+    name = ndb.StringProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shardKeys(name):
+    return [ndb.Key(CounterShard, '%s#%d' % (name, i)) for i in range(SHARDS)]
+
+def increment(names, delta=1):
+    """
+    Add `delta` to each counter in `names`, one random shard apiece.
+    Call this inside a (cross-group) transaction.
+    """
+    incrementMulti(dict((name, delta) for name in names))
+
+def incrementMulti(offsets):
+    """
+    Add `offsets[name]` to each counter `name`, as `increment` does.
+    """
+    names = [name for name, delta in offsets.items() if delta]
+    if not names:
+        return
+    keys = [ndb.Key(CounterShard, '%s#%d' % (name, random.randint(0, SHARDS - 1))) 
+        for name in names]
+    shards = ndb.get_multi(keys)
+    for i, name in enumerate(names):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=keys[i], name=name)
+        shards[i].count += offsets[name]
+    ndb.put_multi(shards)
+
+    offsets = dict((name, offsets[name]) for name in names)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(
+            lambda: memcache.offset_multi(offsets, key_prefix=PREFIX))
+    else:
+        memcache.offset_multi(offsets, key_prefix=PREFIX)
+
+def getCounts(names):
+    """
+    A dict of the current total for each counter in `names`.
+    """
+    counts = memcache.get_multi(names, key_prefix=PREFIX)
+    missing = [name for name in names if name not in counts]
+    if missing:
+        keys = [ ]
+        for name in missing:
+            keys.extend(_shardKeys(name))
+        shards = ndb.get_multi(keys)
+        totals = { }
+        for i, name in enumerate(missing):
+            totals[name] = sum(s.count for s in shards[i * SHARDS:(i + 1) * SHARDS] if s)
+        memcache.add_multi(totals, key_prefix=PREFIX, time=CACHE_SECONDS)
+        counts.update(totals)
+    return counts
+
+def reset(totals):
+    """
+    Replace every counter with the counts in `totals`.  Increments made
+    while this runs may be lost, so only use it for a one-off recount.
+    """
+    old_keys = CounterShard.query().fetch(keys_only=True)
+    ndb.delete_multi(old_keys)
+    ndb.put_multi([CounterShard(id='%s#0' % name, name=name, count=count) 
+        for name, count in totals.items()])
+    memcache.delete_multi(list(set(k.id().rsplit('#', 1)[0] for k in old_keys) | set(totals)),
+        key_prefix=PREFIX)
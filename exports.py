@@ -0,0 +1,158 @@
+"""
+Bulk exports of Booking entities as CSV or iCalendar.
+
+Bookings are read a page at a time with query cursors and written out by
+generators, so only one page of entities is held at a time.  Exports with
+more than INLINE_LIMIT bookings are built by a task and written to Cloud
+Storage a chunk at a time, and the administrator is mailed a link to them.
+"""
+
+from datetime import datetime
+import csv
+import pytz
+import six
+import uuid
+
+import cloudstorage as gcs
+from google.appengine.ext import ndb
+
+import ical
+from models import Booking
+
+
+PAGE_SIZE = 200
+INLINE_LIMIT = 5000
+
+CSV_COLUMNS = ['booking_id', 'teacher', 'teacher_email', 'title', 'date', 'start_time', 'end_time',
+    'timezone', 'first_name', 'last_name', 'email', 'phone', 'notes', 'location',
+    'event_id', 'created', 'canceled']
+
+CANCELED_CHOICES = ('exclude', 'include', 'only')
+
+MIMETYPES = { 'csv': 'text/csv', 'ics': 'text/calendar' }
+
+# Saved exports are read back this many bytes at a time
+READ_SIZE = 1024 * 1024
+
+
+def queryBookings(resource_key=None, dt_from=None, dt_to=None):
+    """
+    Bookings for one resource (or all), with start times (naive UTC) in
+    [dt_from, dt_to), ordered by start time.
+    """
+    qry = Booking.query()
+    if resource_key is not None:
+        qry = qry.filter(Booking.resource == resource_key)
+    if dt_from is not None:
+        qry = qry.filter(Booking.start_time >= dt_from)
+    if dt_to is not None:
+        qry = qry.filter(Booking.start_time < dt_to)
+    return qry.order(Booking.start_time)
+
+def iterPages(qry, canceled='exclude', page_size=PAGE_SIZE):
+    """
+    Yield lists of bookings, one query page at a time.
+    """
+    cursor = None
+    while True:
+        bookings, cursor, more = qry.fetch_page(page_size, start_cursor=cursor)
+        if canceled == 'exclude':
+            bookings = [b for b in bookings if b.canceled is None]
+        elif canceled == 'only':
+            bookings = [b for b in bookings if b.canceled is not None]
+        if bookings:
+            yield bookings
+        if not more or cursor is None:
+            break
+
+def _resourcesFor(bookings, resources):
+    """
+    Load the teachers for a page of bookings, remembering ones already seen.
+    """
+    missing = list(set(b.resource for b in bookings if b.resource not in resources))
+    if missing:
+        for key, user in zip(missing, ndb.get_multi(missing)):
+            resources[key] = user
+    return resources
+
+def _utf8(value):
+    if value is None:
+        return ''
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return str(value)
+
+def csvChunks(qry, canceled='exclude'):
+    buf = six.BytesIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    resources = { }
+    for bookings in iterPages(qry, canceled):
+        _resourcesFor(bookings, resources)
+        for b in bookings:
+            user = resources.get(b.resource)
+            tz = pytz.timezone(b.timezone or 'UTC')
+            start = pytz.utc.localize(b.start_time).astimezone(tz)
+            end = pytz.utc.localize(b.end_time).astimezone(tz)
+            attendee = b.attendee
+            writer.writerow([_utf8(v) for v in [
+                b.key.urlsafe(),
+                b.organizer_name,
+                user.email if user else '',
+                b.title,
+                start.strftime('%Y-%m-%d'),
+                start.strftime('%H:%M'),
+                end.strftime('%H:%M'),
+                b.timezone,
+                attendee.first_name,
+                attendee.last_name,
+                attendee.email,
+                attendee.phone,
+                attendee.notes,
+                b.event.location if b.event else '',
+                b.event.event_id if b.event else '',
+                b.created.strftime('%Y-%m-%d %H:%M:%S') if b.created else '',
+                b.canceled.strftime('%Y-%m-%d %H:%M:%S') if b.canceled else '' ]])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def icsChunks(qry, name, domain, canceled='exclude'):
+    yield ical.calendarStart(name)
+    for bookings in iterPages(qry, canceled):
+        yield ''.join(ical.bookingEvent(b, domain) for b in bookings)
+    yield ical.calendarEnd()
+
+def _exportPath(bucket, filename):
+    return '/%s/exports/%s' % (bucket, filename)
+
+def saveExport(chunks, fmt, bucket):
+    """
+    Write the chunks of an export to Cloud Storage as they are generated.
+    Returns the new file's name, which is hard to guess.
+    """
+    filename = 'bookings-%s-%s.%s' % (datetime.utcnow().strftime('%Y%m%d-%H%M%S'),
+        uuid.uuid4().hex, fmt)
+    with gcs.open(_exportPath(bucket, filename), 'w', content_type=MIMETYPES[fmt]) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return filename
+
+def openExport(bucket, filename):
+    """
+    A saved export opened for reading, or None if there is no such file.
+    """
+    try:
+        return gcs.open(_exportPath(bucket, filename), read_buffer_size=READ_SIZE)
+    except gcs.NotFoundError:
+        return None
+
+def fileChunks(f):
+    with f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            yield data
@@ -0,0 +1,112 @@
+"""
+Cached iCalendar subscription feeds.
+
+Calendar clients poll a feed every few minutes, so a feed is only built
+from the datastore when its bookings have changed.  Each feed has a
+generation number in memcache that is bumped whenever one of its
+bookings is saved; the generation is the feed's ETag and part of the key
+under which the built feed is cached.  A poll with a current
+If-None-Match header costs one memcache get.
+
+A generation missing from memcache restarts at the current time rather
+than at zero, so an evicted counter can never bring back an old feed.
+
+Generations are bumped after the transaction that saved the bookings
+commits.  Even then the global queries feeds are built from may not show
+the change for a few seconds, so for SETTLE_SECONDS after a bump a feed
+has a different ETag and is cached only that long; the next poll after
+that gets a feed built from settled data.
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+# How long a built feed stays in memcache (it is rebuilt sooner on changes)
+FEED_TTL = 86400
+
+# How long after a change feeds may still be built from stale query results
+SETTLE_SECONDS = 30
+
+# Larger feeds are served but not cached
+MAX_CACHED_SIZE = 900000
+
+
+def _genKey(scope, ident):
+    return 'feed-gen:%s:%s' % (scope, ident)
+
+def _changedKey(scope, ident):
+    return 'feed-changed:%s:%s' % (scope, ident)
+
+def invalidate(scope, ident):
+    invalidateMulti([(scope, ident)])
+
+def invalidateMulti(feeds):
+    """
+    Bump the generations of `feeds`, (scope, ident) pairs, with one
+    memcache call for the generations and one for the settling marks.
+    """
+    feeds = set(feeds)
+    if feeds:
+        memcache.offset_multi(dict((_genKey(scope, ident), 1) for scope, ident in feeds),
+            initial_value=int(time.time()))
+        memcache.set_multi(dict((_changedKey(scope, ident), 1) for scope, ident in feeds),
+            time=SETTLE_SECONDS)
+
+def bookingFeeds(booking):
+    feeds = [ ]
+    if booking.resource is not None:
+        feeds.append(('resource', booking.resource.id()))
+    if booking.attendee is not None and booking.attendee.email:
+        feeds.append(('attendee', booking.attendee.email.lower()))
+    return feeds
+
+def invalidateBookings(bookings):
+    """
+    Bump the teachers' and the families' feeds for changed bookings.
+    Inside a transaction this waits for the commit, and every booking
+    saved in the transaction is bumped together.
+    """
+    feeds = [feed for booking in bookings for feed in bookingFeeds(booking)]
+    if not ndb.in_transaction():
+        invalidateMulti(feeds)
+        return
+    ctx = ndb.get_context()
+    pending = getattr(ctx, '_changed_feeds', None)
+    if pending is None:
+        pending = ctx._changed_feeds = set()
+        ctx.call_on_commit(lambda: invalidateMulti(pending))
+    pending.update(feeds)
+
+def etag(scope, ident):
+    """
+    (ETag, seconds to cache the feed) for a feed's current generation.
+    """
+    gen_key = _genKey(scope, ident)
+    changed_key = _changedKey(scope, ident)
+    values = memcache.get_multi([gen_key, changed_key])
+    gen = values.get(gen_key)
+    if gen is None:
+        gen = int(time.time())
+        if not memcache.add(gen_key, gen):
+            gen = memcache.get(gen_key) or gen
+    # A feed built while the change settles must not keep the final ETag
+    settling = changed_key in values
+    version = u'%s:%s:%d%s' % (scope, ident, gen, ':settling' if settling else '')
+    tag = hashlib.md5(version.encode('utf-8')).hexdigest()
+    return (tag, SETTLE_SECONDS if settling else FEED_TTL)
+
+def getFeed(tag, build, ttl=FEED_TTL):
+    """
+    The feed body for ETag `tag`, from the cache or else from `build()`.
+    """
+    key = 'feed:%s' % tag
+    body = memcache.get(key)
+    if body is None:
+        body = build()
+        if len(body) <= MAX_CACHED_SIZE:
+            memcache.set(key, body, time=ttl)
+    return body
@@ -4,12 +4,14 @@ import re
 import six
 
 from flask_wtf import Form
-from wtforms import BooleanField, HiddenField, IntegerField, SelectField, StringField, TextAreaField
+from flask_wtf.file import FileField, FileRequired
+from wtforms import (BooleanField, HiddenField, IntegerField, SelectField, SelectMultipleField, 
+    StringField, TextAreaField)
 from wtforms.fields.html5 import DateField, DateTimeField
 from wtforms.compat import iteritems
 from wtforms.fields import Field
 from wtforms.validators import Email, Optional, Required, ValidationError
-from wtforms.widgets import TextInput
+from wtforms.widgets import CheckboxInput, ListWidget, TextInput
  
 DATEUTIL_TYPEERROR_ISSUE = False
 
@@ -107,6 +109,23 @@ class StringTimeField(Field):
                 raise ValidationError(self.gettext('Not a valid time type'))
 
 
+class StringListField(TextAreaField):
+    """
+    A list of strings edited as a textarea, one string per line.
+    Blank lines and surrounding whitespace are dropped.
+    """
+
+    def _value(self):
+        if self.raw_data:
+            return self.raw_data[0]
+        return '\n'.join(self.data or [ ])
+
+    def process_formdata(self, valuelist):
+        self.data = [ ]
+        if valuelist:
+            self.data = [line.strip() for line in valuelist[0].splitlines() if line.strip()]
+
+
 # dt_next_week.date()
 class UserPrefsForm(Form):
     title = StringField(id='title', label='Title')
@@ -138,6 +157,8 @@ class UserPrefsForm(Form):
     weekday_start = SelectField(id='weekday_start', 
         label='Starting day of week for booking calendar', 
         coerce=int, choices=[(1, 'Monday'), (0,'Sunday')])
+    busy_calendar_ids = StringListField(id='busy_calendar_ids',
+        label='Other calendars that block conference times')
 
     def validate(self):
         valid = super(UserPrefsForm, self).validate()
@@ -290,6 +311,110 @@ class DayPrefsForm(Form):
                         valid = False
         return valid
 
+class BulkScheduleForm(DayPrefsForm):
+    """
+    A school-wide schedule template for the admin pages.  Settings left
+    blank are not changed; the weekly times are only pushed when
+    `apply_days` is checked.
+    """
+    uids = SelectMultipleField(id='uids', label='Teachers', 
+        widget=ListWidget(prefix_label=False), option_widget=CheckboxInput())
+    interval = IntegerField(id='interval', label='Interval', validators=(Optional(),))
+    duration = IntegerField(id='duration', label='Duration', validators=(Optional(),))
+    first_day_scheduled = DateField(id='first_day_scheduled', label='First day for conferences',
+        validators=(Optional(),))
+    last_day_scheduled = DateField(id='last_day_scheduled', label='Last day for conferences',
+        validators=(Optional(),))
+    booking_start_date = DateField(id='booking_start_date', 
+        label='Start date for booking access',
+        validators=(Optional(),))
+    booking_start_time = StringTimeField(id='booking_start_time', 
+        label='Start time for booking access', 
+        validators=(Optional(),))
+    booking_end_date = DateField(id='booking_end_date', 
+        label='End date for booking access',
+        validators=(Optional(),))
+    booking_end_time = StringTimeField(id='booking_end_time', 
+        label='End time for booking access',
+        validators=(Optional(),))
+    minimum_notice_hours = IntegerField(id='minimum_notice_hours',
+        label='Minimum booking notice period', validators=(Optional(),))
+    apply_days = BooleanField(id='apply_days', label='Replace the weekly times')
+
+    PREFS_FIELDS = ['interval', 'duration', 'first_day_scheduled', 'last_day_scheduled',
+        'booking_start_date', 'booking_start_time', 'booking_end_date', 'booking_end_time',
+        'minimum_notice_hours']
+
+    def validate(self):
+        valid = super(BulkScheduleForm, self).validate()
+        if not self.apply_days.data:
+            # The weekly times aren't being used, so their errors don't count
+            for name, field in iteritems(self._fields):
+                if re.search(r'_[0-6]$', name):
+                    field.errors = [ ]
+            valid = not any(field.errors for field in self)
+        if not self.uids.data:
+            self.uids.errors.append('Choose at least one teacher')
+            valid = False
+        if self.interval.data and self.duration.data and self.duration.data > self.interval.data:
+            self.duration.errors.append('Can not exceed interval')
+            valid = False
+        if self.first_day_scheduled.data and self.last_day_scheduled.data and self.last_day_scheduled.data < self.first_day_scheduled.data:
+            self.last_day_scheduled.errors.append('Can not preceed first day for conferences')
+            valid = False
+        if self.booking_start_time.data and not self.booking_start_date.data:
+            self.booking_start_date.errors.append('Required if booking access start time was specified')
+            valid = False
+        if self.booking_end_time.data and not self.booking_end_date.data:
+            self.booking_end_date.errors.append('Required if booking access end time was specified')
+            valid = False
+        return valid
+
+    def populate_obj(self, obj):
+        """
+        Copy the filled-in settings (and the weekly times, if asked) to a User.
+        """
+        for name in self.PREFS_FIELDS:
+            field = self[name]
+            if field.data is not None and field.data != '':
+                field.populate_obj(obj.prefs, name)
+        if obj.prefs.duration > obj.prefs.interval:
+            obj.prefs.duration = obj.prefs.interval
+        if self.apply_days.data:
+            super(BulkScheduleForm, self).populate_obj(obj)
+
+class ActionForm(Form):
+    """
+    Just a CSRF token, for the admin buttons that start a task.
+    """
+
+class CancelBookingsForm(Form):
+    """
+    Cancel every booking for one teacher, or for everybody (`uid` blank),
+    between two dates.  Choices for `uid` are set by the view.
+    """
+    uid = SelectField(id='uid', label='Teacher')
+    date_from = DateField(id='date_from', label='From date', validators=(Required(),))
+    date_to = DateField(id='date_to', label='To date', validators=(Required(),))
+    reason = TextAreaField(id='reason', label='Message for families', validators=(Optional(),))
+    confirm = BooleanField(id='confirm', label='Yes, cancel these bookings',
+        validators=(Required('Please check the box to confirm the cancellation'),))
+
+    def validate(self):
+        valid = super(CancelBookingsForm, self).validate()
+        if self.date_from.data and self.date_to.data and self.date_to.data < self.date_from.data:
+            self.date_to.errors.append('Can not precede the from date')
+            valid = False
+        return valid
+
+class ImportBookingsForm(Form):
+    file = FileField(id='file', label='CSV file',
+        validators=(FileRequired('Please choose a CSV file to import'),))
+
+class CancelDayForm(Form):
+    date = DateField(id='cancel_date', label='Date', validators=(Required(),))
+    reason = TextAreaField(id='cancel_reason', label='Message for families', validators=(Optional(),))
+
 class BookingForm(Form):
     start_time = HiddenField()
     end_time = HiddenField()
@@ -0,0 +1,345 @@
+"""
+Helpers for talking to Google APIs.
+
+The Google API client (`apiclient`, `uritemplate` and friends) is slow to
+import, so it is only imported the first time a service is built.  Discovery
+documents are kept in instance memory and in memcache, so building a service
+does not fetch or re-download them on every request.
+"""
+
+from datetime import datetime
+import httplib
+import httplib2
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
+import flask
+from google.appengine.api import memcache
+from oauth2client.client import Storage
+
+import metrics
+
+
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+
+# The APIs the application uses, preloaded by the warmup handler
+APIS = [('calendar', 'v3'), ('plus', 'v1')]
+
+# How long one instance may hold the right to refresh a user's token
+TOKEN_LEASE_SECONDS = 15
+TOKEN_POLL_SECONDS = 0.1
+
+_discovery_docs = { }
+
+
+def getDiscoveryDocument(name, version):
+    doc = _discovery_docs.get((name, version))
+    if doc is None:
+        cache_key = 'discovery:%s:%s' % (name, version)
+        doc = memcache.get(cache_key)
+        if doc is None:
+            resp, doc = httplib2.Http().request(DISCOVERY_URI % (name, version))
+            if resp.status >= 400:
+                raise IOError('Could not fetch discovery document for %s %s: %s' %
+                    (name, version, resp.status))
+            memcache.set(cache_key, doc, time=86400)
+        _discovery_docs[(name, version)] = doc
+    return doc
+
+class LeasedStorage(Storage):
+    """
+    oauth2client `Storage` for credentials kept in their own ndb entity,
+    shared by every instance.
+
+    The current access token is cached in memcache, so an instance whose
+    stored token has expired can pick up one refreshed elsewhere.  Refreshes
+    are single-flight: oauth2client calls `acquire_lock` before refreshing,
+    and only the request holding the memcache lease goes to Google.  The
+    others wait for the lease to be released and then find the new token
+    in `locked_get`.
+    """
+    _locks = { }
+    _locks_lock = threading.Lock()
+
+    def __init__(self, model, key_name, property_name='credentials'):
+        self._model = model
+        self._key_name = key_name
+        self._property_name = property_name
+        self._token_key = 'token:%s' % key_name
+        self._lease_key = 'token-lease:%s' % key_name
+        self._leased = False
+        with self._locks_lock:
+            self._lock = self._locks.setdefault(key_name, threading.Lock())
+
+    def acquire_lock(self):
+        self._lock.acquire()
+        deadline = time.time() + TOKEN_LEASE_SECONDS
+        while not memcache.add(self._lease_key, 1, time=TOKEN_LEASE_SECONDS):
+            if time.time() >= deadline:
+                # Whoever held the lease is gone; go ahead without it
+                logging.warning('TOKEN: lease for %s timed out' % self._key_name)
+                return
+            time.sleep(TOKEN_POLL_SECONDS)
+        self._leased = True
+
+    def release_lock(self):
+        if self._leased:
+            memcache.delete(self._lease_key)
+            self._leased = False
+        self._lock.release()
+
+    # Plain reads and writes don't need the refresh lease
+    def get(self):
+        return self.locked_get()
+
+    def put(self, credentials):
+        self.locked_put(credentials)
+
+    def locked_get(self):
+        entity = self._model.get_by_id(self._key_name)
+        credentials = entity and getattr(entity, self._property_name)
+        if credentials is not None:
+            self.applyCachedToken(credentials)
+            credentials.set_store(self)
+        return credentials
+
+    def locked_put(self, credentials):
+        entity = self._model(id=self._key_name)
+        setattr(entity, self._property_name, credentials)
+        entity.put()
+        self.cacheToken(credentials)
+
+    def locked_delete(self):
+        ndb_key = self._model(id=self._key_name).key
+        ndb_key.delete()
+        memcache.delete(self._token_key)
+
+    def applyCachedToken(self, credentials):
+        cached = memcache.get(self._token_key)
+        if cached is not None:
+            access_token, token_expiry = cached
+            if credentials.token_expiry is None or token_expiry > credentials.token_expiry:
+                credentials.access_token = access_token
+                credentials.token_expiry = token_expiry
+
+    def cacheToken(self, credentials):
+        if credentials.access_token and credentials.token_expiry:
+            ttl = int((credentials.token_expiry - datetime.utcnow()).total_seconds()) - 60
+            if ttl > 0:
+                memcache.set(self._token_key,
+                    (credentials.access_token, credentials.token_expiry), time=ttl)
+
+
+def authorizedHttp(credentials):
+    store = getattr(credentials, 'store', None)
+    if isinstance(store, LeasedStorage):
+        store.applyCachedToken(credentials)
+    if credentials.access_token_expired:
+        # Refresh up front rather than after a 401
+        credentials.refresh(httplib2.Http())
+    http_auth = httplib2.Http(memcache)
+    credentials.authorize(http_auth)
+    return http_auth
+
+def buildService(name, version, http):
+    from apiclient import discovery
+    return discovery.build_from_document(getDiscoveryDocument(name, version), http=http)
+
+def preload():
+    """
+    Import the API client and load every discovery document we use.
+    """
+    from apiclient import discovery
+    for name, version in APIS:
+        try:
+            getDiscoveryDocument(name, version)
+        except Exception as e:
+            logging.warning('WARMUP: discovery %s %s failed: %s' % (name, version, e))
+
+
+# Errors worth retrying: rate limits and server-side trouble
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'backendError')
+
+
+def errorReason(e):
+    try:
+        return json.loads(e.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def isRetryable(e):
+    from apiclient.errors import HttpError
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        return status in RETRY_STATUSES or (status == 403 and errorReason(e) in RETRY_REASONS)
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+def isConflict(e):
+    from apiclient.errors import HttpError
+    return isinstance(e, HttpError) and e.resp.status == 409
+
+
+class CallScheduler(object):
+    """
+    Every Calendar and Google+ request is executed through here.
+
+    * Rate limits: at most `user_rate` calls per second per user and
+      `global_rate` calls per second for the whole app.  Each limit is a
+      memcache counter per one-second window, i.e. a token bucket that is
+      refilled once a second.  A caller over the limit sleeps until the
+      next window.
+    * Retries: rate limit errors, 5xx responses and socket errors are
+      retried with full-jitter exponential backoff.
+    * Deadline: no call waits or retries for longer than `deadline`
+      seconds in total, and no call made while handling a request waits
+      or retries past that request's budget (`request_deadline` seconds
+      from `startRequest`, or `task_deadline` for task queue requests),
+      however many calls the request makes.  The last error is raised
+      instead.
+
+    Throttles, retries and failures are counted in `metrics`.
+    """
+
+    def __init__(self, user_rate=5, global_rate=50, deadline=20, request_deadline=45,
+            task_deadline=540, base_delay=0.5, max_delay=8):
+        self.user_rate = user_rate
+        self.global_rate = global_rate
+        self.deadline = deadline
+        self.request_deadline = request_deadline
+        self.task_deadline = task_deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError('Unknown scheduler setting %s' % name)
+            setattr(self, name, value)
+
+    def startRequest(self):
+        """
+        Start the API time budget of the current request.  Installed as a
+        `before_request` function.
+        """
+        if flask.request.headers.get('X-AppEngine-QueueName'):
+            budget = self.task_deadline
+        else:
+            budget = self.request_deadline
+        flask.g.api_give_up_at = time.time() + budget
+
+    def _giveUpAt(self):
+        """
+        When a call starting now must stop waiting and retrying: after
+        `deadline` seconds, or when the request's budget runs out.
+        """
+        give_up_at = time.time() + self.deadline
+        if flask.has_app_context():
+            give_up_at = min(give_up_at, getattr(flask.g, 'api_give_up_at', give_up_at))
+        return give_up_at
+
+    def _takeToken(self, scope, rate, give_up_at, cost=1):
+        while rate:
+            now = time.time()
+            window = int(now)
+            key = 'rate:%s:%d' % (scope, window)
+            memcache.add(key, 0, time=5)
+            count = memcache.incr(key, delta=cost)
+            # A batch costing more than a whole window goes through alone
+            if count is None or count <= max(rate, cost):
+                return
+            metrics.incr('api.throttled')
+            wait = window + 1 - now
+            if now + wait > give_up_at:
+                return
+            time.sleep(wait)
+
+    def execute(self, request, user_id=None):
+        give_up_at = self._giveUpAt()
+        attempt = 0
+        while True:
+            if user_id is not None:
+                self._takeToken('user:%s' % user_id, self.user_rate, give_up_at)
+            self._takeToken('global', self.global_rate, give_up_at)
+            try:
+                result = request.execute()
+                metrics.incr('api.calls')
+                return result
+            except Exception as e:
+                if not isRetryable(e):
+                    metrics.incr('api.errors')
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if time.time() + delay > give_up_at:
+                    metrics.incr('api.gave_up')
+                    raise
+                metrics.incr('api.retries')
+                logging.info('API: retrying in %.2f s after %s' % (delay, e))
+                time.sleep(delay)
+                attempt += 1
+
+
+    def executeBatch(self, service, requests, user_id=None, batch_size=50):
+        """
+        Execute `requests`, all made with `service`, as batch HTTP requests
+        of up to `batch_size` calls each.  Calls that fail with retryable
+        errors are sent again in later batches, within the deadline.
+        Returns a (response, exception) pair for each request, in order.
+        """
+        give_up_at = self._giveUpAt()
+        results = [(None, None)] * len(requests)
+        pending = range(len(requests))
+        attempt = 0
+        while pending:
+            retry = [ ]
+            def callback(request_id, response, exception):
+                i = int(request_id)
+                results[i] = (response, exception)
+                if exception is not None and isRetryable(exception):
+                    retry.append(i)
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+                batch = service.new_batch_http_request(callback=callback)
+                for i in chunk:
+                    batch.add(requests[i], request_id=str(i))
+                if user_id is not None:
+                    self._takeToken('user:%s' % user_id, self.user_rate, give_up_at, len(chunk))
+                self._takeToken('global', self.global_rate, give_up_at, len(chunk))
+                try:
+                    batch.execute()
+                    metrics.incrMulti({ 'api.batches': 1, 'api.calls': len(chunk) })
+                except Exception as e:
+                    for i in chunk:
+                        results[i] = (None, e)
+                    if not isRetryable(e):
+                        metrics.incr('api.errors')
+                        raise
+                    retry.extend(chunk)
+            if not retry:
+                break
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            if time.time() + delay > give_up_at:
+                metrics.incr('api.gave_up')
+                break
+            metrics.incr('api.retries', len(retry))
+            logging.info('API: retrying %d batched calls in %.2f s' % (len(retry), delay))
+            time.sleep(delay)
+            pending = sorted(retry)
+            attempt += 1
+        return results
+
+
+scheduler = CallScheduler()
+
+def startRequest():
+    scheduler.startRequest()
+
+def execute(request, user_id=None):
+    return scheduler.execute(request, user_id)
+
+def executeBatch(service, requests, user_id=None):
+    return scheduler.executeBatch(service, requests, user_id)
@@ -0,0 +1,75 @@
+"""
+Just enough iCalendar (RFC 5545) to publish bookings as VEVENTs.
+"""
+
+import six
+
+
+CRLF = '\r\n'
+
+
+def escape(text):
+    if not text:
+        return ''
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+        .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def fold(line):
+    """
+    Split a content line into 75-octet pieces, as the spec requires.
+    """
+    if isinstance(line, six.text_type):
+        line = line.encode('utf-8')
+    if len(line) <= 75:
+        return line + CRLF
+    pieces = [ ]
+    while len(line) > 75:
+        cut = 75 if not pieces else 74
+        # Don't split a UTF-8 sequence
+        while cut > 0 and (ord(line[cut:cut + 1]) & 0xC0) == 0x80:
+            cut -= 1
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return (CRLF + ' ').join(pieces) + CRLF
+
+def formatUtc(dt_utc):
+    return dt_utc.strftime('%Y%m%dT%H%M%SZ')
+
+def calendarStart(name):
+    return ''.join(fold(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//gafe-conferences//Bookings//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        'X-WR-CALNAME:%s' % escape(name) ])
+
+def calendarEnd():
+    return fold('END:VCALENDAR')
+
+def bookingEvent(booking, domain):
+    """
+    One VEVENT for a Booking.  Times are in UTC, as stored.
+    """
+    attendee = booking.attendee
+    description = '%s %s, %s, %s' % (attendee.first_name, attendee.last_name,
+        attendee.email, attendee.phone)
+    if attendee.notes:
+        description += '\n' + attendee.notes
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:%s@%s' % (booking.key.urlsafe(), domain),
+        'DTSTAMP:%s' % formatUtc(booking.updated or booking.created),
+        'DTSTART:%s' % formatUtc(booking.start_time),
+        'DTEND:%s' % formatUtc(booking.end_time),
+        'SUMMARY:%s' % escape(booking.title),
+        'DESCRIPTION:%s' % escape(description) ]
+    if booking.event and booking.event.location:
+        lines.append('LOCATION:%s' % escape(booking.event.location))
+    if booking.canceled:
+        lines.append('STATUS:CANCELLED')
+    else:
+        lines.append('STATUS:CONFIRMED')
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
@@ -0,0 +1,202 @@
+"""
+Bulk import of pre-assigned conference times from a CSV file.
+
+1. `startImport` parses and checks every row in memory: the teacher must
+   exist, the time must be on that teacher's schedule (their compiled
+   `WeekSchedule`) and free of other bookings, which are loaded with one
+   query per teacher.  Good rows are saved with `put_multi`; bad rows are
+   reported on the job.
+2. Task queue tasks create the Calendar events, per teacher in batch HTTP
+   requests of up to 50 inserts; `gapi.executeBatch` retries the items
+   that fail with retryable errors.  An insert that conflicts (an earlier
+   attempt got through) is fetched instead.
+3. Each task adds its results to the `ImportJob`, which the admin page
+   shows as progress.
+"""
+
+from collections import OrderedDict
+import csv
+from datetime import datetime, timedelta
+from dateutil import parser as date_parser
+import logging
+import pytz
+
+from flask import url_for
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import availability
+import gapi
+from models import Attendee, Booking, ImportJob, User
+
+
+CSV_COLUMNS = ['teacher_email', 'date', 'start_time', 'first_name', 'last_name',
+    'email', 'phone', 'notes']
+
+# Bookings per event-creation task
+TASK_SIZE = 100
+
+
+def _decode(value):
+    return (value or '').decode('utf-8').strip()
+
+def parseRows(data):
+    """
+    (line number, dict) for each row of CSV `data`, which must have a
+    header row with at least the CSV_COLUMNS names.
+    """
+    if data.startswith('\xef\xbb\xbf'):
+        data = data[3:]
+    reader = csv.DictReader(data.splitlines())
+    missing = [c for c in CSV_COLUMNS if c not in (reader.fieldnames or [ ])]
+    if missing:
+        raise ValueError('Missing columns: %s' % ', '.join(missing))
+    for line, row in enumerate(reader, 2):
+        yield (line, dict((c, _decode(row.get(c))) for c in CSV_COLUMNS))
+
+def buildBookings(rows):
+    """
+    Check `rows` against the teachers' schedules and bookings.  Returns
+    (bookings, errors), where errors are messages for the rows left out.
+    """
+    teachers = dict((u.email.lower(), u) for u in User.getTeachers())
+    bookings = [ ]
+    errors = [ ]
+    taken = set()
+    for line, row in rows:
+        resource = teachers.get(row['teacher_email'].lower())
+        if resource is None:
+            errors.append('Line %d: no teacher %s' % (line, row['teacher_email']))
+            continue
+        if not row['email'] or not row['first_name'] or not row['last_name']:
+            errors.append('Line %d: name and email are required' % line)
+            continue
+        try:
+            d = date_parser.parse(row['date']).date()
+            t = date_parser.parse(row['start_time']).time()
+        except (ValueError, OverflowError):
+            errors.append('Line %d: bad date or time' % line)
+            continue
+        if not resource.getWeekSchedule().isScheduled(d, t):
+            errors.append('Line %d: %s %s is not on %s\'s schedule' % 
+                (line, row['date'], row['start_time'], resource.email))
+            continue
+        tz = resource.getTimezoneObject()
+        dt_start = tz.localize(datetime.combine(d, t))
+        start_utc = dt_start.astimezone(pytz.utc).replace(tzinfo=None)
+        if (resource.key, start_utc) in taken:
+            errors.append('Line %d: that time is already booked' % line)
+            continue
+        taken.add((resource.key, start_utc))
+
+        booking = Booking(key=Booking.newKey(resource.key, start_utc), 
+            resource=resource.key, attendee=Attendee(
+            email=row['email'], phone=row['phone'], first_name=row['first_name'],
+            last_name=row['last_name'], notes=row['notes']))
+        booking.title = resource.prefs.title
+        booking.organizer_name = resource.prefs.display_name
+        booking.start_time = start_utc
+        booking.end_time = start_utc + timedelta(minutes=resource.prefs.duration)
+        booking.timezone = tz.zone
+        bookings.append((line, booking))
+
+    # Existing bookings, one query per teacher over the imported range
+    by_resource = OrderedDict()
+    for line, b in bookings:
+        by_resource.setdefault(b.resource, [ ]).append(b.start_time)
+    existing = set()
+    for resource_key, starts in by_resource.items():
+        existing.update((resource_key, b.start_time) for b in Booking.fetchForResource(resource_key,
+            Booking.start_time >= min(starts), Booking.start_time <= max(starts)) if b.canceled is None)
+    good = [ ]
+    for line, b in bookings:
+        if (b.resource, b.start_time) in existing:
+            errors.append('Line %d: that time is already booked' % line)
+        else:
+            good.append(b)
+    return (good, errors)
+
+def startImport(data, filename=None):
+    """
+    Save the good rows of CSV `data` as bookings and queue their Calendar
+    events.  Returns the `ImportJob`.
+    """
+    job = ImportJob(filename=filename)
+    try:
+        rows = list(parseRows(data))
+    except (ValueError, csv.Error) as e:
+        job.addErrors([str(e)])
+        job.put()
+        return job
+    bookings, errors = buildBookings(rows)
+    saved = Booking.putMultiCounted(bookings)
+    if len(saved) < len(bookings):
+        errors.append('%d rows were booked by someone else meanwhile' % (len(bookings) - len(saved)))
+    bookings = saved
+    # The imported times are taken now, not at the end of the hard TTL
+    availability.invalidateMulti(set(b.resource.id() for b in bookings))
+    job.rows = len(rows)
+    job.imported = len(bookings)
+    job.addErrors(errors)
+    job.put()
+
+    keys = [b.key.urlsafe() for b in bookings]
+    for start in range(0, len(keys), TASK_SIZE):
+        taskqueue.add(url=url_for('create_calendar_events_task'), params={ 
+            'job': job.key.id(), 'keys': ','.join(keys[start:start + TASK_SIZE]) })
+    return job
+
+def createCalendarEvents(job_id, urlsafe_keys):
+    """
+    Create the Calendar events for a task's share of an import, in one
+    batch request per teacher (per 50 events).
+    """
+    keys = [ndb.Key(urlsafe=k) for k in urlsafe_keys.split(',') if k]
+    by_resource = OrderedDict()
+    for b in ndb.get_multi(keys):
+        # Skip bookings done by an earlier run of this task
+        if b is not None and b.event is None and b.canceled is None:
+            by_resource.setdefault(b.resource, [ ]).append(b)
+
+    created = 0
+    failed = 0
+    errors = [ ]
+    for resource_key, bookings in by_resource.items():
+        resource = resource_key.get()
+        if resource is None:
+            failed += len(bookings)
+            continue
+        user_id = resource_key.id()
+        try:
+            cal_service = gapi.buildService('calendar', 'v3', resource.authorizedHttp())
+            calendar = gapi.execute(cal_service.calendars().get(calendarId='primary'), user_id)
+        except Exception as e:
+            failed += len(bookings)
+            errors.append('%s: %s' % (resource.email, e))
+            continue
+
+        results = gapi.executeBatch(cal_service, [cal_service.events().insert(
+            calendarId='primary', sendNotifications=True, body=b.getEventBody(resource))
+            for b in bookings], user_id)
+        conflicts = [i for i, (event, e) in enumerate(results) if e is not None and gapi.isConflict(e)]
+        if conflicts:
+            fetched = gapi.executeBatch(cal_service, [cal_service.events().get(
+                calendarId='primary', eventId=bookings[i].getEventId()) for i in conflicts], user_id)
+            for i, (event, e) in zip(conflicts, fetched):
+                # A deleted event keeps its id; report the conflict instead
+                if e is not None or Booking.isLiveEvent(event):
+                    results[i] = (event, e)
+
+        done = [ ]
+        for b, (event, e) in zip(bookings, results):
+            if e is None:
+                b.setEvent(resource, calendar['id'], event)
+                done.append(b)
+            else:
+                errors.append('%s at %s: %s' % (resource.email, b.start_time, e))
+        ndb.put_multi(done)
+        created += len(done)
+        failed += len(bookings) - len(done)
+
+    ImportJob.recordEvents(job_id, created, failed, errors)
+    logging.info('IMPORT: job %s, %d events created, %d failed' % (job_id, created, failed))
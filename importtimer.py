@@ -0,0 +1,54 @@
+"""
+Import-time profiling for instance cold starts.
+
+When the `PROFILE_IMPORTS` environment variable is set (see app.yaml),
+`appengine_config.py` calls `install()` before anything else is imported.
+Every top-level import is then timed, and `report()` logs the slowest ones.
+"""
+
+import logging
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+_original_import = None
+_depth = [0]
+_timings = { }
+started = time.time()
+
+
+def _timed_import(name, *args, **kwargs):
+    _depth[0] += 1
+    t0 = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        _depth[0] -= 1
+        if _depth[0] == 0:
+            elapsed = time.time() - t0
+            if elapsed >= 0.001:
+                _timings[name] = _timings.get(name, 0.0) + elapsed
+
+def install():
+    global _original_import
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+
+def uninstall():
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+def timings():
+    return sorted(_timings.items(), key=lambda item: item[1], reverse=True)
+
+def report(limit=20):
+    logging.info('IMPORTS: %.0f ms since instance start' % ((time.time() - started) * 1000))
+    for name, elapsed in timings()[:limit]:
+        logging.info(' %-30s %7.1f ms' % (name, elapsed * 1000))
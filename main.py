@@ -1,5 +1,8 @@
 """`main` is the top level module for your Flask application."""
 
+import time
+_import_started = time.time()
+
 from datetime import date, datetime, timedelta
 from dateutil import parser as date_parser
 import json
@@ -7,18 +10,29 @@ import logging
 import os
 import pytz
 import six
+import sys
 
 # Import Flask Framework modules
-from flask import Flask, flash, request, redirect, render_template, session, url_for
+from flask import Flask, Response, flash, request, redirect, render_template, session, url_for
 from flask_login import LoginManager, current_user, login_user, logout_user
 
-# Impprt Googley modules
-from oauth2client.client import OAuth2WebServerFlow, OAuth2Credentials
-from oauth2client.appengine import AppAssertionCredentials
+from google.appengine.api import mail, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 
 # Applicaition-specific modules
-from models import User, Booking, RemindersToken
-from forms import UserPrefsForm, DayPrefsForm, BookingForm, RemindersForm
+from admin import admin, exportBucket, exportChunks
+import assets
+import availability
+import cancellations
+import exports
+import feeds
+import gapi
+import imports
+import modelcache
+from models import (User, Booking, FeedToken, RemindersToken, SlotTakenError, WatchChannel, 
+    busy_coalescer)
+from forms import UserPrefsForm, DayPrefsForm, BookingForm, CancelDayForm, RemindersForm
+from slots import SLOT_AVAILABLE, SLOT_OFF_SCHEDULE, SLOT_BUSY, SLOT_BOOKED, SLOT_DEADLINE
 
 
 # Flask setup
@@ -27,10 +41,12 @@ app = Flask(__name__)
 # Determine GAE enironment and load private config
 if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
     app.config['GAE_SERVER'] = 'dev_appserver'
+    import config_dev as private_config
     from config_dev import (debug as app_debug, log_level, gafe_domain, hostname, port, protocol, secret_key,
         friendly_name, support_email, reminders_expire)
 else:
     app.config['GAE_SERVER'] = 'appengine'
+    import config_gae as private_config
     from config_gae import (debug as app_debug, log_level, gafe_domain, hostname, port, protocol, secret_key,
         friendly_name, support_email, reminders_expire)
 server_name = '%s:%d' % (hostname, port) if ((protocol == 'http' and port != 80) or (protocol == 'https' and port != 443)) else hostname
@@ -50,15 +66,41 @@ app.config['FRIENDLY_NAME'] = friendly_name
 app.config['SUPPORT_EMAIL'] = support_email
 app.config['REMINDERS_EXPIRE'] = reminders_expire
 
+# Performance tuning; config files from older versions may leave these out
+app.config['BUSY_COALESCE_ENABLED'] = getattr(private_config, 'busy_coalesce_enabled', True)
+app.config['BUSY_COALESCE_RESULT_TTL'] = getattr(private_config, 'busy_coalesce_result_ttl', 5)
+app.config['BUSY_COALESCE_WAIT'] = getattr(private_config, 'busy_coalesce_wait', 10)
+app.config['AVAILABILITY_SOFT_TTL'] = getattr(private_config, 'availability_soft_ttl', 15)
+app.config['AVAILABILITY_HARD_TTL'] = getattr(private_config, 'availability_hard_ttl', 120)
+app.config['AVAILABILITY_PREFETCH'] = getattr(private_config, 'availability_prefetch', True)
+app.config['CALENDAR_WATCH_ENABLED'] = getattr(private_config, 'calendar_watch_enabled', False)
+app.config['API_RATE_PER_USER'] = getattr(private_config, 'api_rate_per_user', 5)
+app.config['API_RATE_GLOBAL'] = getattr(private_config, 'api_rate_global', 50)
+app.config['API_DEADLINE'] = getattr(private_config, 'api_deadline', 20)
+app.config['API_REQUEST_DEADLINE'] = getattr(private_config, 'api_request_deadline', 45)
+app.config['FEED_MAX_AGE'] = getattr(private_config, 'feed_max_age', 300)
+app.config['EXPORT_BUCKET'] = getattr(private_config, 'export_bucket', None)
+app.config['ANCESTOR_BOOKINGS'] = getattr(private_config, 'ancestor_bookings', False)
+app.config['ASSETS_DEBUG'] = getattr(private_config, 'assets_debug', 
+    app.config['GAE_SERVER'] == 'dev_appserver')
+
+busy_coalescer.configure(
+    enabled=app.config['BUSY_COALESCE_ENABLED'],
+    result_ttl=app.config['BUSY_COALESCE_RESULT_TTL'],
+    wait=app.config['BUSY_COALESCE_WAIT'])
+gapi.scheduler.configure(
+    user_rate=app.config['API_RATE_PER_USER'],
+    global_rate=app.config['API_RATE_GLOBAL'],
+    deadline=app.config['API_DEADLINE'],
+    request_deadline=app.config['API_REQUEST_DEADLINE'])
+app.before_request(gapi.startRequest)
+modelcache.install()
+Booking.ancestor_keys = app.config['ANCESTOR_BOOKINGS']
+assets.init_app(app)
 
-# Google OAuth2 setup
-secrets = None
-with open('client_secrets.json') as f:
-    secrets = json.load(f)['web']
 
+# Google OAuth2 setup
 app.config['OAUTH2CALLBACK_PATH'] = '/oauth2callback'
-app.config['GOOGLE_CLIENT_ID'] = secrets['client_id']
-app.config['GOOGLE_CLIENT_SECRET'] = secrets['client_secret']
 app.config['GOOGLE_LOGIN_REDIRECT_URI'] = '%s://%s%s' % (
     app.config['PREFERRED_URL_SCHEME'],
     app.config['SERVER_NAME'], 
@@ -79,6 +121,10 @@ app.config['GOOGLE_SERVICE_ACCOUNT_SCOPE'] = ' '.join([
 ])
 
 
+# Administrator pages (admin.py)
+app.register_blueprint(admin)
+
+
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -92,30 +138,32 @@ def load_user(user_id):
     return user
 
 
-# Google OAuth2 setup for user logins
-flow = OAuth2WebServerFlow(
-    app.config['GOOGLE_CLIENT_ID'],
-    app.config['GOOGLE_CLIENT_SECRET'],
-    app.config['GOOGLE_LOGIN_SCOPE'],
-    redirect_uri=app.config['GOOGLE_LOGIN_REDIRECT_URI'],
-    hd=app.config['GOOGLE_LOGIN_DOMAIN'],
-    approval_prompt='force')
+# Google OAuth2 setup for user logins, built on first use
+_flow = None
+
+def get_flow():
+    global _flow
+    if _flow is None:
+        from oauth2client.client import OAuth2WebServerFlow
+        with open('client_secrets.json') as f:
+            secrets = json.load(f)['web']
+        app.config['GOOGLE_CLIENT_ID'] = secrets['client_id']
+        app.config['GOOGLE_CLIENT_SECRET'] = secrets['client_secret']
+        _flow = OAuth2WebServerFlow(
+            app.config['GOOGLE_CLIENT_ID'],
+            app.config['GOOGLE_CLIENT_SECRET'],
+            app.config['GOOGLE_LOGIN_SCOPE'],
+            redirect_uri=app.config['GOOGLE_LOGIN_REDIRECT_URI'],
+            hd=app.config['GOOGLE_LOGIN_DOMAIN'],
+            approval_prompt='force')
+    return _flow
 
 # Google OAuth2 setup for service accounts, if we ever need to use it
+# from oauth2client.appengine import AppAssertionCredentials
 # app.config['service_account_credentials'] = AppAssertionCredentials(
 #     app.config['GOOGLE_SERVICE_ACCOUNT_SCOPE'])
 
 
-# Flags for booking availabilty
-SLOT_AVAILABLE = 0
-SLOT_OFF_SCHEDULE = 1
-SLOT_BUSY = 2
-SLOT_BOOKED = 3
-
-# Additional flag if it's too early or late to book
-SLOT_DEADLINE = 8
-
-
 # Flask helper functions
 @app.context_processor
 def utility_processor():
@@ -144,13 +192,8 @@ def utility_processor():
         dt_end = dt_start + timedelta(minutes=duration)
         return time_format_local(dt_start, dt_end)
 
-    def slot_at(slots, d, t, tz):
-        status = SLOT_OFF_SCHEDULE
-        dt_start = tz.localize(datetime.combine(d, t))
-        for s in slots:
-            if s['start'] == dt_start:
-                status = SLOT_AVAILABLE if s['available'] else SLOT_BUSY
-        return status
+    def slot_at(grid, d, t, tz):
+        return grid.statusAt(d, t)
 
     return dict(date_format_local=date_format_local,
         date_format_from_utc=date_format_from_utc,
@@ -160,6 +203,23 @@ def utility_processor():
         slot_at=slot_at)
 
 
+def calendar_webhook_url():
+    if app.config['CALENDAR_WATCH_ENABLED']:
+        return url_for('calendar_notification', _external=True)
+    return None
+
+def ics_feed(scope, ident, name, qry):
+    tag, ttl = feeds.etag(scope, ident)
+    if tag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        body = feeds.getFeed(tag, lambda: ''.join(
+            exports.icsChunks(qry, name, app.config['SERVER_NAME'])), ttl)
+        response = Response(body, mimetype='text/calendar')
+    response.set_etag(tag)
+    response.cache_control.max_age = app.config['FEED_MAX_AGE']
+    return response
+
 def flash_form_errors(msg, form):
     flash(msg + ' Please correct these fields and re-submit.', 'error')
     for field, errors in form.errors.items():
@@ -174,7 +234,7 @@ def index():
 
 @app.route('/login')
 def login():
-    authorize_url = flow.step1_get_authorize_url()
+    authorize_url = get_flow().step1_get_authorize_url()
     return redirect(authorize_url)
 
 @app.route('/logout')
@@ -190,8 +250,9 @@ def prefs():
         form = UserPrefsForm(obj=user.prefs)
         if request.method == 'POST':
             if form.validate_on_submit():
+                state = user.getState()
                 form.populate_obj(user.prefs)
-                user.put()
+                user.putIfChanged(state)
 
                 flash('Your preferences were updated.', 'info')
                 return redirect(url_for('index'))
@@ -218,8 +279,9 @@ def times():
         form = DayPrefsForm(obj=user)
         if request.method == 'POST':
             if form.validate_on_submit():
+                state = user.getState()
                 form.populate_obj(user)
-                user.put()
+                user.putIfChanged(state)
 
                 flash('Your preferences were updated.', 'info')
                 return redirect(url_for('index'))
@@ -235,28 +297,66 @@ def bookings():
     user = current_user
     if user.is_active and not user.is_anonymous and user.auth_type == 'gafe':
         bookings = Booking.getBookingsForResource(user)
-        return render_template('user-bookings.html', bookings=bookings)
+        feed_url = url_for('resource_feed', token=FeedToken.getOrCreate(resource=user).key.id(), 
+            _external=True)
+        return render_template('user-bookings.html', bookings=bookings, feed_url=feed_url,
+            cancel_form=CancelDayForm())
+
+    flash('Access denied.  Please log in via Google Apps.', 'error')
+    return redirect(url_for('index'))
+
+@app.route('/bookings/cancel', methods=['POST'])
+def cancel_day():
+    user = current_user
+    if user.is_active and not user.is_anonymous and user.auth_type == 'gafe':
+        form = CancelDayForm()
+        if form.validate_on_submit():
+            tz = user.getTimezoneObject()
+            dt_from = tz.localize(datetime.combine(form.date.data, datetime.min.time()))
+            bookings = Booking.getBookingsForResourceBetween(user, dt_from, dt_from + timedelta(days=1))
+            canceled = cancellations.cancelBookings(bookings, form.reason.data)
+            flash('%d bookings were canceled. The families will get an email.' % len(canceled), 'info')
+        else:
+            flash_form_errors('Your bookings could not be canceled.', form)
+        return redirect(url_for('bookings'))
 
     flash('Access denied.  Please log in via Google Apps.', 'error')
     return redirect(url_for('index'))
 
 @app.route('/resources')
 def resources():
-    resources = User.getAvailableResources()
-    return render_template('resources.html', resources=resources)
+    q = request.args.get('q', '').strip()
+    truncated = False
+    if q:
+        resources, truncated = User.search(q, limit=100)
+    else:
+        resources = User.getAvailableResources()
+    return render_template('resources.html', resources=resources, q=q, truncated=truncated)
+
+@app.route('/resources/search')
+def search_resources():
+    users, truncated = User.search(request.args.get('q', ''))
+    results = [{
+        'name': user.prefs.display_name,
+        'location': user.prefs.location,
+        'url': url_for('calendar', uid=user.key.urlsafe()) }
+        for user in users]
+    return Response(json.dumps({ 'results': results, 'more': truncated }), mimetype='application/json')
 
 @app.route('/calendar/<uid>')
 @app.route('/calendar/<uid>/<date_str>')
 def calendar(uid, date_str=None):
     resource = User.getByUrlsafeId(uid)
     tz = resource.getTimezoneObject()
-    slots = resource.getAvailableSlots()
-    limits = resource.getSlotLimits(slots, True)
 
     d = date.today()
     if date_str is None:
-        if len(limits['dates']) > 0:
-            d = limits['dates'][0]
+        # Start at the first scheduled day; no need to ask Calendar for that
+        dt_from, dt_to = resource.getDefaultWindow()
+        dates = resource.getSlotGrid(dt_from.date(), dt_to.date()).getLimits(False)['dates']
+        upcoming = [day for day in dates if day >= d]
+        if upcoming or dates:
+            d = (upcoming or dates)[0]
     else:
         d = date_parser.parse(date_str).date()
 
@@ -268,6 +368,8 @@ def calendar(uid, date_str=None):
     date_prev = week_prev.strftime('%Y-%m-%d')
     date_next = week_next.strftime('%Y-%m-%d')
 
+    grid = resource.markDeadlines(availability.getSlotGrid(resource, d, week_next - timedelta(days=1)))
+    limits = grid.getLimits(True)
     limits['week_start'] = d
     week_dates = [ ]
     while d < week_next:
@@ -275,10 +377,15 @@ def calendar(uid, date_str=None):
             week_dates.append(d)
         d += timedelta(days=1)
     limits['week_dates'] = week_dates
-    return render_template('calendar.html', uid=uid, date_str=date_str, 
+    prefetch = availability.prefetchAdjacent(resource, limits['week_start'], 
+        week_next - timedelta(days=1))
+    page = render_template('calendar.html', uid=uid, date_str=date_str, 
         date_prev=date_prev, date_next=date_next,
         resource=resource, duration=resource.prefs.duration, tz=tz,
-        slots=slots, limits=limits)
+        slots=grid, limits=limits)
+    # Usually done by now; its RPCs ran while the page was rendered
+    prefetch.get_result()
+    return page
 
 @app.route('/booking/<uid>/<date_str>/<time_str>', methods=['GET', 'POST'])
 def booking(uid, date_str, time_str):
@@ -288,10 +395,29 @@ def booking(uid, date_str, time_str):
     dt_str = '%s %s' % (date_str, time_str.replace('-', ':', 1))
     dt_start = tz.localize(date_parser.parse(dt_str))
     dt_end = dt_start + timedelta(minutes=duration)
+    # The URL may be stale or made up; refuse anything off the schedule
+    reason = resource.validateSlot(dt_start)
+    if reason is not None:
+        flash(reason + ' Please choose another time.', 'error')
+        return redirect(url_for('calendar', uid=uid, date_str=date_str))
     form = BookingForm(start_time=dt_start, end_time=dt_end, timezone=tz.zone)
     if request.method == 'POST':
         if form.validate_on_submit():
-            booking = Booking.createFromPost(resource, form.data)
+            # The calendar page may have been stale; check again for real
+            if not availability.reserveSlot(resource, dt_start):
+                flash('Someone else is booking this time right now. Please choose another time.', 'error')
+                return redirect(url_for('calendar', uid=uid, date_str=date_str))
+            try:
+                if not resource.isSlotFree(dt_start, dt_end):
+                    flash('Sorry, this time is no longer available. Please choose another time.', 'error')
+                    return redirect(url_for('calendar', uid=uid, date_str=date_str))
+                booking = Booking.createFromPost(resource, form.data)
+            except SlotTakenError:
+                flash('Sorry, this time is no longer available. Please choose another time.', 'error')
+                return redirect(url_for('calendar', uid=uid, date_str=date_str))
+            finally:
+                availability.releaseSlot(resource, dt_start)
+            availability.invalidate(resource.key.id())
             flash('Your booking succeeded.', 'info')
             return redirect(url_for('calendar', uid=uid, date_str=date_str))
         else:
@@ -308,7 +434,10 @@ def reminders(token=None):
         email = RemindersToken.validateToken(token)
         if email:
             bookings = Booking.getBookingsForAttendeeEmail(email)
-            return render_template('attendee-bookings.html', email=email, bookings=bookings)
+            feed_url = url_for('attendee_feed', token=FeedToken.getOrCreate(email=email).key.id(), 
+                _external=True)
+            return render_template('attendee-bookings.html', email=email, bookings=bookings,
+                feed_url=feed_url)
         else:
             flash('Token invalid or expired', 'error')
 
@@ -324,6 +453,28 @@ def reminders(token=None):
     return render_template('reminders.html', form=form)
 
 
+# Calendar subscription feeds, built from our own Booking entities
+@app.route('/feeds/teacher/<token>.ics')
+def resource_feed(token):
+    feed_token = FeedToken.validateToken(token)
+    if feed_token is None or feed_token.resource is None:
+        return Response('Unknown feed', status=404)
+    resource_key = feed_token.resource
+    resource = modelcache.get(resource_key)
+    if resource is None or not resource.is_active:
+        return Response('Unknown feed', status=404)
+    return ics_feed('resource', resource_key.id(), resource.prefs.title,
+        exports.queryBookings(resource_key))
+
+@app.route('/feeds/family/<token>.ics')
+def attendee_feed(token):
+    feed_token = FeedToken.validateToken(token)
+    if feed_token is None or not feed_token.email:
+        return Response('Unknown feed', status=404)
+    email = feed_token.email
+    return ics_feed('attendee', email, app.config['FRIENDLY_NAME'], Booking.queryForAttendeeEmail(email))
+
+
 # Special route for OAuth2 login (step 1)
 # Must match the "redirect URI" in the Google console/client_secrets.json file
 @app.route(app.config['OAUTH2CALLBACK_PATH'])
@@ -342,10 +493,10 @@ def oauth2callback():
         flash('Login was not completed. %s' % error, 'error')
         return redirect(url_for('index'))
  
-    credentials = flow.step2_exchange(code)
+    credentials = get_flow().step2_exchange(code)
 
     # logging.debug('ACCESS_TOKEN: %s' % credentials.access_token)
-    user, create = User.fromCredentials(credentials)
+    user, create = User.fromCredentials(credentials, calendar_webhook_url())
 
     # logging.debug('USER: %s' % user.get_id())
     login_user(user, force=True, fresh=True)
@@ -353,6 +504,128 @@ def oauth2callback():
     return redirect(url_for('index'))
 
 
+# Calendar push notifications.  Google only sends these to a verified https
+# domain; to test locally, post one yourself (see README.md).
+@app.route('/notifications/calendar', methods=['POST'])
+def calendar_notification():
+    user_key = WatchChannel.handleNotification(
+        request.headers.get('X-Goog-Channel-ID'),
+        request.headers.get('X-Goog-Channel-Token'),
+        request.headers.get('X-Goog-Resource-State'))
+    if user_key is not None:
+        logging.debug('WATCH: calendar changed for %s' % user_key.id())
+    return ''
+
+
+# Task queue handlers (admin-only, see app.yaml)
+@app.route('/tasks/renew-watch-channels')
+def renew_watch_channels():
+    webhook_url = calendar_webhook_url()
+    if webhook_url:
+        for channel in WatchChannel.getExpiring():
+            user = channel.user.get()
+            if user is None or not user.is_active:
+                channel.stop()
+                continue
+            try:
+                user.watchCalendar(webhook_url, channel.calendar_id)
+            except Exception as e:
+                logging.warning('WATCH: could not renew channel for %s: %s' % (user.email, e))
+    return ''
+
+@app.route('/tasks/refresh-availability', methods=['POST'])
+def refresh_availability():
+    resource = User.getByUrlsafeId(request.form['uid'])
+    if resource is not None:
+        availability.computeSlotGrid(resource,
+            date_parser.parse(request.form['from']).date(),
+            date_parser.parse(request.form['to']).date(),
+            prefetched=bool(request.form.get('prefetch')))
+    return ''
+
+@app.route('/tasks/recount-bookings', methods=['POST'])
+def recount_bookings_task():
+    totals = Booking.recount()
+    logging.info('COUNTERS: recounted %d counters' % len(totals))
+    return ''
+
+@app.route('/tasks/delete-calendar-events', methods=['POST'])
+def delete_calendar_events_task():
+    cancellations.deleteCalendarEvents(request.form['keys'])
+    return ''
+
+@app.route('/tasks/notify-cancellations', methods=['POST'])
+def notify_cancellations_task():
+    cancellations.notifyAttendees(request.form['keys'], request.form.get('reason'))
+    return ''
+
+@app.route('/tasks/create-calendar-events', methods=['POST'])
+def create_calendar_events_task():
+    imports.createCalendarEvents(int(request.form['job']), request.form['keys'])
+    return ''
+
+@app.route('/tasks/migrate-booking-keys', methods=['POST'])
+def migrate_booking_keys_task():
+    cursor = request.form.get('cursor')
+    moved, cursor, more = Booking.migrateToAncestorKeys(Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('MIGRATE: moved %d bookings' % moved)
+    if more and cursor is not None:
+        taskqueue.add(url=url_for('migrate_booking_keys_task'), params={ 'cursor': cursor.urlsafe() })
+    else:
+        left = Booking.finishMigration()
+        if left:
+            logging.warning('MIGRATE: %d bookings could not be moved' % left)
+    return ''
+
+@app.route('/tasks/index-users', methods=['POST'])
+def index_users_task():
+    cursor = request.form.get('cursor')
+    count, cursor, more = User.reindexSearch(Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('SEARCH: indexed %d users' % count)
+    if more and cursor is not None:
+        taskqueue.add(url=url_for('index_users_task'), params={ 'cursor': cursor.urlsafe() })
+    return ''
+
+@app.route('/tasks/index-attendee-emails', methods=['POST'])
+def index_attendee_emails_task():
+    cursor = request.form.get('cursor')
+    count, cursor, more = Booking.reindexAttendeeEmails(Cursor(urlsafe=cursor) if cursor else None)
+    logging.info('EMAILS: indexed %d bookings' % count)
+    if more and cursor is not None:
+        taskqueue.add(url=url_for('index_attendee_emails_task'), params={ 'cursor': cursor.urlsafe() })
+    return ''
+
+@app.route('/tasks/export-bookings', methods=['POST'])
+def export_bookings_task():
+    fmt = request.form['fmt']
+    filename = exports.saveExport(exportChunks(fmt, request.form), fmt, exportBucket())
+    message = mail.EmailMessage(
+        sender=app.config['SUPPORT_EMAIL'],
+        subject='Bookings export',
+        to=request.form['email'],
+        body='The bookings export you asked for is ready. Sign in as an administrator to download it:\n\n%s\n' %
+            url_for('admin.export_file', filename=filename, _external=True))
+    message.send()
+    return ''
+
+
+# App Engine sends this to new instances (see inbound_services in app.yaml),
+# so the first user request doesn't pay for loading everything
+@app.route('/_ah/warmup')
+def warmup():
+    t0 = time.time()
+    get_flow()
+    gapi.preload()
+    for zone, label in UserPrefsForm.timezone.kwargs['choices']:
+        pytz.timezone(zone)
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    logging.info('WARMUP: done in %.0f ms' % ((time.time() - t0) * 1000))
+    if 'importtimer' in sys.modules:
+        sys.modules['importtimer'].report()
+    return ''
+
+
 # See the section on <a href="/appengine/docs/python/#Python_App_caching">Requests and App Caching</a> for information on how
 # App Engine reuses your request handlers when you specify a main function
 def main():
@@ -371,6 +644,9 @@ def main():
     app.run(host=app.config['HOSTNAME'], port=app.config['PORT'])
 
 
+logging.info('MAIN: imported in %.0f ms' % ((time.time() - _import_started) * 1000))
+
+
 # Start the app locally, based on settings in config.py
 if __name__ == '__main__':
     main()
@@ -0,0 +1,175 @@
+"""
+Whole-school availability: a teacher x slot matrix computed in batch.
+
+Each teacher's slot starts and busy intervals are flattened to sorted
+integer arrays of epoch minutes, and every slot is tested against the busy
+set in one vectorized pass per teacher (a binary search per slot with
+NumPy, or a single merge walk over two sorted `array`s without it).  No
+per-slot dicts or datetimes are created.
+
+Columns are the union of every teacher's slot starts; a cell holds the
+`SLOT_*` status of that teacher at that time.
+"""
+
+from array import array
+from datetime import datetime, time as dt_time
+import logging
+import threading
+
+import pytz
+
+from slots import (SLOT_AVAILABLE, SLOT_OFF_SCHEDULE, SLOT_BUSY, SLOT_BOOKED,
+    iter_bits, merge_intervals, to_epoch)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# How many teachers' calendars are fetched at the same time
+FETCH_THREADS = 10
+
+
+def slot_minutes(grid):
+    """
+    Sorted epoch minutes of every scheduled slot start in a `SlotGrid`.
+    """
+    minutes = array('l')
+    for day in grid.days:
+        origin = day.origin // 60
+        minutes.extend(origin + k * grid.interval for k in iter_bits(day.schedule))
+    return minutes
+
+def interval_minutes(intervals):
+    """
+    Ordered, non-overlapping (start, end) epoch-second intervals as two
+    arrays of epoch minutes, widened to whole minutes.
+    """
+    starts = array('l')
+    ends = array('l')
+    for start, end in intervals:
+        starts.append(start // 60)
+        ends.append(-(-end // 60))
+    return (starts, ends)
+
+def conflicts(slots, length, starts, ends):
+    """
+    For each slot start in `slots` (a slot lasts `length` minutes), 1 if it
+    overlaps one of the intervals given by `starts`/`ends`, else 0.
+    """
+    if not len(slots) or not len(starts):
+        return bytearray(len(slots))
+
+    if numpy is not None:
+        s = numpy.frombuffer(slots, dtype=slots.typecode)
+        b_starts = numpy.frombuffer(starts, dtype=starts.typecode)
+        b_ends = numpy.frombuffer(ends, dtype=ends.typecode)
+        # The last interval starting before the slot ends is the only one
+        # that can overlap it
+        j = numpy.searchsorted(b_starts, s + length, side='left') - 1
+        return ((j >= 0) & (b_ends[numpy.maximum(j, 0)] > s)).astype(numpy.int8)
+
+    flags = bytearray(len(slots))
+    j = 0
+    n = len(starts)
+    for i, s in enumerate(slots):
+        while j < n and ends[j] <= s:
+            j += 1
+        if j < n and starts[j] < s + length:
+            flags[i] = 1
+    return flags
+
+
+class AvailabilityMatrix(object):
+    """
+    `rows[i][j]` is the status of `users[i]` at `columns[j]` (epoch minutes).
+    """
+
+    def __init__(self, users, columns, rows):
+        self.users = users
+        self.columns = columns
+        self.rows = rows
+
+    def columnDatetimes(self, tz):
+        return [pytz.utc.localize(datetime.utcfromtimestamp(m * 60)).astimezone(tz)
+            for m in self.columns]
+
+    def availableCounts(self):
+        counts = [0] * len(self.columns)
+        for row in self.rows:
+            for j, status in enumerate(row):
+                if status == SLOT_AVAILABLE:
+                    counts[j] += 1
+        return counts
+
+    @classmethod
+    def compute(cls, users, d_from, d_to, bookings):
+        """
+        Build the matrix for the local dates `d_from` through `d_to`.
+        `bookings` are the (uncanceled) Booking entities in that window.
+        """
+        booked = { }
+        for b in bookings:
+            booked.setdefault(b.resource, [ ]).append((
+                to_epoch(pytz.utc.localize(b.start_time)), to_epoch(pytz.utc.localize(b.end_time))))
+
+        teacher_slots = [ ]
+        teacher_busy = [None] * len(users)
+        for user in users:
+            teacher_slots.append(slot_minutes(user.getSlotGrid(d_from, d_to)))
+        cls._fetchBusy(users, d_from, d_to, teacher_slots, teacher_busy)
+
+        columns = sorted(set(m for minutes in teacher_slots for m in minutes))
+        index = dict((m, j) for j, m in enumerate(columns))
+        rows = [ ]
+        for i, user in enumerate(users):
+            slots = teacher_slots[i]
+            length = user.prefs.interval
+            row = bytearray([SLOT_OFF_SCHEDULE]) * len(columns)
+            if teacher_busy[i] is None:
+                busy = [1] * len(slots)
+            else:
+                busy = conflicts(slots, length, *interval_minutes(teacher_busy[i]))
+            taken = conflicts(slots, length, *interval_minutes(
+                merge_intervals(sorted(booked.get(user.key, [ ])))))
+            for k, m in enumerate(slots):
+                status = SLOT_AVAILABLE
+                if taken[k]:
+                    status = SLOT_BOOKED
+                elif busy[k]:
+                    status = SLOT_BUSY
+                row[index[m]] = status
+            rows.append(row)
+        return cls(users, columns, rows)
+
+    @classmethod
+    def _fetchBusy(cls, users, d_from, d_to, teacher_slots, teacher_busy):
+        """
+        Fill in `teacher_busy` with each teacher's busy intervals, a few
+        teachers at a time.  Teachers whose calendar can't be read are left
+        as None and shown as busy.
+        """
+        todo = [i for i in range(len(users)) if teacher_slots[i]]
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not todo:
+                        return
+                    i = todo.pop()
+                user = users[i]
+                tz = user.getTimezoneObject()
+                try:
+                    teacher_busy[i] = user.getBusyEvents(
+                        tz.localize(datetime.combine(d_from, dt_time())),
+                        tz.localize(datetime.combine(d_to, dt_time.max)))
+                except Exception as e:
+                    logging.warning('MATRIX: no busy times for %s: %s' % (user.email, e))
+
+        threads = [threading.Thread(target=worker) for n in range(min(FETCH_THREADS, len(todo)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
@@ -0,0 +1,34 @@
+"""
+Cheap shared counters for instrumentation, kept in memcache.
+
+Counters are approximate (memcache may evict them) and are meant for the
+admin pages and logs, not for anything that has to be exact; counters.py
+keeps exact counts in the datastore.
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+PREFIX = 'metric:'
+
+
+def incr(name, delta=1):
+    memcache.incr(PREFIX + name, delta=delta, initial_value=0)
+
+def incrAsync(name, delta=1):
+    return ndb.get_context().memcache_incr(PREFIX + name, delta=delta, initial_value=0)
+
+def incrMulti(deltas):
+    memcache.offset_multi(deltas, key_prefix=PREFIX, initial_value=0)
+
+def get(name):
+    return memcache.get(PREFIX + name) or 0
+
+def getMulti(names):
+    values = memcache.get_multi(names, key_prefix=PREFIX)
+    return dict((name, values.get(name, 0)) for name in names)
+
+def ratio(hits, misses):
+    total = hits + misses
+    return float(hits) / total if total else None
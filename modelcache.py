@@ -0,0 +1,74 @@
+"""
+Hit-rate instrumentation for ndb's entity caches.
+
+ndb answers `key.get()` from its in-context cache, then memcache, and only
+then the datastore, and keeps memcache in step on every put and delete.
+It won't say which of them answered, but it is enough to know whether a
+datastore Get RPC was made: a hook on the datastore API counts Get calls
+on each thread, and `get()` compares the count before and after.
+
+Hits and misses are tallied per kind on each instance and flushed to
+`metrics` every FLUSH_SECONDS, so counting costs no extra RPC per get.
+"""
+
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+import metrics
+
+
+FLUSH_SECONDS = 30
+
+_local = threading.local()
+_tally = { }
+_tally_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+def _countGets(service, call, request, response):
+    if call == 'Get':
+        _local.gets = getattr(_local, 'gets', 0) + 1
+
+def install():
+    # Append() ignores a hook that is already installed under this name
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('modelcache', _countGets, 'datastore_v3')
+
+def _record(name):
+    flush = None
+    with _tally_lock:
+        _tally[name] = _tally.get(name, 0) + 1
+        if time.time() - _last_flush[0] >= FLUSH_SECONDS:
+            flush = _tally.copy()
+            _tally.clear()
+            _last_flush[0] = time.time()
+    if flush:
+        metrics.incrMulti(flush)
+
+def get(key):
+    """
+    `key.get()`, counting whether it was served without the datastore.
+    """
+    before = getattr(_local, 'gets', 0)
+    entity = key.get()
+    if getattr(_local, 'gets', 0) == before:
+        _record('model-cache-hit:%s' % key.kind())
+    else:
+        _record('model-cache-miss:%s' % key.kind())
+    return entity
+
+def hitRates(kinds):
+    """
+    (kind, hits, misses, hit ratio) for each of `kinds`.
+    """
+    names = [ ]
+    for kind in kinds:
+        names.extend(['model-cache-hit:%s' % kind, 'model-cache-miss:%s' % kind])
+    counts = metrics.getMulti(names)
+    rates = [ ]
+    for kind in kinds:
+        hits = counts['model-cache-hit:%s' % kind]
+        misses = counts['model-cache-miss:%s' % kind]
+        rates.append((kind, hits, misses, metrics.ratio(hits, misses)))
+    return rates
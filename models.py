@@ -1,9 +1,14 @@
 import base64
+import binascii
+import copy
 from datetime import date, datetime, timedelta
 from dateutil import parser as date_parser
-import httplib2
 import logging
+import os
 import pytz
+import threading
+import time
+import uuid
 
 from flask import render_template
 from flask_login import UserMixin, make_secure_token
@@ -11,19 +16,46 @@ from flask_login import UserMixin, make_secure_token
 # Google App Engine and API access
 from google.appengine.api import mail
 from google.appengine.ext import ndb
-from apiclient import discovery
 from oauth2client.appengine import CredentialsNDBProperty
 
 from google.appengine.api import memcache
 
+import availability
+from coalesce import Coalescer
+import counters
+import feeds
+import gapi
+from matrix import AvailabilityMatrix
+import metrics
+import modelcache
+import rfc3339
+import search
+from slots import (SLOT_BUSY, SLOT_BOOKED, BusyInterval, SlotGrid, WeekSchedule, merge_intervals,
+    to_epoch)
+
 # If you are using App Engine, you can connect to the App Engine memcache server easily:
 # from werkzeug.contrib.cache import GAEMemcachedCache
 # cache = GAEMemcachedCache()
 
+# Concurrent identical busy-event fetches share one Calendar API request.
+# main.py applies the BUSY_COALESCE_* settings from the config file.
+busy_coalescer = Coalescer('busy')
+
+# Partial response: the only parts of each event we look at
+BUSY_EVENT_FIELDS = 'items(start,end,transparency),nextPageToken'
+
+# Compiled WeekSchedules, keyed by the prefs they were compiled from
+_week_schedules = { }
 
-# Helper function to test for event overlaps
-def conflict(slot, busy_events):
-    return any(e['dt_start'] < slot['end'] and e['dt_end'] > slot['start'] for e in busy_events)
+# Entity groups per transaction in bulk updates (the datastore allows 25)
+BULK_BATCH_SIZE = 25
+
+# User fields (see User.changedFields) that cached availability and feeds
+# are computed from
+AVAILABILITY_FIELDS = frozenset(['days', 'deleted', 'prefs.timezone', 'prefs.interval', 
+    'prefs.duration', 'prefs.first_day_scheduled', 'prefs.last_day_scheduled', 
+    'prefs.busy_calendar_ids'])
+FEED_FIELDS = frozenset(['deleted', 'prefs.title'])
 
 
 # User 1:1 UserPrefs
@@ -42,6 +74,8 @@ class UserPrefs(ndb.Model):
     booking_end_time = ndb.StringProperty()
     minimum_notice_hours = ndb.IntegerProperty(required=True, default=36)
     weekday_start = ndb.IntegerProperty(required=True, default=1)
+    # Other calendars, besides 'primary', whose events block conference slots
+    busy_calendar_ids = ndb.StringProperty(repeated=True)
 
 # User 1:7 DayPrefs
 class DayPrefs(ndb.Model):
@@ -52,19 +86,104 @@ class DayPrefs(ndb.Model):
     lunch_end_time = ndb.StringProperty(required=True)
     day_end_time = ndb.StringProperty(required=True)
 
+# Caching policy: ndb keeps each model below in its in-context cache and in
+# memcache (or not) as set by _use_cache/_use_memcache, and drops the
+# memcache copy itself whenever an entity is put or deleted.  Reads on the
+# hot paths go through modelcache.get, which counts hits and misses.
+
+# User 1:1 UserCredentials, keyed by the User id.  Kept out of the User
+# entity so a token refresh only writes this small entity.  Refresh
+# tokens never go to the shared memcache, and are always read fresh.
+class UserCredentials(ndb.Model):
+    _use_cache = False
+    _use_memcache = False
+
+    credentials = CredentialsNDBProperty()
+
 class User(ndb.Model, UserMixin):
+    # Loaded on every logged-in request and every public calendar page
+    _use_memcache = True
+    _memcache_timeout = 3600
+
+    # Only set on entities saved before UserCredentials existed; moved
+    # out by getCredentials so it isn't cached with the profile
     credentials = CredentialsNDBProperty()
     auth_type = ndb.StringProperty()
     email = ndb.StringProperty()
     first_name = ndb.StringProperty()
     last_name = ndb.StringProperty()
     google_id = ndb.StringProperty()
+    # Copies of the OAuth tokens saved by older versions.  Never set; they
+    # are cleared whenever the user is saved (see _pre_put_hook)
     access_token = ndb.StringProperty()
     refresh_token = ndb.StringProperty()
     created = ndb.DateTimeProperty(auto_now_add=True)
     deleted = ndb.DateTimeProperty()
     prefs = ndb.StructuredProperty(UserPrefs)
     days = ndb.StructuredProperty(DayPrefs, repeated=True)
+    # Name and location prefixes for search (see search.py), set on save
+    search_tokens = ndb.StringProperty(repeated=True)
+
+    def _pre_put_hook(self):
+        self.search_tokens = search.tokensFor(self.searchTexts())
+        # Users are cached in memcache, so they must not carry tokens
+        self.access_token = None
+        self.refresh_token = None
+
+    def getState(self):
+        """
+        A copy of what put() would save, to pass to changedFields or
+        putIfChanged after the user has been edited.
+        """
+        state = copy.deepcopy(self.to_dict(exclude=['credentials', 'search_tokens']))
+        state['credentials'] = self.credentials.to_json() if self.credentials else None
+        return state
+
+    def changedFields(self, state):
+        """
+        Names of the properties that differ from `state`, as
+        'prefs.<name>' for UserPrefs fields.  'search_tokens' is included
+        if the saved tokens are out of date, and 'access_token' and
+        'refresh_token' if the user still holds old OAuth tokens.
+        """
+        current = self.getState()
+        changed = set()
+        for name in set(current) | set(state):
+            old, new = state.get(name), current.get(name)
+            if old == new:
+                continue
+            if name == 'prefs' and old and new:
+                changed.update('prefs.' + field for field in set(old) | set(new) 
+                    if old.get(field) != new.get(field))
+            else:
+                changed.add(name)
+        if self.search_tokens != search.tokensFor(self.searchTexts()):
+            changed.add('search_tokens')
+        changed.update(name for name in ('access_token', 'refresh_token') if getattr(self, name))
+        return changed
+
+    def putIfChanged(self, state):
+        """
+        Save the user unless nothing differs from `state` (see getState),
+        and drop the caches that depend on what changed.  Skipped writes
+        are counted as the 'user.writes_avoided' metric.  Returns the
+        changed fields.
+        """
+        changed = self.changedFields(state)
+        if not changed:
+            metrics.incr('user.writes_avoided')
+            return changed
+        self.put()
+        metrics.incr('user.writes')
+        self.invalidateCaches(changed)
+        return changed
+
+    def invalidateCaches(self, changed):
+        # The User itself is kept current in memcache by put()
+        if changed & AVAILABILITY_FIELDS:
+            availability.invalidate(self.key.id())
+        if changed & FEED_FIELDS:
+            feeds.invalidate('resource', self.key.id())
 
     @property
     def is_active(self):
@@ -74,10 +193,25 @@ class User(ndb.Model, UserMixin):
         if not self.is_active:
             return False
         if dt is None:
-            dt = datetime.now()
-        dt_start = self.prefs.booking_start_time or dt
-        dt_end = self.prefs.booking_end_time or dt
-        return dt_start <= dt and dt <= dt_end
+            dt = datetime.now(pytz.utc)
+        dt_start, dt_end = self.getBookingWindow()
+        return (dt_start is None or dt_start <= dt) and (dt_end is None or dt <= dt_end)
+
+    def getBookingWindow(self):
+        """
+        When parents may make bookings, as (start, end) tz-aware datetimes.
+        Either may be None, for no limit.
+        """
+        tz = self.getTimezoneObject()
+        window = [ ]
+        for d, time_str in [(self.prefs.booking_start_date, self.prefs.booking_start_time),
+                (self.prefs.booking_end_date, self.prefs.booking_end_time)]:
+            dt = None
+            if d is not None:
+                t = date_parser.parse(time_str, fuzzy=True).time() if time_str else datetime.min.time()
+                dt = tz.localize(datetime.combine(d, t))
+            window.append(dt)
+        return tuple(window)
 
     def get_id(self):
         return self.key.id()
@@ -85,6 +219,12 @@ class User(ndb.Model, UserMixin):
     def getTimezoneObject(self):
         return pytz.timezone(self.prefs.timezone)
 
+    def searchTexts(self):
+        texts = [self.first_name, self.last_name]
+        if self.prefs:
+            texts.extend([self.prefs.display_name, self.prefs.location])
+        return texts
+
     def defaultUserPrefs(self):
         display_name = ' '.join([self.first_name, self.last_name])
         title = 'Parent-Teacher Conferences with %s' % display_name
@@ -105,93 +245,216 @@ class User(ndb.Model, UserMixin):
             day_prefs.append(day_pref)
         return day_prefs
 
-    def getBusyEvents(self, dt_from, dt_to, calendar_id='primary'):
-        http_auth = httplib2.Http(memcache)
-        self.credentials.authorize(http_auth)
-        cal_service = discovery.build('calendar', 'v3', http=http_auth)
+    def getCredentials(self):
+        storage = gapi.LeasedStorage(UserCredentials, self.key.id())
+        credentials = storage.get()
+        if credentials is None and self.credentials is not None:
+            credentials = self.credentials
+            storage.put(credentials)
+            credentials.set_store(storage)
+        if self.credentials is not None or self.access_token or self.refresh_token:
+            # Saved by an older version; put() clears the token fields too
+            self.credentials = None
+            self.put()
+        return credentials
+
+    def authorizedHttp(self):
+        return gapi.authorizedHttp(self.getCredentials())
+
+    def getBusyCalendarIds(self):
+        extra = [c for c in (self.prefs.busy_calendar_ids or [ ]) if c != 'primary']
+        return ['primary'] + extra
+
+    def getBusyEvents(self, dt_from, dt_to, calendar_ids=None):
+        """
+        The busy times from all of `calendar_ids` (by default the ones
+        returned by `getBusyCalendarIds`) as ordered, non-overlapping
+        `BusyInterval`s of epoch seconds.
+        """
+        calendar_ids = calendar_ids or self.getBusyCalendarIds()
+        # The generation changes whenever a push notification says the calendar changed
+        key = '|'.join([self.key.id(), str(availability.generation(self.key.id())),
+            ','.join(calendar_ids), dt_from.isoformat(), dt_to.isoformat()])
+        return busy_coalescer.call(key, 
+            lambda: self.fetchAllBusyEvents(dt_from, dt_to, calendar_ids))
+
+    def fetchAllBusyEvents(self, dt_from, dt_to, calendar_ids):
+        """
+        Fetch each calendar in its own thread, then merge the time-ordered
+        results with a k-way merge that joins overlapping intervals.
+        """
+        credentials = self.getCredentials()
+        if len(calendar_ids) == 1:
+            return list(merge_intervals(
+                self.fetchBusyEvents(dt_from, dt_to, calendar_ids[0], credentials)))
+
+        results = [ [ ] for calendar_id in calendar_ids ]
+        errors = [ ]
+        def fetch(i, calendar_id):
+            try:
+                results[i] = self.fetchBusyEvents(dt_from, dt_to, calendar_id, credentials)
+            except Exception as e:
+                if calendar_id == 'primary':
+                    errors.append(e)
+                else:
+                    logging.warning('BUSY: skipping calendar %s for %s: %s' % 
+                        (calendar_id, self.email, e))
+        threads = [threading.Thread(target=fetch, args=(i, calendar_id)) 
+            for i, calendar_id in enumerate(calendar_ids)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return list(merge_intervals(*results))
+
+    def parseEventTimes(self, e):
+        """
+        A `BusyInterval` for an event resource.  All-day events only have
+        `date` values, and block the whole of those days in our time zone.
+        """
+        start = e['start']
+        end = e['end']
+        if 'dateTime' in start:
+            return BusyInterval(rfc3339.parse_datetime(start['dateTime']), 
+                rfc3339.parse_datetime(end['dateTime']))
+        tz = self.getTimezoneObject()
+        return BusyInterval(to_epoch(tz.localize(datetime(*rfc3339.parse_date(start['date'])))),
+            to_epoch(tz.localize(datetime(*rfc3339.parse_date(end['date'])))))
+
+    def fetchBusyEvents(self, dt_from, dt_to, calendar_id='primary', credentials=None):
+        http_auth = gapi.authorizedHttp(credentials or self.getCredentials())
+        cal_service = gapi.buildService('calendar', 'v3', http_auth)
         busy_events = [ ]
         page_token = None
 
         # logging.debug('GET BUSY from %s to %s' % (dt_from, dt_to))
         while True:
-            result = cal_service.events().list(
+            result = gapi.execute(cal_service.events().list(
                 calendarId=calendar_id, 
                 orderBy='startTime',
                 singleEvents=True,
                 timeMin=dt_from.isoformat(),
                 timeMax=dt_to.isoformat(),
                 timeZone=self.prefs.timezone,
-                pageToken=page_token).execute()
-            events = result['items']
+                fields=BUSY_EVENT_FIELDS,
+                pageToken=page_token), self.key.id())
+            events = result.get('items', [ ])
 
             # logging.debug('EVENTS: %r' % events)
             for e in events:
                 if e.get('transparency') != 'transparent':
-                    dt_start = date_parser.parse(e['start']['dateTime'])
-                    dt_end = date_parser.parse(e['end']['dateTime'])
-                    e.update({ 'dt_start': dt_start, 'dt_end': dt_end })
-                    busy_events.append(e)
+                    busy_events.append(self.parseEventTimes(e))
             page_token = result.get('nextPageToken')
             if not page_token:
                 break
         return busy_events
 
+    def getWeekSchedule(self):
+        """
+        The `DayPrefs` compiled to a `WeekSchedule`.  Compiled schedules are
+        kept for the life of the instance and recompiled when prefs change.
+        """
+        prefs = self.prefs
+        signature = (prefs.interval, prefs.first_day_scheduled, prefs.last_day_scheduled,
+            tuple((p.enabled, p.day_start_time, p.day_end_time, p.lunch_start_time, p.lunch_end_time)
+                for p in self.days))
+        schedule = _week_schedules.get(signature)
+        if schedule is None:
+            schedule = WeekSchedule(prefs.interval, prefs.first_day_scheduled, prefs.last_day_scheduled)
+            for i, day_prefs in enumerate(self.days[:7]):
+                if day_prefs.enabled:
+                    lunch_start = None
+                    lunch_end = None
+                    if day_prefs.lunch_start_time and day_prefs.lunch_end_time:
+                        lunch_start = date_parser.parse(day_prefs.lunch_start_time).time()
+                        lunch_end = date_parser.parse(day_prefs.lunch_end_time).time()
+                    schedule.setDay(i,
+                        date_parser.parse(day_prefs.day_start_time or '04:00').time(),
+                        date_parser.parse(day_prefs.day_end_time or '23:00').time(),
+                        lunch_start, lunch_end)
+            if len(_week_schedules) >= 1000:
+                _week_schedules.clear()
+            _week_schedules[signature] = schedule
+        return schedule
+
+    def getSlotGrid(self, d_from, d_to):
+        """
+        Lay out the scheduled (not yet checked for conflicts) slots for
+        each day from `d_from` through `d_to` as a `SlotGrid`.
+        """
+        grid = SlotGrid(self.getTimezoneObject(), self.prefs.interval)
+        schedule = self.getWeekSchedule()
+        d_start = self.prefs.first_day_scheduled or d_from
+        d_end = self.prefs.last_day_scheduled or d_to
+        d = max(d_from, d_start)
+        while d <= d_to and d <= d_end:
+            day_times = schedule.times[d.weekday()]
+            if day_times is not None:
+                grid.addDay(d, *day_times)
+            d += timedelta(days=1)
+        return grid
+
+    def markDeadlines(self, grid, now=None):
+        """
+        Set the deadline bit on every slot in `grid` that can't be booked
+        at `now`: all of them while booking is closed, otherwise the ones
+        starting within `minimum_notice_hours`.
+        """
+        if not grid.days:
+            return grid
+        now = now or datetime.now(pytz.utc)
+        last = grid.days[-1]
+        if not self.booking_is_available(now):
+            grid.markDeadline(grid.days[0].origin, last.origin + last.count * grid.step)
+        else:
+            grid.markDeadline(grid.days[0].origin,
+                now + timedelta(hours=self.prefs.minimum_notice_hours))
+        return grid
+
+    def validateSlot(self, dt_start, now=None):
+        """
+        Why the slot starting at `dt_start` (in our time zone) can't be
+        booked, or None if it looks bookable.  Checks the compiled schedule
+        and the booking window first, then the cached availability for that
+        week; the caller must still check live data with `isSlotFree`.
+        """
+        now = now or datetime.now(pytz.utc)
+        if not self.booking_is_available(now):
+            return 'This teacher is not taking bookings right now.'
+        d = dt_start.date()
+        t = dt_start.time()
+        if not self.getWeekSchedule().isScheduled(d, t):
+            return 'That is not one of this teacher\'s conference times.'
+        if dt_start < now + timedelta(hours=self.prefs.minimum_notice_hours):
+            return 'Bookings must be made at least %d hours ahead.' % self.prefs.minimum_notice_hours
+        monday = d - timedelta(days=d.weekday())
+        status = availability.getSlotGrid(self, monday, monday + timedelta(days=6)).statusAt(d, t)
+        if status == SLOT_BOOKED:
+            return 'Sorry, this time is already booked.'
+        if status == SLOT_BUSY:
+            return 'Sorry, the teacher is not available at this time.'
+        return None
+
     def getPossibleSlotsForDay(self, d):
-        slots = [ ]
-        tz = self.getTimezoneObject()
-        d_start = self.prefs.first_day_scheduled or d
-        d_end = self.prefs.last_day_scheduled or d
-        if d_start <= d and d <= d_end:
-            i = d.weekday()
-            day_prefs = self.days[i]
-            if day_prefs.enabled:
-                day_start = tz.localize(
-                    date_parser.parse(day_prefs.day_start_time or '04:00').replace(
-                    year=d.year, month=d.month, day=d.day))
-                day_end = tz.localize(
-                    date_parser.parse(day_prefs.day_end_time or '23:00').replace(
-                    year=d.year, month=d.month, day=d.day))
-                lunch_start = None
-                lunch_end = None
-                if day_prefs.lunch_start_time and day_prefs.lunch_end_time:
-                    lunch_start = tz.localize(
-                        date_parser.parse(day_prefs.lunch_start_time).replace(
-                        year=d.year, month=d.month, day=d.day))
-                    lunch_end = tz.localize(
-                        date_parser.parse(day_prefs.lunch_end_time).replace(
-                        year=d.year, month=d.month, day=d.day))
-                interval = timedelta(minutes=self.prefs.interval)
-                t_start = day_start
-                t_end = t_start + interval
-                while t_end <= day_end:
-                    if not lunch_start or (t_start >= lunch_end or t_end <= lunch_start):
-                        t_start_time = t_start.time()
-                        slots.append({ 'start': t_start, 'end': t_end, 'available': True })
-                    t_start = t_end
-                    t_end = t_start + interval
-        return slots
+        return self.getSlotGrid(d, d).toSlots()
 
     def getPossibleSlots(self, dt_from, dt_to):
-        all_slots = [ ]
-        d_from = dt_from.date()
-        d_to = dt_to.date()
-        d = d_from
-        while d <= d_to:
-            slots = self.getPossibleSlotsForDay(d)
-            all_slots += slots
-            d += timedelta(days=1)
-        return all_slots
+        return self.getSlotGrid(dt_from.date(), dt_to.date()).toSlots()
 
     def getSlotLimits(self, slots, available_only=True):
+        if isinstance(slots, SlotGrid):
+            return slots.getLimits(available_only)
         latest_day = None
         earliest_time = None
         latest_time = None
         dates = [ ]
         times = [ ]
         for s in slots:
-            if not available_only or s['available']:
-                d = s['start'].date()
-                t = s['start'].time()
+            if not available_only or s.available:
+                d = s.start.date()
+                t = s.start.time()
                 if latest_day is None or d != latest_day:
                     dates.append(d)
                     latest_day = d
@@ -208,35 +471,84 @@ class User(ndb.Model, UserMixin):
                 t += interval
         return { 'dates': dates, 'times': times }
 
-    def getAvailableSlots(self, dt_from=None, dt_to=None, calendar_id='primary'):
+    def watchCalendar(self, webhook_url, calendar_id='primary'):
+        """
+        Make sure Calendar will send change notifications for `calendar_id`
+        to `webhook_url`, opening a new channel when there is none or the
+        current one expires within a day.
+        """
+        renew_before = datetime.utcnow() + timedelta(days=1)
+        channels = WatchChannel.query(WatchChannel.user == self.key,
+            WatchChannel.calendar_id == calendar_id).fetch()
+        if any(c.expiration > renew_before for c in channels):
+            return None
+
+        cal_service = gapi.buildService('calendar', 'v3', self.authorizedHttp())
+        channel = WatchChannel(id=str(uuid.uuid4()), user=self.key, calendar_id=calendar_id,
+            token=binascii.hexlify(os.urandom(16)))
+        result = gapi.execute(cal_service.events().watch(calendarId=calendar_id, body={
+            'id': channel.key.id(),
+            'type': 'web_hook',
+            'address': webhook_url,
+            'token': channel.token,
+            'params': { 'ttl': str(WatchChannel.TTL_SECONDS) } }), self.key.id())
+        channel.resource_id = result['resourceId']
+        channel.expiration = datetime.utcfromtimestamp(int(result['expiration']) / 1000)
+        channel.put()
+
+        for previous in channels:
+            previous.stop(cal_service)
+        return channel
+
+    def getDefaultWindow(self):
         # Get some kind of date range
         d_today = date.today()
         day_offset = d_today.weekday()
         d_from = d_today - timedelta(days=day_offset)
         d_to = d_from + timedelta(days=35)
         tz = self.getTimezoneObject()
-        if dt_from is None:
-            if self.prefs.first_day_scheduled is not None:
-                d_from = self.prefs.first_day_scheduled
-            dt_from = tz.localize(
-                datetime(d_from.year, d_from.month, d_from.day, 0, 0, 0, 0))
-        if dt_to is None:
-            if self.prefs.last_day_scheduled is not None:
-                d_to = self.prefs.last_day_scheduled
-            dt_to = tz.localize(
-                datetime(d_to.year, d_to.month, d_to.day, 0, 0, 0, 0))
-
-        slots = self.getPossibleSlots(dt_from, dt_to)
-        busy_events = self.getBusyEvents(dt_from, dt_to, calendar_id)
-        for s in slots:
-            s['available'] = not conflict(s, busy_events)
-        return slots
+        if self.prefs.first_day_scheduled is not None:
+            d_from = self.prefs.first_day_scheduled
+        if self.prefs.last_day_scheduled is not None:
+            d_to = self.prefs.last_day_scheduled
+        dt_from = tz.localize(
+            datetime(d_from.year, d_from.month, d_from.day, 0, 0, 0, 0))
+        dt_to = tz.localize(
+            datetime(d_to.year, d_to.month, d_to.day, 0, 0, 0, 0))
+        return (dt_from, dt_to)
+
+    def getAvailableSlotGrid(self, dt_from=None, dt_to=None, calendar_ids=None):
+        default_from, default_to = self.getDefaultWindow()
+        dt_from = dt_from or default_from
+        dt_to = dt_to or default_to
+
+        grid = self.getSlotGrid(dt_from.date(), dt_to.date())
+        for dt_start, dt_end in self.getBusyEvents(dt_from, dt_to, calendar_ids):
+            grid.markBusy(dt_start, dt_end)
+        for b in Booking.getBookingsForResourceBetween(self, dt_from, dt_to + timedelta(days=1)):
+            grid.markBooked(pytz.utc.localize(b.start_time), pytz.utc.localize(b.end_time))
+        return grid
+
+    def getAvailableSlots(self, dt_from=None, dt_to=None, calendar_ids=None):
+        return self.getAvailableSlotGrid(dt_from, dt_to, calendar_ids).toSlots()
+
+    def isSlotFree(self, dt_start, dt_end, calendar_ids=None):
+        """
+        Check a slot against the datastore and Calendar directly, bypassing
+        every cache.  Used right before a booking is saved.
+        """
+        earliest = dt_start - timedelta(minutes=self.prefs.interval)
+        for b in Booking.getBookingsForResourceBetween(self, earliest, dt_end):
+            if pytz.utc.localize(b.end_time) > dt_start:
+                return False
+        return not self.fetchAllBusyEvents(dt_start, dt_end, 
+            calendar_ids or self.getBusyCalendarIds())
 
     @classmethod
     def getById(cls, user_id):
         try:
             key = ndb.Key('User', user_id)
-            return key.get()
+            return modelcache.get(key)
         except:
             return None
 
@@ -244,7 +556,9 @@ class User(ndb.Model, UserMixin):
     def getByUrlsafeId(cls, uid):
         try:
             key = ndb.Key(urlsafe=uid)
-            return key.get()
+            if key.kind() != 'User':
+                return None
+            return modelcache.get(key)
         except:
             return None
 
@@ -257,6 +571,93 @@ class User(ndb.Model, UserMixin):
                 users.append(user)
         return users
 
+    @classmethod
+    def search(cls, q, limit=20, page_size=100):
+        """
+        Bookable teachers whose name or location has a word starting with
+        each word of `q`, by last name, and whether more than `limit`
+        matched.  The query filters on the longest word and runs in last
+        name order a page of keys at a time, until `limit` teachers pass
+        the checks for the other words; the profiles come from the context
+        cache and memcache.  Returns (users, truncated).
+        """
+        terms = search.queryTerms(q)
+        if not terms:
+            return ([ ], False)
+        qry = User.query(User.auth_type == 'gafe', 
+            User.search_tokens == terms[0][:search.MAX_PREFIX]).order(User.last_name, User.first_name)
+        users = [ ]
+        cursor = None
+        more = True
+        while more and len(users) <= limit:
+            keys, cursor, more = qry.fetch_page(page_size, start_cursor=cursor, keys_only=True)
+            users.extend(user for user in ndb.get_multi(keys) if user is not None and 
+                user.booking_is_available() and search.matches(user.searchTexts(), terms))
+        return (users[:limit], len(users) > limit)
+
+    @classmethod
+    def reindexSearch(cls, cursor=None, page_size=100):
+        """
+        Re-save the users in one page whose search tokens are out of date,
+        or that still hold old OAuth tokens.  Returns (count, cursor, more).
+        """
+        keys, cursor, more = User.query().fetch_page(page_size, start_cursor=cursor, keys_only=True)
+        users = cls.updateMulti(keys, lambda user: None)
+        return (len(users), cursor, more)
+
+    @classmethod
+    def getTeachers(cls):
+        qry = User.query(User.auth_type == 'gafe').order(User.last_name)
+        return [user for user in qry if user.is_active]
+
+    @classmethod
+    def updateMulti(cls, keys, update):
+        """
+        Call `update(user)` for each of the User `keys` and save the ones
+        it changed with `put_multi`, BULK_BATCH_SIZE users to a
+        transaction.  `update` may run more than once if a transaction is
+        retried.  Caches that depend on the changed fields are dropped at
+        the end.  Returns the users that were saved.
+        """
+        updated = [ ]
+        for i in range(0, len(keys), BULK_BATCH_SIZE):
+            batch = keys[i:i + BULK_BATCH_SIZE]
+            def txn():
+                changes = [ ]
+                for user in ndb.get_multi(batch):
+                    if user is not None:
+                        state = user.getState()
+                        update(user)
+                        changes.append((user, user.changedFields(state)))
+                ndb.put_multi([user for user, changed in changes if changed])
+                return changes
+            changes = ndb.transaction(txn, xg=True)
+            metrics.incrMulti({ 
+                'user.writes': sum(1 for user, changed in changes if changed),
+                'user.writes_avoided': sum(1 for user, changed in changes if not changed) })
+            updated.extend((user, changed) for user, changed in changes if changed)
+        availability.invalidateMulti([user.key.id() for user, changed in updated 
+            if changed & AVAILABILITY_FIELDS])
+        feeds.invalidateMulti([('resource', user.key.id()) for user, changed in updated 
+            if changed & FEED_FIELDS])
+        return [user for user, changed in updated]
+
+    @classmethod
+    def getAvailabilityMatrix(cls, d_from, d_to, users=None):
+        """
+        An `AvailabilityMatrix` of every teacher (or just `users`) for the
+        local dates `d_from` through `d_to`.
+        """
+        if users is None:
+            users = cls.getTeachers()
+        # Bookings are stored in UTC; pad the window for time zone offsets
+        dt_from = datetime.combine(d_from - timedelta(days=1), datetime.min.time())
+        dt_to = datetime.combine(d_to + timedelta(days=2), datetime.min.time())
+        keys = set(user.key for user in users)
+        qry = Booking.query(Booking.start_time >= dt_from, Booking.start_time < dt_to)
+        bookings = [b for b in qry if b.canceled is None and b.resource in keys]
+        return AvailabilityMatrix.compute(users, d_from, d_to, bookings)
+
     @classmethod
     def findUserOrCreateKey(cls, auth_type, email):
         qry = User.query(User.auth_type == auth_type, User.email == email)
@@ -270,30 +671,36 @@ class User(ndb.Model, UserMixin):
         return (ndb.Key('User', new_id), True)
 
     @classmethod
-    def fromCredentials(cls, credentials):
-        http_auth = httplib2.Http(memcache)
-        credentials.authorize(http_auth)
-        plus_service = discovery.build('plus', 'v1', http=http_auth)
-        profile = plus_service.people().get(userId='me').execute()
+    def fromCredentials(cls, credentials, webhook_url=None):
+        plus_service = gapi.buildService('plus', 'v1', gapi.authorizedHttp(credentials))
+        profile = gapi.execute(plus_service.people().get(userId='me'))
         email = profile['emails'][0]['value'].lower()
         user = None
         user_or_key, create = cls.findUserOrCreateKey('gafe', email)
         if create:
-            user = User(key=user_or_key, credentials=credentials)
+            user = User(key=user_or_key)
             user.auth_type = 'gafe'
             user.email = email
             user.first_name = profile['name']['givenName']
             user.last_name = profile['name']['familyName']
             user.google_id = profile['id']
-            user.access_token = credentials.access_token
-            user.refresh_token = credentials.refresh_token
             user.prefs = user.defaultUserPrefs()
             user.days = user.defaultDayPrefs()
             user.put()
         else:
+            # Most logins change nothing on the User itself
             user = user_or_key
-            user.credentials = credentials
-            user.put()
+            state = user.getState()
+            user.credentials = None
+            user.putIfChanged(state)
+        gapi.LeasedStorage(UserCredentials, user.key.id()).put(credentials)
+        if webhook_url:
+            for calendar_id in user.getBusyCalendarIds():
+                try:
+                    user.watchCalendar(webhook_url, calendar_id)
+                except Exception as e:
+                    logging.warning('WATCH: could not watch calendar %s for %s: %s' % 
+                        (calendar_id, user.email, e))
         return (user, create)
 
 
@@ -304,13 +711,30 @@ class Event(ndb.Model):
     url = ndb.StringProperty()
 
 class Attendee(ndb.Model):
+    # As typed; bookings are looked up by the lowercased copy
     email = ndb.StringProperty()
+    email_lower = ndb.ComputedProperty(lambda self: self.email.lower() if self.email else None)
     phone = ndb.StringProperty()
     first_name = ndb.StringProperty()
     last_name = ndb.StringProperty()
     notes = ndb.StringProperty() # 1500 char limit
 
+class SlotTakenError(Exception):
+    pass
+
 class Booking(ndb.Model):
+    _use_memcache = True
+    _memcache_timeout = 600
+
+    # With ancestor keys (the ancestor_bookings setting), a booking is a
+    # child of its teacher's User, and an active booking's key name is its
+    # UTC start time, so a slot can hold only one.  Canceled bookings move
+    # to '<slot name>~<epoch milliseconds>' to free the slot.
+    ancestor_keys = False
+    SLOT_NAME_FORMAT = '%Y%m%dT%H%M'
+    # Set once no root bookings are left (see finishMigration)
+    _roots_migrated = False
+
     resource = ndb.KeyProperty(kind=User)
     title = ndb.StringProperty()
     organizer_name = ndb.StringProperty()
@@ -323,28 +747,89 @@ class Booking(ndb.Model):
     updated = ndb.DateTimeProperty(auto_now=True)
     reminded = ndb.DateTimeProperty()
     canceled = ndb.DateTimeProperty()
+    # The root key of a booking moved by migrateToAncestorKeys
+    moved_from = ndb.KeyProperty(indexed=False)
+
+    def _post_put_hook(self, future):
+        feeds.invalidateBookings([self])
+
+    def getLocalDate(self):
+        tz = pytz.timezone(self.timezone or 'UTC')
+        return pytz.utc.localize(self.start_time).astimezone(tz).date()
+
+    def counterNames(self):
+        d = self.getLocalDate()
+        return [Booking.teacherCounter(self.resource.id()), Booking.dayCounter(d),
+            Booking.teacherDayCounter(self.resource.id(), d)]
+
+    def isSlotKeyed(self):
+        return (self.key is not None and self.key.parent() is not None and 
+            '~' not in self.key.id())
+
+    def createdStamp(self):
+        # Creation time in epoch milliseconds, for archive keys
+        created = self.created or datetime.utcnow()
+        return to_epoch(pytz.utc.localize(created)) * 1000 + created.microsecond // 1000
+
+    def getArchiveKey(self, stamp=None):
+        # `stamp` is in epoch milliseconds
+        stamp = stamp or int(time.time() * 1000)
+        return ndb.Key(Booking, '%s~%d' % (self.start_time.strftime(Booking.SLOT_NAME_FORMAT), stamp),
+            parent=self.resource)
+
+    def putCounted(self):
+        """
+        Save a new booking and count it, in one transaction.  Raises
+        SlotTakenError if the booking is slot-keyed and the slot is taken.
+        """
+        def txn():
+            if self.isSlotKeyed() and self.key.get() is not None:
+                raise SlotTakenError()
+            self.put()
+            counters.increment(self.counterNames(), 1)
+        ndb.transaction(txn, xg=True)
+
+    def deleteCounted(self):
+        def txn():
+            self.key.delete()
+            if self.canceled is None:
+                counters.increment(self.counterNames(), -1)
+        ndb.transaction(txn, xg=True)
+        feeds.invalidateBookings([self])
 
     def sendReminder(self, credentials):
         pass
 
-    def createCalendarEvent(self, resource):
+    def getEventId(self):
+        # Our own event id (base32hex characters only) makes the insert safe
+        # to retry.  A slot-keyed booking's key is used again once it is
+        # canceled, and Calendar never takes an id twice, so the creation
+        # time (set by the first put) is part of it too
+        created = to_epoch(pytz.utc.localize(self.created)) * 1000000 + self.created.microsecond
+        return '%s%x' % (binascii.hexlify(self.key.urlsafe()), created)
+
+    @classmethod
+    def isLiveEvent(cls, event):
+        """
+        False for a Calendar event that has been deleted, which can't be
+        adopted by a booking whose insert conflicted.
+        """
+        return event.get('status') != 'cancelled'
+
+    def getEventBody(self, resource):
         description = render_template('event-description.txt', resource=resource, booking=self)
-        location = resource.prefs.location
         tz = pytz.timezone(self.timezone)
         start_time = pytz.utc.localize(self.start_time).astimezone(tz).isoformat()
         end_time = pytz.utc.localize(self.end_time).astimezone(tz).isoformat()
-        event_id = None
-        # event_id =  base64.b32encode(self.key.urlsafe()).rstrip('=').lower()
 
-        # logging.debug('CREATE EVENT id %r' % event_id)
         # logging.debug('CREATE EVENT start %s' % start_time)
         # logging.debug('CREATE EVENT end %s' %  end_time)
         # logging.debug('CREATE EVENT timezone %s' % self.timezone)
 
-        event = {
-            'id': event_id,
+        return {
+            'id': self.getEventId(),
             'summary': self.title,
-            'location': location,
+            'location': resource.prefs.location,
             'description': description,
             'start': {
                 'dateTime': start_time,
@@ -378,21 +863,34 @@ class Booking(ndb.Model):
             }
         }
 
-        # make calendar entry
-        http_auth = httplib2.Http(memcache)
-        resource.credentials.authorize(http_auth)
-        cal_service = discovery.build('calendar', 'v3', http=http_auth)
-
-        calendar = cal_service.calendars().get(calendarId='primary').execute()
-        new_event = cal_service.events().insert(
-            calendarId='primary', sendNotifications=True, body=event).execute()
-        
+    def setEvent(self, resource, calendar_id, new_event):
         self.event = Event()
-        self.event.location = location
-        self.event.calendar_id = calendar['id']
+        self.event.location = resource.prefs.location
+        self.event.calendar_id = calendar_id
         self.event.event_id = new_event['id']
         self.event.url = new_event['htmlLink']
 
+    def createCalendarEvent(self, resource):
+        event = self.getEventBody(resource)
+
+        # make calendar entry
+        cal_service = gapi.buildService('calendar', 'v3', resource.authorizedHttp())
+
+        user_id = resource.key.id()
+        calendar = gapi.execute(cal_service.calendars().get(calendarId='primary'), user_id)
+        try:
+            new_event = gapi.execute(cal_service.events().insert(
+                calendarId='primary', sendNotifications=True, body=event), user_id)
+        except Exception as e:
+            # An earlier attempt got through after all
+            if not gapi.isConflict(e):
+                raise
+            new_event = gapi.execute(cal_service.events().get(
+                calendarId='primary', eventId=event['id']), user_id)
+            if not Booking.isLiveEvent(new_event):
+                raise
+
+        self.setEvent(resource, calendar['id'], new_event)
         self.put()
 
     @classmethod
@@ -404,11 +902,12 @@ class Booking(ndb.Model):
         attendee.last_name = data['last_name']
         attendee.notes = data['notes']
 
-        booking = Booking(resource=resource.key, attendee=attendee)
-        booking.title = resource.prefs.title
-        booking.organizer_name = resource.prefs.display_name
         start_time_utc = date_parser.parse(data['start_time']).astimezone(pytz.utc).replace(tzinfo=None)
         end_time_utc = date_parser.parse(data['end_time']).astimezone(pytz.utc).replace(tzinfo=None)
+        booking = Booking(key=cls.newKey(resource.key, start_time_utc), 
+            resource=resource.key, attendee=attendee)
+        booking.title = resource.prefs.title
+        booking.organizer_name = resource.prefs.display_name
  
         # logging.debug('CREATE BOOKING start %s' % start_time_utc)
         # logging.debug('CREATE BOOKING end %s' % end_time_utc)
@@ -417,29 +916,327 @@ class Booking(ndb.Model):
         booking.start_time = start_time_utc
         booking.end_time = end_time_utc
         booking.timezone = data['timezone']
-        booking.put()
+        booking.putCounted()
 
         try:
             booking.createCalendarEvent(resource)
             # booking.sendReminder(credentials)
         except:
-            booking.key.delete()
+            booking.deleteCounted()
             booking = None
             raise
 
         return booking
 
+    @classmethod
+    def newKey(cls, resource_key, start_utc):
+        """
+        The key for a new booking: slot-keyed under the teacher with ancestor
+        keys, otherwise None (an automatic id).
+        """
+        if not cls.ancestor_keys:
+            return None
+        return ndb.Key(Booking, start_utc.strftime(cls.SLOT_NAME_FORMAT), parent=resource_key)
+
+    @classmethod
+    def rootsMigrated(cls):
+        if not cls._roots_migrated:
+            cls._roots_migrated = ndb.Key(BookingKeysMigration, 'done').get() is not None
+        return cls._roots_migrated
+
+    @classmethod
+    def queriesForResource(cls, resource_key):
+        """
+        The queries that together find all of a teacher's bookings.  With
+        ancestor keys that is a (strongly consistent) ancestor query, plus
+        a query by `resource` for bookings not moved under their teacher
+        yet, until finishMigration finds none left.
+        """
+        if not cls.ancestor_keys:
+            return [Booking.query(Booking.resource == resource_key)]
+        queries = [Booking.query(ancestor=resource_key)]
+        if not cls.rootsMigrated():
+            queries.append(Booking.query(Booking.resource == resource_key))
+        return queries
+
+    @classmethod
+    def fetchForResource(cls, resource_key, *filters):
+        """
+        A teacher's bookings matching `filters`, ordered by start time.
+        Root bookings found by the query by `resource` are read again by
+        key, which leaves out the ones moved or deleted since the query's
+        index was updated; the root copy of a booking moved while the
+        queries ran is left out by its `moved_from` key.
+        """
+        queries = [qry.filter(*filters) if filters else qry for qry in cls.queriesForResource(resource_key)]
+        roots = [ ]
+        if len(queries) > 1:
+            keys = [key for key in queries[1].fetch(keys_only=True) if key.parent() is None]
+            roots = [b for b in ndb.get_multi(keys) if b is not None]
+        bookings = queries[0].fetch()
+        if roots:
+            moved = set(b.moved_from for b in bookings if b.moved_from is not None)
+            bookings.extend(b for b in roots if b.key not in moved)
+        bookings.sort(key=lambda b: b.start_time)
+        return bookings
+
     @classmethod
     def getBookingsForResource(cls, resource):
-        qry = Booking.query(Booking.resource == resource.key).order(Booking.start_time)
-        return qry.fetch()
+        return cls.fetchForResource(resource.key)
+
+    @classmethod
+    def getBookingsForResourceBetween(cls, resource, dt_from, dt_to):
+        start_utc = dt_from.astimezone(pytz.utc).replace(tzinfo=None)
+        end_utc = dt_to.astimezone(pytz.utc).replace(tzinfo=None)
+        return [b for b in cls.fetchForResource(resource.key,
+            Booking.start_time >= start_utc, Booking.start_time < end_utc) if b.canceled is None]
+
+    @classmethod
+    def migrateToAncestorKeys(cls, cursor=None, page_size=100):
+        """
+        Move one page of root Booking entities under their teachers, with
+        slot-derived key names.  Canceled bookings, and an active booking
+        whose slot is already taken, get archive names instead, stamped
+        with their creation time and moved on by a millisecond while that
+        name is taken, so every root booking finds a key.  Each
+        transaction moves BULK_BATCH_SIZE // 2 bookings, since each move
+        touches the old and the new entity group.  Returns (moved, cursor,
+        more).
+        """
+        bookings, cursor, more = Booking.query().fetch_page(page_size, start_cursor=cursor)
+        roots = [b for b in bookings if b.key.parent() is None and b.resource is not None]
+        moved = 0
+        size = BULK_BATCH_SIZE // 2
+        for start in range(0, len(roots), size):
+            def txn(batch_keys=[b.key for b in roots[start:start + size]]):
+                # Fresh copies, so a retried transaction starts over
+                batch = [b for b in ndb.get_multi(batch_keys)
+                    if b is not None and b.key.parent() is None]
+                new_keys = [ ]
+                for b in batch:
+                    key = None
+                    if b.canceled is None:
+                        key = ndb.Key(Booking, b.start_time.strftime(Booking.SLOT_NAME_FORMAT), 
+                            parent=b.resource)
+                    if key is None or key in new_keys:
+                        key = b.getArchiveKey(b.createdStamp())
+                    new_keys.append(key)
+                for i, found in enumerate(ndb.get_multi(new_keys)):
+                    if found is None:
+                        continue
+                    stamp = batch[i].createdStamp()
+                    key = new_keys[i]
+                    while key in new_keys or key.get() is not None:
+                        key = batch[i].getArchiveKey(stamp)
+                        stamp += 1
+                    logging.info('MIGRATE: %s is taken, moving booking %s to %s' % 
+                        (new_keys[i], batch[i].key.urlsafe(), key))
+                    new_keys[i] = key
+                for b, key in zip(batch, new_keys):
+                    b.moved_from = b.key
+                    b.key = key
+                ndb.put_multi(batch)
+                ndb.delete_multi([b.moved_from for b in batch])
+                return len(batch)
+            moved += ndb.transaction(txn, xg=True)
+        return (moved, cursor, more)
+
+    @classmethod
+    def finishMigration(cls):
+        """
+        After migrateToAncestorKeys has been through every page: if no
+        root bookings are left, record that, so per-teacher lookups only
+        use the ancestor query from then on.  Returns the number left.
+        """
+        left = sum(1 for key in Booking.query().iter(keys_only=True) if key.parent() is None)
+        if not left:
+            BookingKeysMigration(id='done').put()
+            cls._roots_migrated = True
+        return left
+
+    @classmethod
+    def counterBatches(cls, bookings):
+        """
+        Split `bookings` into lists that can be written, along with one
+        shard of each of their counters, in a single transaction of at
+        most BULK_BATCH_SIZE entity groups.  Each booking is taken as its
+        own group, and brings up to three counters (see `counterNames`)
+        that the batch doesn't already touch.
+        """
+        batch = [ ]
+        names = set()
+        for b in bookings:
+            with_b = names.union(b.counterNames())
+            if batch and len(batch) + 1 + len(with_b) > BULK_BATCH_SIZE:
+                yield batch
+                batch = [ ]
+                with_b = set(b.counterNames())
+            batch.append(b)
+            names = with_b
+        if batch:
+            yield batch
+
+    @classmethod
+    def putMultiCounted(cls, bookings):
+        """
+        Save new `bookings` with `put_multi` and count them, as
+        `putCounted` does for one booking.  Slot-keyed bookings whose slot
+        is taken, in the datastore or by an earlier booking in the list,
+        are left out.  Returns the bookings saved.
+        """
+        saved = [ ]
+        for batch in cls.counterBatches(bookings):
+            def txn(batch=batch):
+                slot_keys = [b.key for b in batch if b.isSlotKeyed()]
+                taken = set(e.key for e in ndb.get_multi(slot_keys) if e is not None)
+                fresh = [ ]
+                for b in batch:
+                    if b.isSlotKeyed():
+                        if b.key in taken:
+                            continue
+                        taken.add(b.key)
+                    fresh.append(b)
+                batch = fresh
+                deltas = { }
+                for b in batch:
+                    for name in b.counterNames():
+                        deltas[name] = deltas.get(name, 0) + 1
+                ndb.put_multi(batch)
+                counters.incrementMulti(deltas)
+                return batch
+            saved.extend(ndb.transaction(txn, xg=True))
+        return saved
+
+    @classmethod
+    def cancelMulti(cls, bookings):
+        """
+        Mark `bookings` canceled with `put_multi` and stop counting them.
+        Each transaction takes as many bookings as fit in BULK_BATCH_SIZE
+        entity groups, counter shards included.  Returns the bookings that
+        were canceled now, not earlier; slot-keyed ones come back under
+        their new archive keys.  Calendar events are left alone; see
+        cancellations.py.
+        """
+        dt_now_utc = datetime.utcnow()
+        canceled = [ ]
+        for batch in cls.counterBatches(bookings):
+            def txn(batch=batch):
+                fresh = [b for b in ndb.get_multi([b.key for b in batch]) 
+                    if b is not None and b.canceled is None]
+                deltas = { }
+                freed = [ ]
+                for b in fresh:
+                    b.canceled = dt_now_utc
+                    for name in b.counterNames():
+                        deltas[name] = deltas.get(name, 0) - 1
+                    if b.isSlotKeyed():
+                        freed.append(b.key)
+                        b.key = b.getArchiveKey()
+                ndb.put_multi(fresh)
+                ndb.delete_multi(freed)
+                counters.incrementMulti(deltas)
+                return fresh
+            canceled.extend(ndb.transaction(txn, xg=True))
+        return canceled
+
+    @classmethod
+    def teacherCounter(cls, user_id):
+        return 'bookings:%s' % user_id
+
+    @classmethod
+    def dayCounter(cls, d):
+        return 'bookings-day:%s' % d.isoformat()
+
+    @classmethod
+    def teacherDayCounter(cls, user_id, d):
+        # `d` is the booking's local date, as for dayCounter
+        return 'bookings-teacher-day:%s:%s' % (user_id, d.isoformat())
+
+    @classmethod
+    def recount(cls):
+        """
+        Rebuild the booking counters from the Booking entities: the
+        all-time count per teacher, and the counts per day and per teacher
+        and day.
+        """
+        totals = { }
+        for b in Booking.query():
+            if b.canceled is None:
+                for name in b.counterNames():
+                    totals[name] = totals.get(name, 0) + 1
+        counters.reset(totals)
+        return totals
+
+    @classmethod
+    def queryForAttendeeEmail(cls, email):
+        return Booking.query(Booking.attendee.email_lower == email.lower()).order(Booking.start_time)
 
     @classmethod
     def getBookingsForAttendeeEmail(cls, email):
-        qry = Booking.query(Booking.attendee.email == email).order(Booking.start_time)
-        return qry.fetch()
+        return cls.queryForAttendeeEmail(email).fetch()
+
+    @classmethod
+    def reindexAttendeeEmails(cls, cursor=None, page_size=100):
+        """
+        Re-save one page of bookings, so the ones saved before
+        `Attendee.email_lower` existed are found by family email.  Each
+        transaction takes BULK_BATCH_SIZE bookings.  Returns (count,
+        cursor, more).
+        """
+        keys, cursor, more = Booking.query().fetch_page(page_size, start_cursor=cursor, keys_only=True)
+        count = 0
+        for start in range(0, len(keys), BULK_BATCH_SIZE):
+            def txn(batch_keys=keys[start:start + BULK_BATCH_SIZE]):
+                batch = [b for b in ndb.get_multi(batch_keys) if b is not None and b.attendee is not None]
+                ndb.put_multi(batch)
+                return len(batch)
+            count += ndb.transaction(txn, xg=True)
+        return (count, cursor, more)
+
+# Exists once every Booking has been moved under its teacher
+class BookingKeysMigration(ndb.Model):
+    finished = ndb.DateTimeProperty(auto_now_add=True)
+
+# Progress of a CSV booking import (see imports.py)
+class ImportJob(ndb.Model):
+    MAX_ERRORS = 200
+
+    filename = ndb.StringProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    rows = ndb.IntegerProperty(default=0)
+    imported = ndb.IntegerProperty(default=0)
+    events_created = ndb.IntegerProperty(default=0)
+    events_failed = ndb.IntegerProperty(default=0)
+    errors = ndb.StringProperty(repeated=True, indexed=False)
+
+    @property
+    def events_pending(self):
+        return self.imported - self.events_created - self.events_failed
+
+    def addErrors(self, errors):
+        room = self.MAX_ERRORS - len(self.errors)
+        if room > 0:
+            self.errors.extend(errors[:room])
+
+    @classmethod
+    def recordEvents(cls, job_id, created, failed, errors):
+        """
+        Add one task's results; tasks for the same job may run at once.
+        """
+        def txn():
+            job = cls.get_by_id(job_id)
+            if job is not None:
+                job.events_created += created
+                job.events_failed += failed
+                job.addErrors(errors)
+                job.put()
+        ndb.transaction(txn)
+
 
 class RemindersToken(ndb.Model):
+    _use_memcache = True
+    _memcache_timeout = 600
+
     email = ndb.StringProperty()
     created = ndb.DateTimeProperty(auto_now_add=True)
     expires = ndb.DateTimeProperty()
@@ -449,7 +1246,7 @@ class RemindersToken(ndb.Model):
         email = None
         try:
             key = ndb.Key(urlsafe=token)
-            reminders_token = key.get()
+            reminders_token = modelcache.get(key)
             email = reminders_token.email
             dt_now_utc = datetime.utcnow()
             if reminders_token.expires <= dt_now_utc:
@@ -492,3 +1289,84 @@ class RemindersToken(ndb.Model):
             body=body)
         message.send()
 
+
+# Calendar subscription feed tokens, keyed by the (random) token.  Unlike
+# RemindersToken these don't expire, since calendar clients keep polling
+# a subscription for the whole conference season.
+class FeedToken(ndb.Model):
+    # Polled by calendar clients every few minutes
+    _use_memcache = True
+    _memcache_timeout = 86400
+
+    resource = ndb.KeyProperty(kind=User)
+    email = ndb.StringProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def validateToken(cls, token):
+        try:
+            return modelcache.get(ndb.Key(FeedToken, token))
+        except:
+            return None
+
+    @classmethod
+    def getOrCreate(cls, resource=None, email=None):
+        """
+        The feed token for a teacher (`resource`) or a family (`email`).
+        """
+        if resource is not None:
+            qry = FeedToken.query(FeedToken.resource == resource.key)
+        else:
+            email = email.lower()
+            qry = FeedToken.query(FeedToken.email == email)
+        feed_token = qry.get()
+        if feed_token is None:
+            feed_token = FeedToken(id=binascii.hexlify(os.urandom(16)),
+                resource=resource.key if resource is not None else None, email=email)
+            feed_token.put()
+        return feed_token
+
+
+# Calendar push notification channels, keyed by channel id
+class WatchChannel(ndb.Model):
+    _use_memcache = True
+    _memcache_timeout = 3600
+
+    TTL_SECONDS = 7 * 86400
+
+    user = ndb.KeyProperty(kind=User)
+    calendar_id = ndb.StringProperty()
+    resource_id = ndb.StringProperty()
+    token = ndb.StringProperty()
+    expiration = ndb.DateTimeProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def stop(self, cal_service=None):
+        try:
+            if cal_service is None:
+                cal_service = gapi.buildService('calendar', 'v3', self.user.get().authorizedHttp())
+            gapi.execute(cal_service.channels().stop(body={ 
+                'id': self.key.id(), 'resourceId': self.resource_id }), self.user.id())
+        except Exception as e:
+            logging.info('WATCH: could not stop channel %s: %s' % (self.key.id(), e))
+        self.key.delete()
+
+    @classmethod
+    def getExpiring(cls, within=timedelta(days=1)):
+        qry = WatchChannel.query(WatchChannel.expiration < datetime.utcnow() + within)
+        return qry.fetch()
+
+    @classmethod
+    def handleNotification(cls, channel_id, token, state):
+        """
+        Process one push notification.  Returns the User key whose calendar
+        changed, or None if the notification was ignored.
+        """
+        channel = modelcache.get(ndb.Key(WatchChannel, channel_id)) if channel_id else None
+        if channel is None or channel.token != token:
+            logging.info('WATCH: ignoring notification for channel %r' % channel_id)
+            return None
+        if state == 'sync':
+            return None
+        availability.invalidate(channel.user.id())
+        return channel.user
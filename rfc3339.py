@@ -0,0 +1,30 @@
+"""
+Fast parsing of the fixed-format timestamps the Calendar API returns.
+
+Calendar always sends `dateTime` values as `YYYY-MM-DDTHH:MM:SS`, optionally
+followed by fractional seconds, then `Z` or a `+HH:MM`/`-HH:MM` offset.
+Slicing those fixed positions is much cheaper than `dateutil.parser.parse`,
+and we only need epoch seconds, never a datetime object.
+"""
+
+import calendar
+
+
+def parse_datetime(s):
+    """
+    Epoch seconds for an RFC 3339 date-time string.
+    """
+    seconds = calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]),
+        int(s[11:13]), int(s[14:16]), int(s[17:19]), 0, 0, 0))
+    if s[-1] in 'Zz':
+        return seconds
+    offset = int(s[-5:-3]) * 3600 + int(s[-2:]) * 60
+    if s[-6] == '-':
+        return seconds + offset
+    return seconds - offset
+
+def parse_date(s):
+    """
+    (year, month, day) for an RFC 3339 full-date string.
+    """
+    return (int(s[0:4]), int(s[5:7]), int(s[8:10]))
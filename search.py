@@ -0,0 +1,60 @@
+"""
+Prefix search tokens for type-ahead teacher search.
+
+Each word of a teacher's name and location is lowercased, stripped of
+accents and stored with all of its prefixes (up to MAX_PREFIX characters)
+in a repeated property.  A search is a keys-only query on the longest
+typed word in last name order, which uses the composite index on
+search_tokens and last_name in index.yaml (one entry per token); the
+other words are checked in memory.  Filtering on more than one word
+would need that property in the index once per word, and an index entry
+for every combination of a teacher's tokens.
+"""
+
+import re
+import unicodedata
+
+import six
+
+
+MAX_PREFIX = 12
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    if not text:
+        return u''
+    if not isinstance(text, six.text_type):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    return u''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+def words(text):
+    return _WORD.findall(normalize(text))
+
+def tokensFor(texts):
+    """
+    The sorted set of word prefixes in `texts`.
+    """
+    tokens = set()
+    for text in texts:
+        for word in words(text):
+            for n in range(1, min(len(word), MAX_PREFIX) + 1):
+                tokens.add(word[:n])
+    return sorted(tokens)
+
+def queryTerms(q):
+    """
+    The typed words of a search, longest first (the most selective filters).
+    """
+    return sorted(set(words(q)), key=len, reverse=True)
+
+def matches(texts, terms):
+    """
+    True if every term is a prefix of some word in `texts`.  Used for the
+    terms a query couldn't filter on: every word but the longest, and
+    characters beyond MAX_PREFIX.
+    """
+    all_words = [word for text in texts for word in words(text)]
+    return all(any(word.startswith(term) for word in all_words) for term in terms)
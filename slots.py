@@ -0,0 +1,360 @@
+"""
+Bitset representation of bookable slots.
+
+Every scheduled day is laid out on a grid of `interval`-minute cells that
+starts at that day's `day_start_time`.  Bit k of a day refers to the cell
+starting `k * interval` minutes after the origin, so a whole day of slots
+fits in one Python integer.  Each reason a slot can not be booked is kept
+in its own bit-plane, and a slot is available when
+
+    schedule & ~(busy | booked | deadline)
+
+has its bit set.  Conflict marking, limits and intersections are bit
+operations; individual `Slot` objects are only built by
+`SlotGrid.toSlots()` when somebody asks for them.
+
+Busy times are `BusyInterval` (start, end) tuples of epoch seconds.
+"""
+
+from bisect import bisect_right
+import calendar
+from collections import namedtuple
+import heapq
+from datetime import datetime, time as dt_time, timedelta
+
+
+# Flags for booking availabilty
+SLOT_AVAILABLE = 0
+SLOT_OFF_SCHEDULE = 1
+SLOT_BUSY = 2
+SLOT_BOOKED = 3
+
+# Additional flag if it's too early or late to book
+SLOT_DEADLINE = 8
+
+
+class Slot(object):
+    """
+    One bookable cell: tz-aware `start` and `end` datetimes and whether it
+    is `available`.  Reads like the `{'start', 'end', 'available'}` dicts
+    it replaces (`slot['start']`, `slot.get('available')`), so templates
+    can use either form.
+
+    With __slots__ a Slot is 72 bytes against 280 for the dict (CPython
+    2.7, 64 bit).  For the admin matrix use case of 80 teachers over a
+    35-day window (34,000 20-minute slots) that is 7.1 MB less, 6.0 MB
+    instead of 13.1 MB with the datetimes; see benchmarks/slot_memory.py.
+    """
+
+    __slots__ = ('start', 'end', 'available')
+
+    def __init__(self, start, end, available):
+        self.start = start
+        self.end = end
+        self.available = available
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return 'Slot(%r, %r, %r)' % (self.start, self.end, self.available)
+
+
+# A busy time from a calendar, as epoch seconds.  A plain tuple underneath
+# (no per-instance dict), so it sorts, merges and unpacks like one.  The
+# 6,000 busy times of the matrix use case above take 0.8 MB, against 22.5 MB
+# as event resources with datetimes added.
+BusyInterval = namedtuple('BusyInterval', ['start', 'end'])
+
+
+def to_epoch(dt):
+    """
+    Seconds since the epoch for a tz-aware datetime (or pass an int through).
+    """
+    if isinstance(dt, datetime):
+        return calendar.timegm(dt.utctimetuple())
+    return int(dt)
+
+
+def minute_of_day(t):
+    return t.hour * 60 + t.minute
+
+
+def lowest_bit(mask):
+    return (mask & -mask).bit_length() - 1
+
+
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def merge_intervals(*streams):
+    """
+    Lazily merge streams of (start, end) intervals, each already ordered
+    by start, into one ordered stream of `BusyInterval`s.  Intervals that
+    overlap or touch are joined, so only the merged busy set is ever held
+    in memory.
+    """
+    current_start = current_end = None
+    for start, end in heapq.merge(*streams):
+        if current_start is None:
+            current_start, current_end = start, end
+        elif start <= current_end:
+            if end > current_end:
+                current_end = end
+        else:
+            yield BusyInterval(current_start, current_end)
+            current_start, current_end = start, end
+    if current_start is not None:
+        yield BusyInterval(current_start, current_end)
+
+
+class WeekSchedule(object):
+    """
+    A teacher's weekly `DayPrefs` compiled once into plain numbers: for each
+    weekday (Monday is 0) the parsed day and lunch times, the minute of day
+    of the first cell, the cell count and the mask of cells outside lunch.
+    `isScheduled` is then a few integer operations, with no parsing and no
+    grid to build.
+    """
+    __slots__ = ('interval', 'first_day', 'last_day', 'times', 'start_minutes', 'masks')
+
+    def __init__(self, interval, first_day=None, last_day=None):
+        self.interval = interval
+        self.first_day = first_day
+        self.last_day = last_day
+        self.times = [None] * 7
+        self.start_minutes = [0] * 7
+        self.masks = [0] * 7
+
+    def setDay(self, weekday, day_start, day_end, lunch_start=None, lunch_end=None):
+        self.times[weekday] = (day_start, day_end, lunch_start, lunch_end)
+        start = minute_of_day(day_start)
+        count = max((minute_of_day(day_end) - start) // self.interval, 0)
+        mask = (1 << count) - 1
+        if lunch_start and lunch_end:
+            # Cells that overlap lunch, as in `SlotGrid.addDay`
+            lo = max((minute_of_day(lunch_start) - start) // self.interval, 0)
+            hi = min(-((start - minute_of_day(lunch_end)) // self.interval), count)
+            if hi > lo:
+                mask &= ~(((1 << (hi - lo)) - 1) << lo)
+        self.start_minutes[weekday] = start
+        self.masks[weekday] = mask
+
+    def isScheduled(self, d, t):
+        """
+        Whether a slot starts at local date `d`, time `t`.
+        """
+        if self.first_day is not None and d < self.first_day:
+            return False
+        if self.last_day is not None and d > self.last_day:
+            return False
+        weekday = d.weekday()
+        k, rem = divmod(minute_of_day(t) - self.start_minutes[weekday], self.interval)
+        if rem or t.second or t.microsecond or k < 0:
+            return False
+        return bool(self.masks[weekday] & (1 << k))
+
+
+class DaySlots(object):
+    """
+    The bit-planes for a single day.  `origin` is the epoch second of bit 0,
+    `start_minute` the same instant as minutes after local midnight.
+    """
+    __slots__ = ('date', 'origin', 'start_minute', 'count',
+        'schedule', 'busy', 'booked', 'deadline')
+
+    def __init__(self, d, origin, start_minute, count, schedule=0):
+        self.date = d
+        self.origin = origin
+        self.start_minute = start_minute
+        self.count = count
+        self.schedule = schedule
+        self.busy = 0
+        self.booked = 0
+        self.deadline = 0
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @property
+    def available(self):
+        return self.schedule & ~(self.busy | self.booked | self.deadline)
+
+    def status(self, k):
+        bit = 1 << k
+        if not self.schedule & bit:
+            return SLOT_OFF_SCHEDULE
+        status = SLOT_AVAILABLE
+        if self.booked & bit:
+            status = SLOT_BOOKED
+        elif self.busy & bit:
+            status = SLOT_BUSY
+        if self.deadline & bit:
+            status |= SLOT_DEADLINE
+        return status
+
+
+class SlotGrid(object):
+    """
+    An ordered collection of `DaySlots` sharing a time zone and interval.
+    """
+
+    def __init__(self, tz, interval):
+        self.tz = tz
+        self.interval = interval
+        self.step = interval * 60
+        self.days = [ ]
+        self._origins = [ ]
+        self._by_date = { }
+
+    def addDay(self, d, day_start, day_end, lunch_start=None, lunch_end=None):
+        """
+        Lay out the cells for date `d` from `day_start` until `day_end`
+        (both `datetime.time`), leaving out cells that overlap lunch.
+        """
+        origin = to_epoch(self.tz.localize(datetime.combine(d, day_start)))
+        end = to_epoch(self.tz.localize(datetime.combine(d, day_end)))
+        count = (end - origin) // self.step
+        if count <= 0:
+            return None
+        day = DaySlots(d, origin, minute_of_day(day_start), count, (1 << count) - 1)
+        if lunch_start and lunch_end:
+            day.schedule &= ~self._span(day,
+                to_epoch(self.tz.localize(datetime.combine(d, lunch_start))),
+                to_epoch(self.tz.localize(datetime.combine(d, lunch_end))))
+        self.days.append(day)
+        self._origins.append(origin)
+        self._by_date[d] = day
+        return day
+
+    def getDay(self, d):
+        return self._by_date.get(d)
+
+    def _span(self, day, start, end):
+        """
+        Mask of the cells in `day` that overlap the half-open epoch
+        interval [start, end).
+        """
+        lo = max((start - day.origin) // self.step, 0)
+        hi = min(-((day.origin - end) // self.step), day.count)
+        if hi <= lo:
+            return 0
+        return ((1 << (hi - lo)) - 1) << lo
+
+    def _mark(self, plane, start, end):
+        start = to_epoch(start)
+        end = to_epoch(end)
+        i = max(bisect_right(self._origins, start) - 1, 0)
+        while i < len(self.days):
+            day = self.days[i]
+            if day.origin >= end:
+                break
+            mask = self._span(day, start, end)
+            if mask:
+                setattr(day, plane, getattr(day, plane) | mask)
+            i += 1
+
+    def markBusy(self, start, end):
+        self._mark('busy', start, end)
+
+    def markBooked(self, start, end):
+        self._mark('booked', start, end)
+
+    def markDeadline(self, start, end):
+        self._mark('deadline', start, end)
+
+    def _locate(self, d, t):
+        day = self._by_date.get(d)
+        if day is None:
+            return (None, None)
+        offset = minute_of_day(t) - day.start_minute
+        k, rem = divmod(offset, self.interval)
+        if rem or k < 0 or k >= day.count:
+            return (day, None)
+        return (day, k)
+
+    def statusAt(self, d, t):
+        """
+        The `SLOT_*` status of the cell starting at local date `d`, time `t`.
+        """
+        day, k = self._locate(d, t)
+        if k is None:
+            return SLOT_OFF_SCHEDULE
+        return day.status(k)
+
+    def isAvailable(self, d, t):
+        day, k = self._locate(d, t)
+        return k is not None and bool(day.available & (1 << k))
+
+    def getLimits(self, available_only=True):
+        """
+        Same result as `User.getSlotLimits`: the dates that have any
+        (available) slot, and the times of day from the earliest to the
+        latest (available) slot start.
+        """
+        dates = [ ]
+        times = [ ]
+        earliest = None
+        latest = None
+        for day in self.days:
+            mask = day.available if available_only else day.schedule
+            if mask:
+                dates.append(day.date)
+                first = day.start_minute + lowest_bit(mask) * self.interval
+                last = day.start_minute + (mask.bit_length() - 1) * self.interval
+                if earliest is None or first < earliest:
+                    earliest = first
+                if latest is None or last > latest:
+                    latest = last
+        if dates:
+            for m in range(earliest, latest + 1, self.interval):
+                times.append(dt_time(m // 60, m % 60))
+        return { 'dates': dates, 'times': times }
+
+    def intersect(self, other):
+        """
+        A new grid whose available cells are the ones available in both
+        grids.  Days are matched by date and must share the same origin.
+        """
+        grid = SlotGrid(self.tz, self.interval)
+        for day in self.days:
+            other_day = other.getDay(day.date)
+            if other_day is None or other_day.origin != day.origin:
+                continue
+            both = DaySlots(day.date, day.origin, day.start_minute,
+                min(day.count, other_day.count), day.available & other_day.available)
+            grid.days.append(both)
+            grid._origins.append(both.origin)
+            grid._by_date[both.date] = both
+        return grid
+
+    def toSlots(self):
+        """
+        Materialize the scheduled cells as a list of `Slot`s.
+        """
+        slots = [ ]
+        interval = timedelta(minutes=self.interval)
+        for day in self.days:
+            midnight = datetime.combine(day.date, dt_time())
+            available = day.available
+            for k in iter_bits(day.schedule):
+                t_start = self.tz.localize(midnight +
+                    timedelta(minutes=day.start_minute + k * self.interval))
+                slots.append(Slot(t_start, t_start + interval, bool(available & (1 << k))))
+        return slots
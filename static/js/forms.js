@@ -0,0 +1,5 @@
+// Polyfill date inputs for browsers without them
+webshims.setOptions('basePath', '/static/js/js-webshim-1.15.10/shims/');
+webshims.setOptions('waitReady', false);
+webshims.setOptions('forms-ext', {types: 'date'});
+webshims.polyfill('forms forms-ext');
@@ -67,7 +67,6 @@ else:
     from _ssl import SSLError as sslerror
     from _ssl import \
          RAND_add, \
-         RAND_egd, \
          RAND_status, \
          SSL_ERROR_ZERO_RETURN, \
          SSL_ERROR_WANT_READ, \
@@ -78,14 +77,14 @@ else:
          SSL_ERROR_WANT_CONNECT, \
          SSL_ERROR_EOF, \
          SSL_ERROR_INVALID_ERROR_CODE
+    try:
+        from _ssl import RAND_egd
+    except ImportError:
+        # LibreSSL and OpenSSL 1.1 don't provide RAND_egd
+        pass
 
 import os, sys, warnings
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
 try:
     import errno
 except ImportError:
@@ -240,8 +239,8 @@ class _fileobject(object):
 
     __slots__ = ["mode", "bufsize", "softspace",
                  # "closed" is a property, see below
-                 "_sock", "_rbufsize", "_wbufsize", "_rbuf", "_wbuf", "_wbuf_len",
-                 "_close"]
+                 "_sock", "_rbufsize", "_wbufsize", "_rbuf", "_rstart", "_rend",
+                 "_wbuf", "_wbuf_len", "_close"]
 
     def __init__(self, sock, mode='rb', bufsize=-1, close=False):
         self._sock = sock
@@ -260,11 +259,12 @@ class _fileobject(object):
         else:
             self._rbufsize = bufsize
         self._wbufsize = bufsize
-        # We use StringIO for the read buffer to avoid holding a list
-        # of variously sized string objects which have been known to
-        # fragment the heap due to how they are malloc()ed and often
-        # realloc()ed down much smaller than their original allocation.
-        self._rbuf = StringIO()
+        # The read buffer is a bytearray that recv_into() writes to
+        # directly; the unread bytes are _rbuf[_rstart:_rend].  Each
+        # string returned is copied out of it once, without the
+        # intermediate strings and StringIO copies of the stock version.
+        self._rbuf = bytearray()
+        self._rstart = self._rend = 0
         self._wbuf = [] # A list of strings
         self._wbuf_len = 0
         self._close = close
@@ -333,180 +333,181 @@ class _fileobject(object):
             self._wbuf_len >= self._wbufsize):
             self.flush()
 
+    def _recv_into(self, view):
+        """
+        recv() into `view`, retrying on EINTR.  Returns the number of
+        bytes received, 0 at EOF.
+        """
+        recv_into = getattr(self._sock, 'recv_into', None)
+        while True:
+            try:
+                if recv_into is not None:
+                    return recv_into(view)
+                # Socket-like objects without recv_into
+                data = self._sock.recv(len(view))
+                view[:len(data)] = data
+                return len(data)
+            except error, e:
+                if e.args[0] == EINTR:
+                    continue
+                raise
+
+    def _reserve(self, n):
+        """
+        Make room for `n` more bytes after the unread ones: move them to
+        the front, and grow the buffer (at least doubling it) in place if
+        that isn't enough.
+        """
+        buf = self._rbuf
+        start, end = self._rstart, self._rend
+        if end + n > len(buf):
+            if start == end:
+                # Nothing unread; a new buffer is cheaper than growing this one
+                self._rbuf = bytearray(max(n, len(buf)))
+                self._rstart = self._rend = 0
+                return
+            if start:
+                del buf[:start]
+                self._rstart, self._rend = 0, end - start
+                end -= start
+            if end + n > len(buf):
+                buf += '\0' * max(end + n - len(buf), len(buf))
+
+    def _fill(self, n):
+        """
+        Receive up to `n` more bytes onto the end of the read buffer.
+        Returns the number of bytes received.
+        """
+        end = self._rend
+        if end + n > len(self._rbuf):
+            self._reserve(n)
+            end = self._rend
+        view = memoryview(self._rbuf)[end:end + n]
+        try:
+            received = self._recv_into(view)
+        finally:
+            # The buffer can't be resized while a view of it exists
+            del view
+        self._rend = end + received
+        return received
+
+    def _take(self, n):
+        """
+        Remove the first `n` buffered bytes and return them as a string.
+        """
+        start = self._rstart
+        if n < 65536:
+            # Slicing is quicker than a memoryview for short strings,
+            # although it copies twice
+            data = str(self._rbuf[start:start + n])
+        else:
+            data = memoryview(self._rbuf)[start:start + n].tobytes()
+        self._rstart = start + n
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+            # Don't hold on to the room made for one large read
+            if len(self._rbuf) > 4 * max(self._rbufsize, self.default_bufsize):
+                self._rbuf = bytearray()
+        return data
+
     def read(self, size=-1):
         # Use max, disallow tiny reads in a loop as they are very inefficient.
         # We never leave read() with any leftover data from a new recv() call
         # in our internal buffer.
         rbufsize = max(self._rbufsize, self.default_bufsize)
-        # Our use of StringIO rather than lists of string objects returned by
-        # recv() minimizes memory usage and fragmentation that occurs when
-        # rbufsize is large compared to the typical return value of recv().
-        buf = self._rbuf
-        buf.seek(0, 2)  # seek end
         if size < 0:
-            # Read until EOF
-            self._rbuf = StringIO()  # reset _rbuf.  we consume it via buf.
+            # Read until EOF.  The length isn't known, so receive into one
+            # reused chunk and append it to what's unread.
+            buf = self._rbuf[self._rstart:self._rend]
+            self._rbuf = bytearray()
+            self._rstart = self._rend = 0
+            chunk = bytearray(rbufsize)
             while True:
-                try:
-                    data = self._sock.recv(rbufsize)
-                except error, e:
-                    if e.args[0] == EINTR:
-                        continue
-                    raise
-                if not data:
+                n = self._recv_into(chunk)
+                if not n:
                     break
-                buf.write(data)
-            return buf.getvalue()
-        else:
-            # Read until size bytes or EOF seen, whichever comes first
-            buf_len = buf.tell()
-            if buf_len >= size:
-                # Already have size bytes in our buffer?  Extract and return.
-                buf.seek(0)
-                rv = buf.read(size)
-                self._rbuf = StringIO()
-                self._rbuf.write(buf.read())
-                return rv
-
-            self._rbuf = StringIO()  # reset _rbuf.  we consume it via buf.
+                buf += chunk if n == rbufsize else chunk[:n]
+            return str(buf)
+        # Read until size bytes or EOF seen, whichever comes first.  Only
+        # ask for what is missing, and receive straight into the buffer.
+        buffered = self._rend - self._rstart
+        if not buffered and size:
+            # Shortcut.  A first recv() that returns everything is
+            # returned as is, without a copy through the buffer.
             while True:
-                left = size - buf_len
-                # recv() will malloc the amount of memory given as its
-                # parameter even though it often returns much less data
-                # than that.  The returned data string is short lived
-                # as we copy it into a StringIO and free it.  This avoids
-                # fragmentation issues on many platforms.
                 try:
-                    data = self._sock.recv(left)
+                    data = self._sock.recv(size)
                 except error, e:
                     if e.args[0] == EINTR:
                         continue
                     raise
-                if not data:
-                    break
-                n = len(data)
-                if n == size and not buf_len:
-                    # Shortcut.  Avoid buffer data copies when:
-                    # - We have no data in our buffer.
-                    # AND
-                    # - Our call to recv returned exactly the
-                    #   number of bytes we were asked to read.
-                    return data
-                if n == left:
-                    buf.write(data)
-                    del data  # explicit free
-                    break
-                assert n <= left, "recv(%d) returned %d bytes" % (left, n)
-                buf.write(data)
-                buf_len += n
-                del data  # explicit free
-                #assert buf_len == buf.tell()
-            return buf.getvalue()
+                break
+            if len(data) == size or not data:
+                return data
+            self._reserve(size)
+            self._rbuf[:len(data)] = data
+            self._rend = buffered = len(data)
+            del data  # explicit free
+        while buffered < size:
+            n = self._fill(size - buffered)
+            if not n:
+                break
+            buffered += n
+        return self._take(min(size, buffered))
 
     def readline(self, size=-1):
-        buf = self._rbuf
-        buf.seek(0, 2)  # seek end
-        if buf.tell() > 0:
-            # check if we already have it in our buffer
-            buf.seek(0)
-            bline = buf.readline(size)
-            if bline.endswith('\n') or len(bline) == size:
-                self._rbuf = StringIO()
-                self._rbuf.write(buf.read())
-                return bline
-            del bline
-        if size < 0:
-            # Read until \n or EOF, whichever comes first
+        # Read until size bytes or \n or EOF seen, whichever comes first.
+        # Unbuffered files receive one byte at a time, so nothing past the
+        # newline is taken from the socket.
+        scanned = 0
+        while True:
+            start, end = self._rstart, self._rend
+            limit = end if size < 0 else min(end, start + size)
+            nl = self._rbuf.find('\n', start + scanned, limit)
+            if nl >= 0:
+                return self._take(nl + 1 - start)
+            if size >= 0 and end - start >= size:
+                return self._take(size)
+            scanned = limit - start
             if self._rbufsize <= 1:
-                # Speed up unbuffered case
-                buf.seek(0)
-                buffers = [buf.read()]
-                self._rbuf = StringIO()  # reset _rbuf.  we consume it via buf.
-                data = None
-                recv = self._sock.recv
-                while True:
-                    try:
-                        while data != "\n":
-                            data = recv(1)
-                            if not data:
-                                break
-                            buffers.append(data)
-                    except error, e:
-                        # The try..except to catch EINTR was moved outside the
-                        # recv loop to avoid the per byte overhead.
-                        if e.args[0] == EINTR:
-                            continue
-                        raise
-                    break
-                return "".join(buffers)
-
-            buf.seek(0, 2)  # seek end
-            self._rbuf = StringIO()  # reset _rbuf.  we consume it via buf.
-            while True:
-                try:
-                    data = self._sock.recv(self._rbufsize)
-                except error, e:
-                    if e.args[0] == EINTR:
-                        continue
-                    raise
-                if not data:
-                    break
-                nl = data.find('\n')
-                if nl >= 0:
-                    nl += 1
-                    buf.write(data[:nl])
-                    self._rbuf.write(data[nl:])
-                    del data
-                    break
-                buf.write(data)
-            return buf.getvalue()
-        else:
-            # Read until size bytes or \n or EOF seen, whichever comes first
-            buf.seek(0, 2)  # seek end
-            buf_len = buf.tell()
-            if buf_len >= size:
-                buf.seek(0)
-                rv = buf.read(size)
-                self._rbuf = StringIO()
-                self._rbuf.write(buf.read())
-                return rv
-            self._rbuf = StringIO()  # reset _rbuf.  we consume it via buf.
-            while True:
-                try:
-                    data = self._sock.recv(self._rbufsize)
-                except error, e:
-                    if e.args[0] == EINTR:
-                        continue
-                    raise
-                if not data:
-                    break
-                left = size - buf_len
-                # did we just receive a newline?
-                nl = data.find('\n', 0, left)
-                if nl >= 0:
-                    nl += 1
-                    # save the excess data to _rbuf
-                    self._rbuf.write(data[nl:])
-                    if buf_len:
-                        buf.write(data[:nl])
-                        break
-                    else:
-                        # Shortcut.  Avoid data copy through buf when returning
-                        # a substring of our first recv().
-                        return data[:nl]
-                n = len(data)
-                if n == size and not buf_len:
-                    # Shortcut.  Avoid data copy through buf when
-                    # returning exactly all of our first recv().
-                    return data
-                if n >= left:
-                    buf.write(data[:left])
-                    self._rbuf.write(data[left:])
-                    break
-                buf.write(data)
-                buf_len += n
-                #assert buf_len == buf.tell()
-            return buf.getvalue()
+                return self._readline_unbuffered(size)
+            n = self._fill(self._rbufsize)
+            if not n:
+                return self._take(self._rend - self._rstart)
+
+    def _readline_unbuffered(self, size):
+        """
+        The rest of readline() for unbuffered files, which holds no newline
+        in its buffer: one recv(1) at a time, without the per-byte overhead
+        of going through the buffer.
+        """
+        line = self._rbuf[self._rstart:self._rend]
+        self._rbuf = bytearray()
+        self._rstart = self._rend = 0
+        recv = self._sock.recv
+        data = None
+        while True:
+            try:
+                if size < 0:
+                    while data != "\n":
+                        data = recv(1)
+                        if not data:
+                            break
+                        line += data
+                else:
+                    while data != "\n" and len(line) < size:
+                        data = recv(1)
+                        if not data:
+                            break
+                        line += data
+            except error, e:
+                # The try..except to catch EINTR is outside the recv loop
+                # to avoid the per byte overhead.
+                if e.args[0] == EINTR:
+                    continue
+                raise
+            break
+        return str(line)
 
     def readlines(self, sizehint=0):
         total = 0
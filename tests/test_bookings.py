@@ -0,0 +1,311 @@
+from datetime import date, datetime, timedelta
+import unittest
+
+import pytz
+
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+from tests import testing
+import counters
+from models import BULK_BATCH_SIZE, Attendee, Booking, BookingKeysMigration, SlotTakenError, User
+
+
+START = datetime(2030, 3, 4, 16, 0)
+
+
+class BookingTestCase(testing.ServiceTestCase):
+
+    def setUp(self):
+        super(BookingTestCase, self).setUp()
+        self.teacher = self.makeTeacher('teacher')
+
+    def tearDown(self):
+        Booking.ancestor_keys = False
+        Booking._roots_migrated = False
+        super(BookingTestCase, self).tearDown()
+
+    def makeTeacher(self, user_id):
+        user = User(id=user_id, email='%s@example.org' % user_id, first_name='Pat', last_name=user_id)
+        user.prefs = user.defaultUserPrefs()
+        user.days = user.defaultDayPrefs()
+        user.put()
+        return user
+
+    def makeBooking(self, start=START, email='jane@example.com', key=None, resource=None):
+        resource = resource or self.teacher
+        booking = Booking(key=key, resource=resource.key, attendee=Attendee(email=email,
+            first_name='Jane', last_name='Doe'))
+        booking.start_time = start
+        booking.end_time = start + timedelta(minutes=20)
+        booking.timezone = 'UTC'
+        return booking
+
+    def makeRoots(self, teachers, count):
+        # Saved before ancestor keys were turned on
+        roots = [ ]
+        for i in range(count):
+            booking = self.makeBooking(START + timedelta(minutes=20 * i), resource=teachers[i % len(teachers)])
+            booking.putCounted()
+            roots.append(booking)
+        return roots
+
+
+class AttendeeEmailTest(BookingTestCase):
+
+    def test_found_without_regard_to_case(self):
+        self.makeBooking(email='Jane@Example.com').put()
+        self.makeBooking(START + timedelta(hours=1), email='jane@example.com').put()
+        self.makeBooking(START + timedelta(hours=2), email='other@example.com').put()
+        for email in ('jane@example.com', 'JANE@EXAMPLE.COM'):
+            bookings = Booking.getBookingsForAttendeeEmail(email)
+            self.assertEqual([b.start_time for b in bookings], [START, START + timedelta(hours=1)])
+        self.assertEqual(bookings[0].attendee.email, 'Jane@Example.com')
+
+    def test_reindex_finds_older_bookings(self):
+        # Saved before Attendee.email_lower existed
+        entity = datastore.Entity('Booking')
+        entity.update({ 'resource': self.teacher.key.to_old_key(),
+            'attendee.email': 'Jane@Example.com', 'attendee.first_name': 'Jane',
+            'start_time': START, 'end_time': START + timedelta(minutes=20) })
+        datastore.Put(entity)
+        self.makeBooking(START + timedelta(hours=1)).put()
+        self.assertEqual(len(Booking.getBookingsForAttendeeEmail('jane@example.com')), 1)
+
+        count, cursor, more = Booking.reindexAttendeeEmails(page_size=1)
+        self.assertEqual(count, 1)
+        while more:
+            count, cursor, more = Booking.reindexAttendeeEmails(cursor, page_size=1)
+        bookings = Booking.getBookingsForAttendeeEmail('jane@example.com')
+        self.assertEqual([b.start_time for b in bookings], [START, START + timedelta(hours=1)])
+
+
+class CounterTest(BookingTestCase):
+
+    def test_counter_names(self):
+        booking = self.makeBooking(datetime(2030, 3, 5, 6, 0))
+        booking.timezone = 'America/Los_Angeles'
+        self.assertEqual(booking.counterNames(), [Booking.teacherCounter('teacher'),
+            Booking.dayCounter(date(2030, 3, 4)), Booking.teacherDayCounter('teacher', date(2030, 3, 4))])
+
+    def test_counted_and_recounted(self):
+        other = self.makeTeacher('other')
+        self.makeBooking().putCounted()
+        self.makeBooking(START + timedelta(hours=1)).putCounted()
+        self.makeBooking(START + timedelta(days=1)).putCounted()
+        Booking.putMultiCounted([self.makeBooking(START, resource=other)])
+        d = START.date()
+        names = [Booking.teacherCounter('teacher'), Booking.dayCounter(d),
+            Booking.teacherDayCounter('teacher', d), Booking.teacherDayCounter('other', d),
+            Booking.teacherDayCounter('teacher', d + timedelta(days=1))]
+        expected = dict(zip(names, [3, 3, 2, 1, 1]))
+        self.assertEqual(counters.getCounts(names), expected)
+
+        Booking.cancelMulti([b for b in Booking.query() if b.resource == other.key])
+        expected[Booking.dayCounter(d)] = 2
+        expected[Booking.teacherDayCounter('other', d)] = 0
+        self.assertEqual(counters.getCounts(names), expected)
+
+        totals = Booking.recount()
+        self.assertEqual(len(totals), 5)
+        self.assertEqual(counters.getCounts(names), expected)
+
+    def test_batches_fit_a_transaction(self):
+        teachers = [self.makeTeacher('t%d' % i) for i in range(4)]
+        bookings = [self.makeBooking(START + timedelta(days=i // 8, minutes=20 * i),
+            resource=teachers[i % 4]) for i in range(40)]
+        batches = list(Booking.counterBatches(bookings))
+        self.assertEqual(sum(len(batch) for batch in batches), 40)
+        for batch in batches:
+            names = set()
+            for b in batch:
+                names.update(b.counterNames())
+            self.assertTrue(len(batch) + len(names) <= BULK_BATCH_SIZE)
+        saved = Booking.putMultiCounted(bookings)
+        self.assertEqual(len(saved), 40)
+
+
+class SlotKeyTest(BookingTestCase):
+
+    def setUp(self):
+        super(SlotKeyTest, self).setUp()
+        Booking.ancestor_keys = True
+
+    def slotBooking(self, start=START):
+        return self.makeBooking(start, key=Booking.newKey(self.teacher.key, start))
+
+    def test_put_counted_slot_taken(self):
+        self.slotBooking().putCounted()
+        self.assertRaises(SlotTakenError, self.slotBooking().putCounted)
+        self.assertEqual(counters.getCounts([Booking.teacherCounter('teacher')]).values(), [1])
+
+    def test_put_multi_counted_leaves_out_taken(self):
+        self.slotBooking().putCounted()
+        later = START + timedelta(hours=1)
+        saved = Booking.putMultiCounted([self.slotBooking(), self.slotBooking(later),
+            self.slotBooking(later)])
+        self.assertEqual([b.start_time for b in saved], [later])
+        self.assertEqual(Booking.query().count(), 2)
+        self.assertEqual(counters.getCounts([Booking.teacherCounter('teacher')]).values(), [2])
+
+    def test_slot_free_again_after_cancel(self):
+        booking = self.slotBooking()
+        booking.putCounted()
+        canceled = Booking.cancelMulti([booking])
+        self.assertFalse(canceled[0].isSlotKeyed())
+        self.slotBooking().putCounted()
+        bookings = Booking.getBookingsForResource(self.teacher)
+        self.assertEqual(sorted(b.canceled is None for b in bookings), [False, True])
+
+
+class MigrationTest(BookingTestCase):
+
+    def migrate(self, page_size=100):
+        moved, cursor, more = Booking.migrateToAncestorKeys(page_size=page_size)
+        pages = 1
+        while more and cursor is not None:
+            n, cursor, more = Booking.migrateToAncestorKeys(cursor, page_size=page_size)
+            moved += n
+            pages += 1
+        return (moved, pages)
+
+    def test_several_pages(self):
+        teachers = [self.teacher, self.makeTeacher('other'), self.makeTeacher('third')]
+        roots = self.makeRoots(teachers, 40)
+        names = list(set(name for b in roots for name in b.counterNames()))
+        counts = counters.getCounts(names)
+        Booking.ancestor_keys = True
+        moved, pages = self.migrate(page_size=7)
+        self.assertEqual(moved, 40)
+        self.assertTrue(pages > 6)
+        self.assertEqual(Booking.finishMigration(), 0)
+        self.assertTrue(Booking.rootsMigrated())
+        self.assertIsNotNone(BookingKeysMigration.get_by_id('done'))
+
+        bookings = Booking.query().fetch()
+        self.assertEqual(len(bookings), 40)
+        self.assertTrue(all(b.isSlotKeyed() for b in bookings))
+        by_root = dict((b.moved_from, b) for b in bookings)
+        for old in roots:
+            new = by_root[old.key]
+            self.assertEqual(new.key.parent(), old.resource)
+            self.assertEqual((new.start_time, new.created, new.attendee), 
+                (old.start_time, old.created, old.attendee))
+        self.assertEqual(counters.getCounts(names), counts)
+        for teacher in teachers:
+            self.assertEqual(len(Booking.getBookingsForResource(teacher)), 14 if teacher is self.teacher else 13)
+
+    def test_canceled_and_duplicate_in_one_slot(self):
+        active = self.makeRoots([self.teacher], 1)[0]
+        duplicate = self.makeBooking()
+        duplicate.put()
+        canceled = self.makeBooking()
+        canceled.canceled = datetime(2030, 3, 1)
+        canceled.put()
+        Booking.ancestor_keys = True
+        self.assertEqual(self.migrate(), (3, 1))
+        self.assertEqual(Booking.finishMigration(), 0)
+
+        bookings = Booking.getBookingsForResource(self.teacher)
+        self.assertEqual(len(bookings), 3)
+        slot_keyed = [b for b in bookings if b.isSlotKeyed()]
+        self.assertEqual(len(slot_keyed), 1)
+        self.assertEqual(slot_keyed[0].key, Booking.newKey(self.teacher.key, START))
+        self.assertIsNone(slot_keyed[0].canceled)
+        self.assertEqual(len(set(b.key for b in bookings)), 3)
+        self.assertEqual(len([b for b in bookings if b.canceled is None]), 2)
+        self.assertEqual(len(Booking.getBookingsForResourceBetween(self.teacher,
+            pytz.utc.localize(START), pytz.utc.localize(START + timedelta(hours=1)))), 2)
+        self.assertEqual(set(b.moved_from for b in bookings),
+            set([active.key, duplicate.key, canceled.key]))
+
+    def test_archive_name_taken(self):
+        canceled = self.makeBooking()
+        canceled.canceled = datetime(2030, 3, 1)
+        canceled.put()
+        Booking.ancestor_keys = True
+        # A booking already holds the archive name the move would use
+        archive_key = canceled.getArchiveKey(canceled.createdStamp())
+        self.makeBooking(key=archive_key).put()
+        self.assertEqual(self.migrate(), (1, 1))
+        self.assertEqual(Booking.finishMigration(), 0)
+        keys = sorted(b.key.id() for b in Booking.getBookingsForResource(self.teacher))
+        self.assertEqual(keys, [archive_key.id(), canceled.getArchiveKey(canceled.createdStamp() + 1).id()])
+
+    def test_same_slot_and_creation_time(self):
+        first = self.makeBooking()
+        first.put()
+        second = self.makeBooking()
+        second.created = first.created
+        second.canceled = datetime(2030, 3, 1)
+        second.put()
+        Booking.ancestor_keys = True
+        self.assertEqual(len(Booking.getBookingsForResource(self.teacher)), 2)
+        # One moved and one not: still two different bookings
+        Booking.migrateToAncestorKeys(page_size=1)
+        self.assertEqual(sorted(b.key.parent() is None for b in Booking.query()), [False, True])
+        self.assertEqual(len(Booking.getBookingsForResource(self.teacher)), 2)
+        self.migrate()
+        self.assertEqual(len(Booking.getBookingsForResource(self.teacher)), 2)
+
+    def test_slot_taken_by_new_booking(self):
+        root = self.makeRoots([self.teacher], 1)[0]
+        Booking.ancestor_keys = True
+        taken = self.makeBooking(key=Booking.newKey(self.teacher.key, START))
+        taken.putCounted()
+        self.assertEqual(self.migrate(), (1, 1))
+        self.assertEqual(Booking.finishMigration(), 0)
+        moved = [b for b in Booking.getBookingsForResource(self.teacher) if b.moved_from == root.key]
+        self.assertEqual(moved[0].key, root.getArchiveKey(root.createdStamp()))
+        self.assertIsNone(moved[0].canceled)
+        self.assertEqual(taken.key.get().moved_from, None)
+
+    def test_mixed_listing_before_finish(self):
+        roots = self.makeRoots([self.teacher], 3)
+        Booking.ancestor_keys = True
+        later = START + timedelta(hours=2)
+        self.makeBooking(later, key=Booking.newKey(self.teacher.key, later)).putCounted()
+        Booking.migrateToAncestorKeys(page_size=1)
+        self.assertFalse(Booking.rootsMigrated())
+
+        bookings = Booking.getBookingsForResource(self.teacher)
+        self.assertEqual([b.start_time for b in bookings], [b.start_time for b in roots] + [later])
+        self.assertEqual([b.key.parent() is None for b in bookings], [False, True, True, False])
+        between = Booking.getBookingsForResourceBetween(self.teacher,
+            pytz.utc.localize(START + timedelta(minutes=20)), pytz.utc.localize(later))
+        self.assertEqual([b.key for b in between], [roots[1].key, roots[2].key])
+
+        self.assertEqual(Booking.finishMigration(), 2)
+        self.assertFalse(Booking.rootsMigrated())
+        self.migrate()
+        self.assertEqual(Booking.finishMigration(), 0)
+        self.assertEqual([b.start_time for b in Booking.getBookingsForResource(self.teacher)],
+            [b.start_time for b in roots] + [later])
+
+    def test_moved_once(self):
+        self.makeRoots([self.teacher], 2)
+        Booking.ancestor_keys = True
+        moved, cursor, more = Booking.migrateToAncestorKeys()
+        self.assertEqual(moved, 2)
+        self.assertEqual(Booking.migrateToAncestorKeys()[0], 0)
+
+
+class EventualMigrationTest(BookingTestCase):
+    # Global queries only see a write once its entity group is read again
+    consistency = 0
+
+    def test_moved_roots_listed_once(self):
+        roots = self.makeRoots([self.teacher], 4)
+        for b in roots:
+            b.key.get(use_cache=False, use_memcache=False)
+        Booking.ancestor_keys = True
+        Booking.migrateToAncestorKeys()
+        # The query by resource still returns the deleted root entities
+        self.assertEqual(len(Booking.query(Booking.resource == self.teacher.key).fetch(keys_only=True)), 4)
+        bookings = Booking.getBookingsForResource(self.teacher)
+        self.assertEqual([b.start_time for b in bookings], [b.start_time for b in roots])
+        self.assertTrue(all(b.isSlotKeyed() for b in bookings))
+
+
+if __name__ == '__main__':
+    unittest.main()
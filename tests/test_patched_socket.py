@@ -0,0 +1,100 @@
+"""
+The rewritten `_fileobject` reader in stdlib/patched_socket.py must return
+exactly what the stock `socket._fileobject` does, however recv splits up
+the data.
+"""
+
+import os
+import random
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'stdlib'))
+import patched_socket
+
+
+class FakeSocket(object):
+    """
+    Serves `data` in chunks of a random size, never more than asked for.
+    """
+
+    def __init__(self, data, rng, recv_into=True):
+        self.data = data
+        self.pos = 0
+        self.rng = rng
+        if recv_into:
+            self.recv_into = self._recv_into
+
+    def recv(self, size):
+        n = min(size, self.rng.randint(1, 5000))
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+    def _recv_into(self, buf):
+        chunk = self.recv(len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+BUFSIZES = [0, 1, 2, 16, -1, 100000]
+SIZES = [-1, 0, 1, 5, 100, 3000, 70000]
+
+
+def randomData(rng):
+    pieces = ['a', 'b', '\n', 'xyz\n', '\r\n', '\0']
+    return ''.join(rng.choice(pieces + ['q' * rng.randint(0, 300)])
+        for i in range(rng.randint(0, 400)))
+
+def randomCalls(rng):
+    return [(rng.choice(['read', 'readline']), rng.choice(SIZES))
+        for i in range(rng.randint(1, 30))]
+
+def run(module, data, calls, bufsize, seed, recv_into):
+    f = module._fileobject(FakeSocket(data, random.Random(seed), recv_into), 'rb', bufsize)
+    return [getattr(f, name)(size) for name, size in calls]
+
+
+class ReaderTest(unittest.TestCase):
+
+    def compare(self, data, calls, bufsize, seed):
+        expected = run(socket, data, calls, bufsize, seed, False)
+        for recv_into in (True, False):
+            got = run(patched_socket, data, calls, bufsize, seed, recv_into)
+            self.assertEqual(got, expected, 'seed %d, bufsize %d, recv_into %s' % (seed, bufsize, recv_into))
+            self.assertTrue(all(type(s) is str for s in got))
+
+    def test_random(self):
+        for seed in range(600):
+            rng = random.Random(seed)
+            data = randomData(rng)
+            self.compare(data, randomCalls(rng), BUFSIZES[seed % len(BUFSIZES)], seed + 1)
+
+    def test_read_all(self):
+        data = 'line one\nline two\n' * 1000
+        for bufsize in BUFSIZES:
+            self.compare(data, [('readline', -1), ('read', 10), ('read', -1), ('read', -1)], bufsize, 1)
+
+    def test_long_lines(self):
+        data = ('x' * 20000 + '\n') * 3 + 'tail'
+        for bufsize in BUFSIZES:
+            self.compare(data, [('readline', -1), ('readline', 100), ('readline', 30000),
+                ('readline', -1), ('readline', -1), ('readline', -1)], bufsize, 2)
+
+    def test_empty(self):
+        for bufsize in BUFSIZES:
+            self.compare('', [('read', -1), ('readline', -1), ('read', 10), ('readline', 5)], bufsize, 3)
+
+    def test_iteration(self):
+        data = 'a\nbb\n\nccc'
+        for bufsize in BUFSIZES:
+            f = patched_socket._fileobject(FakeSocket(data, random.Random(4)), 'rb', bufsize)
+            self.assertEqual(list(f), ['a\n', 'bb\n', '\n', 'ccc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
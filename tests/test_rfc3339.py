@@ -0,0 +1,89 @@
+import calendar
+from datetime import date, datetime
+import unittest
+
+from dateutil import parser as date_parser
+import pytz
+
+import rfc3339
+from tests import testing
+from models import User
+
+
+def expected(s):
+    return calendar.timegm(date_parser.parse(s).utctimetuple())
+
+
+class ParseDateTimeTest(unittest.TestCase):
+
+    def check(self, s):
+        self.assertEqual(rfc3339.parse_datetime(s), expected(s), s)
+
+    def test_utc(self):
+        self.check('2030-03-04T08:00:00Z')
+        self.check('1999-12-31T23:59:59Z')
+        self.assertEqual(rfc3339.parse_datetime('2030-03-04T08:00:00z'),
+            expected('2030-03-04T08:00:00Z'))
+
+    def test_offsets(self):
+        for s in ('2030-03-04T08:00:00+00:00', '2030-03-04T08:00:00-00:00',
+                '2030-03-04T08:00:00-08:00', '2030-03-04T20:15:00+05:30',
+                '2030-03-04T01:30:00+14:00', '2030-03-04T23:45:00-09:30',
+                '2030-03-01T00:00:00+01:00', '2030-12-31T22:00:00-03:00'):
+            self.check(s)
+
+    def test_fractional_seconds(self):
+        for s in ('2030-03-04T08:00:01.5Z', '2030-03-04T08:00:59.999999-07:00',
+                '2030-03-04T08:00:00.000+02:00'):
+            self.check(s)
+        self.assertEqual(rfc3339.parse_datetime('2030-03-04T08:00:01.999Z'),
+            rfc3339.parse_datetime('2030-03-04T08:00:01Z'))
+
+    def test_same_instant(self):
+        self.assertEqual(rfc3339.parse_datetime('2030-03-04T08:00:00-08:00'),
+            rfc3339.parse_datetime('2030-03-04T16:00:00Z'))
+
+
+class ParseDateTest(unittest.TestCase):
+
+    def test_date(self):
+        self.assertEqual(rfc3339.parse_date('2030-03-04'), (2030, 3, 4))
+        self.assertEqual(rfc3339.parse_date('1999-12-31'), (1999, 12, 31))
+        d = date_parser.parse('2030-02-28').date()
+        self.assertEqual(rfc3339.parse_date('2030-02-28'), (d.year, d.month, d.day))
+
+
+class ParseEventTimesTest(testing.ServiceTestCase):
+
+    def setUp(self):
+        super(ParseEventTimesTest, self).setUp()
+        self.user = User(id='teacher', email='teacher@example.org',
+            first_name='Pat', last_name='Lee')
+        self.user.prefs = self.user.defaultUserPrefs()
+        self.user.prefs.timezone = 'America/Los_Angeles'
+
+    def local(self, *args):
+        tz = pytz.timezone('America/Los_Angeles')
+        return calendar.timegm(tz.localize(datetime(*args)).utctimetuple())
+
+    def test_timed_event(self):
+        busy = self.user.parseEventTimes({
+            'start': { 'dateTime': '2030-03-04T08:00:00-08:00' },
+            'end': { 'dateTime': '2030-03-04T08:20:00.500-08:00' } })
+        self.assertEqual(busy, (self.local(2030, 3, 4, 8, 0), self.local(2030, 3, 4, 8, 20)))
+
+    def test_all_day_event(self):
+        busy = self.user.parseEventTimes({
+            'start': { 'date': '2030-03-04' }, 'end': { 'date': '2030-03-05' } })
+        self.assertEqual(busy, (self.local(2030, 3, 4), self.local(2030, 3, 5)))
+        self.assertEqual(busy.end - busy.start, 86400)
+
+    def test_all_day_event_across_dst(self):
+        busy = self.user.parseEventTimes({
+            'start': { 'date': '2030-03-09' }, 'end': { 'date': '2030-03-12' } })
+        self.assertEqual(busy, (self.local(2030, 3, 9), self.local(2030, 3, 12)))
+        self.assertEqual(busy.end - busy.start, 3 * 86400 - 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import unittest
+
+from tests import testing
+from google.appengine.ext import ndb
+
+import search
+from models import User
+
+
+class TokensTest(unittest.TestCase):
+
+    def test_tokens(self):
+        self.assertEqual(search.tokensFor(['Ann', u'Pérez', None]),
+            ['a', 'an', 'ann', 'p', 'pe', 'per', 'pere', 'perez'])
+
+    def test_long_words_are_cut(self):
+        tokens = search.tokensFor(['Abcdefghijklmnop'])
+        self.assertEqual(len(tokens), search.MAX_PREFIX)
+        self.assertEqual(tokens[-1], 'abcdefghijkl')
+
+    def test_query_terms(self):
+        self.assertEqual(search.queryTerms(u'  ann  PÉREZ ann '), [u'perez', u'ann'])
+        self.assertEqual(search.queryTerms(' , '), [ ])
+
+    def test_matches(self):
+        self.assertTrue(search.matches(['Ann', 'Perez', 'Room 12'], ['room', 'pe', '1']))
+        self.assertFalse(search.matches(['Ann', 'Perez'], ['ann', 'x']))
+        self.assertTrue(search.matches(['Abcdefghijklmnop'], ['abcdefghijklmn']))
+
+
+class UserSearchTest(testing.ServiceTestCase):
+
+    def makeTeacher(self, n, first_name, last_name, location=None, deleted=None):
+        user = User(id='t%d' % n, email='t%d@example.org' % n, auth_type='gafe',
+            first_name=first_name, last_name=last_name, deleted=deleted)
+        user.prefs = user.defaultUserPrefs()
+        user.prefs.location = location
+        user.days = user.defaultDayPrefs()
+        return user
+
+    def test_by_last_name(self):
+        users = [ ]
+        for n in range(250):
+            # Key order is not last name order
+            users.append(self.makeTeacher(n, 'Sam', 'Smith%03d' % ((n * 7) % 250)))
+        users.append(self.makeTeacher(300, 'Ann', 'Jones', location='Science 2'))
+        users.append(self.makeTeacher(301, 'Ann', 'Aaron', deleted=datetime(2030, 1, 1)))
+        ndb.put_multi(users)
+
+        found, truncated = User.search('s', limit=100)
+        self.assertTrue(truncated)
+        self.assertEqual([u.last_name for u in found], ['Jones'] + ['Smith%03d' % i for i in range(99)])
+
+        found, truncated = User.search('ann', limit=100)
+        self.assertFalse(truncated)
+        self.assertEqual([u.last_name for u in found], ['Jones'])
+
+        found, truncated = User.search('sam smith01', limit=5, page_size=3)
+        self.assertTrue(truncated)
+        self.assertEqual([u.last_name for u in found], ['Smith%03d' % i for i in range(10, 15)])
+
+        found, truncated = User.search('sc ann')
+        self.assertEqual(([u.last_name for u in found], truncated), (['Jones'], False))
+
+        self.assertEqual(User.search(' '), ([ ], False))
+
+    def test_exactly_limit(self):
+        ndb.put_multi([self.makeTeacher(n, 'Sam', 'Smith%d' % n) for n in range(5)])
+        found, truncated = User.search('smith', limit=5, page_size=2)
+        self.assertEqual((len(found), truncated), (5, False))
+        found, truncated = User.search('smith', limit=4, page_size=2)
+        self.assertEqual((len(found), truncated), (4, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+from datetime import date, datetime, time
+import unittest
+
+import pytz
+
+import slots
+from slots import SlotGrid, BusyInterval, merge_intervals, to_epoch
+
+
+PACIFIC = pytz.timezone('America/Los_Angeles')
+
+# Daylight saving time starts at 2 am on Sunday, March 10, 2030
+FRIDAY_BEFORE_DST = date(2030, 3, 8)
+MONDAY_AFTER_DST = date(2030, 3, 11)
+
+
+def local(d, hour, minute=0):
+    return PACIFIC.localize(datetime.combine(d, time(hour, minute)))
+
+
+class SpanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 20)
+        self.d = date(2030, 3, 4)
+        self.day = self.grid.addDay(self.d, time(8, 0), time(10, 0))
+
+    def span(self, start, end):
+        return self.grid._span(self.day, to_epoch(start), to_epoch(end))
+
+    def test_day_layout(self):
+        self.assertEqual(self.day.count, 6)
+        self.assertEqual(self.day.start_minute, 8 * 60)
+        self.assertEqual(self.day.origin, to_epoch(local(self.d, 8)))
+        self.assertEqual(self.day.schedule, 0b111111)
+
+    def test_whole_cells(self):
+        self.assertEqual(self.span(local(self.d, 8, 20), local(self.d, 9, 0)), 0b000110)
+
+    def test_partial_cells_are_covered(self):
+        self.assertEqual(self.span(local(self.d, 8, 10), local(self.d, 8, 30)), 0b000011)
+
+    def test_day_edges(self):
+        self.assertEqual(self.span(local(self.d, 7, 0), local(self.d, 8, 0)), 0)
+        self.assertEqual(self.span(local(self.d, 10, 0), local(self.d, 11, 0)), 0)
+        self.assertEqual(self.span(local(self.d, 7, 0), local(self.d, 8, 1)), 0b000001)
+        self.assertEqual(self.span(local(self.d, 9, 59), local(self.d, 11, 0)), 0b100000)
+        self.assertEqual(self.span(local(self.d, 0, 0), local(self.d, 23, 59)), 0b111111)
+
+    def test_empty_interval(self):
+        self.assertEqual(self.span(local(self.d, 9, 0), local(self.d, 9, 0)), 0)
+
+    def test_empty_day(self):
+        self.assertIsNone(self.grid.addDay(date(2030, 3, 5), time(10, 0), time(10, 0)))
+        self.assertEqual(len(self.grid.days), 1)
+
+
+class MarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 30)
+        for d in (date(2030, 3, 4), date(2030, 3, 5), date(2030, 3, 6)):
+            self.grid.addDay(d, time(8, 0), time(10, 0))
+
+    def test_marks_across_days(self):
+        self.grid.markBusy(local(date(2030, 3, 4), 9, 30), local(date(2030, 3, 6), 8, 30))
+        self.assertEqual([day.busy for day in self.grid.days], [0b1000, 0b1111, 0b0001])
+
+    def test_marks_epoch_seconds(self):
+        self.grid.markBooked(to_epoch(local(date(2030, 3, 5), 9, 0)),
+            to_epoch(local(date(2030, 3, 5), 9, 30)))
+        self.assertEqual([day.booked for day in self.grid.days], [0, 0b0100, 0])
+
+    def test_outside_grid(self):
+        self.grid.markBusy(local(date(2030, 3, 1), 8), local(date(2030, 3, 4), 8))
+        self.grid.markBusy(local(date(2030, 3, 6), 10), local(date(2030, 3, 9), 8))
+        self.assertEqual([day.busy for day in self.grid.days], [0, 0, 0])
+
+    def test_planes_are_separate(self):
+        self.grid.markBusy(local(date(2030, 3, 4), 8), local(date(2030, 3, 4), 9))
+        self.grid.markDeadline(local(date(2030, 3, 4), 8, 30), local(date(2030, 3, 4), 9, 30))
+        day = self.grid.days[0]
+        self.assertEqual((day.busy, day.booked, day.deadline), (0b0011, 0, 0b0110))
+        self.assertEqual(day.available, 0b1000)
+
+
+class DaylightSavingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 30)
+        self.before = self.grid.addDay(FRIDAY_BEFORE_DST, time(8, 0), time(10, 0))
+        self.after = self.grid.addDay(MONDAY_AFTER_DST, time(8, 0), time(10, 0))
+
+    def test_origins_follow_local_time(self):
+        self.assertEqual(self.after.origin - self.before.origin, 3 * 86400 - 3600)
+        self.assertEqual(self.before.start_minute, self.after.start_minute)
+
+    def test_mark_across_change(self):
+        # 16:00 UTC is 8 am before the change and 9 am after it
+        utc = pytz.utc
+        self.grid.markBusy(utc.localize(datetime(2030, 3, 8, 16, 0)),
+            utc.localize(datetime(2030, 3, 11, 16, 30)))
+        self.assertEqual(self.before.busy, 0b1111)
+        self.assertEqual(self.after.busy, 0b0111)
+        self.assertTrue(self.grid.isAvailable(MONDAY_AFTER_DST, time(9, 30)))
+        self.assertFalse(self.grid.isAvailable(MONDAY_AFTER_DST, time(9, 0)))
+
+    def test_short_day(self):
+        day = self.grid.addDay(date(2030, 3, 10), time(1, 0), time(4, 0))
+        self.assertEqual(day.count, 4)
+
+
+class LunchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 20)
+        self.d = date(2030, 3, 4)
+
+    def test_lunch_cells_removed(self):
+        day = self.grid.addDay(self.d, time(11, 0), time(13, 0), time(12, 0), time(12, 20))
+        self.assertEqual(day.schedule, 0b110111)
+        self.assertEqual(self.grid.statusAt(self.d, time(12, 0)), slots.SLOT_OFF_SCHEDULE)
+        self.assertEqual(self.grid.statusAt(self.d, time(12, 20)), slots.SLOT_AVAILABLE)
+
+    def test_partial_overlap_removes_cells(self):
+        day = self.grid.addDay(self.d, time(11, 0), time(13, 0), time(11, 50), time(12, 30))
+        self.assertEqual(day.schedule, 0b100011)
+
+    def test_lunch_outside_day(self):
+        day = self.grid.addDay(self.d, time(8, 0), time(9, 0), time(12, 0), time(13, 0))
+        self.assertEqual(day.schedule, 0b111)
+
+    def test_no_lunch_end(self):
+        day = self.grid.addDay(self.d, time(11, 0), time(12, 0), time(11, 20), None)
+        self.assertEqual(day.schedule, 0b111)
+
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 30)
+        self.d = date(2030, 3, 4)
+        self.grid.addDay(self.d, time(8, 0), time(10, 0))
+
+    def status(self, hour, minute=0):
+        return self.grid.statusAt(self.d, time(hour, minute))
+
+    def test_available(self):
+        self.assertEqual(self.status(8), slots.SLOT_AVAILABLE)
+
+    def test_off_schedule(self):
+        self.assertEqual(self.status(7, 30), slots.SLOT_OFF_SCHEDULE)
+        self.assertEqual(self.status(10), slots.SLOT_OFF_SCHEDULE)
+        self.assertEqual(self.status(8, 15), slots.SLOT_OFF_SCHEDULE)
+        self.assertEqual(self.grid.statusAt(date(2030, 3, 5), time(8)), slots.SLOT_OFF_SCHEDULE)
+
+    def test_booked_beats_busy(self):
+        self.grid.markBusy(local(self.d, 8), local(self.d, 9))
+        self.grid.markBooked(local(self.d, 8, 30), local(self.d, 9, 30))
+        self.assertEqual(self.status(8), slots.SLOT_BUSY)
+        self.assertEqual(self.status(8, 30), slots.SLOT_BOOKED)
+        self.assertEqual(self.status(9), slots.SLOT_BOOKED)
+
+    def test_deadline_is_added(self):
+        self.grid.markBusy(local(self.d, 8, 30), local(self.d, 9))
+        self.grid.markBooked(local(self.d, 9), local(self.d, 9, 30))
+        self.grid.markDeadline(local(self.d, 8), local(self.d, 10))
+        self.assertEqual(self.status(8), slots.SLOT_AVAILABLE | slots.SLOT_DEADLINE)
+        self.assertEqual(self.status(8, 30), slots.SLOT_BUSY | slots.SLOT_DEADLINE)
+        self.assertEqual(self.status(9), slots.SLOT_BOOKED | slots.SLOT_DEADLINE)
+        self.assertFalse(self.grid.isAvailable(self.d, time(9, 30)))
+
+
+class LimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SlotGrid(PACIFIC, 30)
+        self.grid.addDay(date(2030, 3, 4), time(9, 0), time(11, 0))
+        self.grid.addDay(date(2030, 3, 5), time(8, 0), time(10, 0))
+        self.grid.addDay(date(2030, 3, 6), time(8, 0), time(9, 0))
+
+    def test_all_scheduled(self):
+        self.grid.markBusy(local(date(2030, 3, 6), 0), local(date(2030, 3, 7), 0))
+        limits = self.grid.getLimits(False)
+        self.assertEqual(limits['dates'], [date(2030, 3, 4), date(2030, 3, 5), date(2030, 3, 6)])
+        self.assertEqual(limits['times'][0], time(8, 0))
+        self.assertEqual(limits['times'][-1], time(10, 30))
+        self.assertEqual(len(limits['times']), 6)
+
+    def test_available_only(self):
+        self.grid.markBusy(local(date(2030, 3, 6), 0), local(date(2030, 3, 7), 0))
+        self.grid.markBooked(local(date(2030, 3, 4), 10, 30), local(date(2030, 3, 4), 11))
+        self.grid.markDeadline(local(date(2030, 3, 5), 8), local(date(2030, 3, 5), 9))
+        limits = self.grid.getLimits()
+        self.assertEqual(limits['dates'], [date(2030, 3, 4), date(2030, 3, 5)])
+        self.assertEqual(limits['times'], [time(9, 0), time(9, 30), time(10, 0)])
+
+    def test_nothing_available(self):
+        self.grid.markBusy(local(date(2030, 3, 4), 0), local(date(2030, 3, 7), 0))
+        self.assertEqual(self.grid.getLimits(), { 'dates': [ ], 'times': [ ] })
+
+
+class ToSlotsTest(unittest.TestCase):
+
+    def test_slots(self):
+        grid = SlotGrid(PACIFIC, 30)
+        d = date(2030, 3, 4)
+        grid.addDay(d, time(11, 0), time(13, 0), time(12, 0), time(12, 30))
+        grid.markBooked(local(d, 11, 30), local(d, 12, 0))
+        result = grid.toSlots()
+        self.assertEqual([(s['start'], s['end'], s.get('available')) for s in result], [
+            (local(d, 11, 0), local(d, 11, 30), True),
+            (local(d, 11, 30), local(d, 12, 0), False),
+            (local(d, 12, 30), local(d, 13, 0), True),
+        ])
+        self.assertEqual(result[0].start.tzinfo.zone, 'America/Los_Angeles')
+
+    def test_slots_after_dst(self):
+        grid = SlotGrid(PACIFIC, 30)
+        grid.addDay(MONDAY_AFTER_DST, time(8, 0), time(9, 0))
+        starts = [s.start for s in grid.toSlots()]
+        self.assertEqual(starts, [local(MONDAY_AFTER_DST, 8), local(MONDAY_AFTER_DST, 8, 30)])
+        self.assertEqual([to_epoch(s) for s in starts],
+            [grid.days[0].origin, grid.days[0].origin + 1800])
+
+
+class IntersectTest(unittest.TestCase):
+
+    def test_intersect(self):
+        d1, d2, d3 = date(2030, 3, 4), date(2030, 3, 5), date(2030, 3, 6)
+        first = SlotGrid(PACIFIC, 30)
+        first.addDay(d1, time(8, 0), time(10, 0))
+        first.addDay(d2, time(8, 0), time(10, 0))
+        first.addDay(d3, time(8, 0), time(10, 0))
+        first.markBusy(local(d1, 8), local(d1, 8, 30))
+        second = SlotGrid(PACIFIC, 30)
+        second.addDay(d1, time(8, 0), time(9, 30))
+        second.addDay(d2, time(8, 30), time(10, 0))
+        second.markBooked(local(d1, 9), local(d1, 9, 30))
+
+        both = first.intersect(second)
+        self.assertEqual([day.date for day in both.days], [d1])
+        self.assertEqual(both.days[0].count, 3)
+        self.assertEqual(both.days[0].available, 0b010)
+        self.assertEqual(both.getDay(d1), both.days[0])
+        self.assertIsNone(both.getDay(d2))
+        self.assertTrue(both.isAvailable(d1, time(8, 30)))
+        self.assertFalse(both.isAvailable(d1, time(8, 0)))
+
+
+class MergeIntervalsTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(list(merge_intervals()), [ ])
+        self.assertEqual(list(merge_intervals([ ], [ ])), [ ])
+
+    def test_merges_streams(self):
+        merged = list(merge_intervals(
+            [(0, 10), (20, 30), (50, 60)],
+            [(5, 15), (30, 40)],
+            [(45, 46), (55, 58)]))
+        self.assertEqual(merged, [(0, 15), (20, 40), (45, 46), (50, 60)])
+        self.assertTrue(all(isinstance(i, BusyInterval) for i in merged))
+
+    def test_contained_and_touching(self):
+        self.assertEqual(list(merge_intervals([(0, 100), (10, 20), (100, 110)])), [(0, 110)])
+
+    def test_gap_kept(self):
+        self.assertEqual(list(merge_intervals([(0, 10)], [(11, 20)])), [(0, 10), (11, 20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
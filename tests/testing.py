@@ -0,0 +1,43 @@
+"""
+Set up for tests that use the App Engine service stubs.  The SDK must be
+on PYTHONPATH, as for the benchmarks:
+
+    PYTHONPATH=$GAE_SDK:$GAE_SDK/lib/fancy_urllib python -m unittest discover -s tests -t .
+"""
+
+import os
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+# Load lib/ now: once the testbed is active, appengine_config would also
+# apply the dev_appserver socket patch, which needs the real dev server
+import appengine_config
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+class ServiceTestCase(unittest.TestCase):
+    """
+    Activates a testbed with the datastore, memcache and task queue stubs.
+    `consistency` is the chance that a global query sees a write before
+    its entity group is read again; 1 makes the stub strongly consistent.
+    """
+    consistency = 1
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=self.consistency))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()